@@ -9,6 +9,7 @@ for penetration testing training purposes only. DO NOT deploy to production!
 from flask import Flask, render_template, request, session, redirect, url_for, jsonify, send_file
 import os
 import secrets
+import click
 from datetime import datetime
 
 # Import configuration
@@ -16,6 +17,8 @@ import config
 
 # Import database functions
 import database as db
+import pdf_renderer
+from attachment_store import attachment_store
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -32,6 +35,12 @@ app.config['SESSION_COOKIE_HTTPONLY'] = config.SESSION_COOKIE_HTTPONLY
 app.config['SESSION_COOKIE_SAMESITE'] = config.SESSION_COOKIE_SAMESITE
 app.config['PERMANENT_SESSION_LIFETIME'] = config.PERMANENT_SESSION_LIFETIME
 
+# Pooled, request-scoped database connections
+db.init_app(app)
+
+# Background runner for queued PDF jobs
+pdf_renderer.init_app(app)
+
 # Vulnerability #24: Missing security headers
 @app.after_request
 def add_headers(response):
@@ -115,7 +124,7 @@ def dashboard():
     stats = db.get_dashboard_stats(user_id)
 
     # Get recent invoices
-    recent_invoices = db.get_invoices_by_user(user_id)[:5]
+    recent_invoices = db.get_recent_invoices(user_id, limit=5)
 
     return render_template('dashboard/index.html',
                           stats=stats,
@@ -209,6 +218,83 @@ def handle_exception(error):
     return "An error occurred", 500
 
 
+# Maintenance commands (run with: flask --app app <command>)
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Apply schema.sql to an existing database"""
+    db.migrate_schema()
+    click.echo(f"Schema applied to {config.DATABASE_PATH}")
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the dashboard invoice_stats rollup"""
+    rows = db.rebuild_dashboard_rollups()
+    click.echo(f"Rebuilt invoice_stats ({rows} rows)")
+
+
+@app.cli.command('check-rollups')
+def check_rollups_command():
+    """Verify the dashboard rollup against live aggregates"""
+    mismatches = db.check_dashboard_rollups()
+    for user_id, status, expected, actual in mismatches:
+        click.echo(f"user {user_id} status '{status}': expected {expected}, found {actual}")
+    if mismatches:
+        raise SystemExit(1)
+    click.echo("invoice_stats is consistent")
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Backfill the invoices_fts full-text index"""
+    rows = db.rebuild_search_index()
+    click.echo(f"Indexed {rows} invoices")
+
+
+@app.cli.command('archive-logs')
+@click.option('--days', type=int, default=config.ACTIVITY_LOG_RETENTION_DAYS,
+              help='Keep this many days of activity in the live table')
+def archive_logs_command(days):
+    """Move old activity_log rows into monthly archive tables"""
+    moved = db.archive_activity_log(retention_days=days)
+    for month, rows in moved.items():
+        click.echo(f"{month}: {rows} rows archived")
+    click.echo(f"Archived {sum(moved.values())} rows older than {days} days")
+
+
+@app.cli.command('export-invoices')
+@click.option('--format', 'fmt', type=click.Choice(db.EXPORT_FORMATS), default='csv')
+@click.option('--from', 'date_from', help='First invoice_date to include (YYYY-MM-DD)')
+@click.option('--to', 'date_to', help='Last invoice_date to include (YYYY-MM-DD)')
+@click.option('--status', 'statuses', multiple=True, help='Only these statuses (repeatable)')
+@click.option('--user-id', type=int, help="Only this user's invoices")
+@click.option('--company-id', type=int, help="Only this company's invoices")
+@click.option('--output', type=click.File('w'), default='-', help='Output file (default stdout)')
+def export_invoices_command(fmt, date_from, date_to, statuses, user_id, company_id, output):
+    """Stream invoices with company and line items to CSV or NDJSON"""
+    rows = db.iter_invoice_export(date_from, date_to, statuses, user_id, company_id)
+    for line in db.iter_export_lines(rows, fmt):
+        output.write(line)
+
+
+@app.cli.command('gc-attachments')
+@click.option('--grace', type=int, default=config.ATTACHMENT_GC_GRACE,
+              help='Keep unreferenced blobs younger than this many seconds')
+def gc_attachments_command(grace):
+    """Delete attachment blobs no invoice references any more"""
+    removed, freed = attachment_store.collect_garbage(grace)
+    click.echo(f"Removed {removed} unreferenced blobs ({freed} bytes)")
+
+
+@app.cli.command('revoke-api-key')
+@click.argument('key_id', type=int)
+def revoke_api_key_command(key_id):
+    """Deactivate an API key"""
+    if not db.revoke_api_key(key_id):
+        raise click.ClickException(f"No API key with id {key_id}")
+    click.echo(f"Revoked API key {key_id} (running servers drop it within {config.API_KEY_CACHE_TTL}s)")
+
+
 # Main entry point
 if __name__ == '__main__':
     # Ensure upload directory exists
@@ -218,6 +304,12 @@ if __name__ == '__main__':
     if not os.path.exists(config.DATABASE_PATH):
         db.init_database()
         print("Database initialized with seed data")
+    else:
+        db.migrate_schema()
+
+    # Report the connection PRAGMAs actually in effect
+    pragmas = db.get_pragma_report()
+    print("Database PRAGMAs: " + ', '.join(f"{k}={v}" for k, v in pragmas.items()))
 
     # Vulnerability #12: Debug mode enabled in production
     # Vulnerability #24: Running on 0.0.0.0 exposes to network
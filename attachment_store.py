@@ -0,0 +1,140 @@
+"""
+Attachment storage for InvoiceFlow
+Uploads are stored once per distinct content, named by their SHA-256 and
+sharded two levels deep (ab/cd/abcd...). The attachments table references
+blobs by digest and attachment_blobs counts the references, so identical
+files uploaded to many invoices share one blob and unreferenced blobs can
+be garbage collected.
+"""
+
+import os
+import hashlib
+import tempfile
+import time
+import database as db
+from config import ATTACHMENT_STORE_DIR, ATTACHMENT_CHUNK_SIZE, ATTACHMENT_GC_GRACE
+
+
+class AttachmentStore:
+    """Content-addressed blob files on disk"""
+
+    def __init__(self, root=ATTACHMENT_STORE_DIR, chunk_size=ATTACHMENT_CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def save_stream(self, stream, register=None):
+        """
+        Copy a file-like object into the store, hashing it on the way
+        Reads `chunk_size` bytes at a time into a temp file, then renames it
+        to its digest. Content that is already stored is not written twice.
+        With `register`, the rename is left to it: it is called as
+        register(sha256, size, place) and must call place() while it holds
+        the database write lock, as db.set_invoice_attachment() does, so GC
+        cannot remove a blob this upload deduplicates onto.
+        Returns (sha256, size).
+        """
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+            sha256 = digest.hexdigest()
+            path = self.path_for(sha256)
+
+            def place():
+                try:
+                    # Deduplicated; touch it so it is fresh for the grace period
+                    os.utime(path)
+                except FileNotFoundError:
+                    # New content, or GC removed the blob earlier: write ours
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(tmp_path, path)
+
+            if register is None:
+                place()
+            else:
+                register(sha256, size, place)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return sha256, size
+
+    def exists(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def collect_garbage(self, grace_seconds=ATTACHMENT_GC_GRACE):
+        """
+        Remove blobs nobody references any more
+        Blob rows with ref_count 0 for longer than `grace_seconds` are deleted
+        with their files. Files on disk with no blob row at all (an upload
+        that failed before its row was written) are removed once they are
+        older than the grace period. Each blob is re-checked and unlinked
+        under the database write lock (db.release_unreferenced_blob), so an
+        upload deduplicating onto it meanwhile keeps it.
+        Returns (files_removed, bytes_freed).
+        """
+        cutoff = time.time() - grace_seconds
+        removed, freed = 0, 0
+
+        def release(path, sha256):
+            return db.release_unreferenced_blob(
+                sha256, grace_seconds, lambda: self._remove_if_stale(path, cutoff))
+
+        for sha256 in db.get_unreferenced_blobs(grace_seconds):
+            size = release(self.path_for(sha256), sha256)
+            if size is not None:
+                removed += 1
+                freed += size
+
+        tmp_dir = os.path.join(self.root, 'tmp')
+        known = db.get_blob_digests()
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if name in known:
+                    continue
+                path = os.path.join(root, name)
+                if root == tmp_dir:
+                    # Leftover upload temp file; no row can reference it
+                    size = self._remove_if_stale(path, cutoff)
+                else:
+                    size = release(path, name)
+                if size is not None:
+                    removed += 1
+                    freed += size
+
+        return removed, freed
+
+    def _remove_if_stale(self, path, cutoff):
+        """
+        Delete a file not modified since `cutoff`, returning its size
+        Returns None if the file was kept, and 0 if it was already gone so
+        its blob row can still be released.
+        """
+        try:
+            st = os.stat(path)
+            if st.st_mtime >= cutoff:
+                return None
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        except OSError:
+            return None
+        return st.st_size
+
+
+attachment_store = AttachmentStore()
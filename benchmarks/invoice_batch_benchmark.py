@@ -0,0 +1,97 @@
+"""
+Benchmark: columnar InvoiceBatch aggregates vs per-row dict aggregation
+Builds a throwaway database with synthetic invoices, then computes totals,
+per-status, per-company and per-month sums both ways: looping over
+[dict(inv) for inv in invoices] and over an InvoiceBatch. Load and
+aggregate times are reported separately.
+
+Usage:
+    python benchmarks/invoice_batch_benchmark.py [invoice_count]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import config
+
+config.DATABASE_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import database as db
+
+STATUSES = ['draft', 'sent', 'paid', 'overdue', 'cancelled']
+
+
+def populate(count):
+    """Insert `count` invoices spread over three years"""
+    db.init_database()
+    rng = random.Random(42)
+    start = date(2022, 1, 1)
+    with db.UnitOfWork() as uow:
+        for n in range(count):
+            subtotal = rng.randint(100, 10000)
+            invoice_date = (start + timedelta(days=rng.randint(0, 1095))).isoformat()
+            uow.add_invoice(
+                rng.randint(2, 5), rng.choice([None] + list(range(1, 51))),
+                f'INV-2024-{n + 1000:06d}', invoice_date, None, rng.choice(STATUSES),
+                subtotal, 10, subtotal / 10, 0, subtotal * 1.1, '', 'Net 30')
+
+
+def load_dicts():
+    conn = db.get_db_connection()
+    invoices = conn.execute("SELECT * FROM invoices").fetchall()
+    conn.close()
+    return [dict(inv) for inv in invoices]
+
+
+def aggregate_dicts(invoices):
+    """The row-at-a-time version of InvoiceBatch.summary('month')"""
+    totals = {'count': len(invoices), 'total': sum(inv['total'] for inv in invoices)}
+    by_status, by_company, by_month = {}, {}, {}
+    for inv in invoices:
+        for groups, key in ((by_status, inv['status']),
+                            (by_company, inv['company_id'] or 0),
+                            (by_month, inv['invoice_date'][:7])):
+            group = groups.setdefault(key, {'count': 0, 'total': 0.0})
+            group['count'] += 1
+            group['total'] += inv['total']
+    return totals, by_status, by_company, by_month
+
+
+def timed(func, *args, repeat=3):
+    """Best-of-N wall time in milliseconds and the last result"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print(f"Populating {count} invoices in {config.DATABASE_PATH} ...")
+    populate(count)
+
+    dict_load_ms, invoices = timed(load_dicts)
+    dict_agg_ms, _ = timed(aggregate_dicts, invoices)
+    del invoices
+
+    batch_load_ms, batch = timed(db.load_invoice_batch)
+    batch_agg_ms, _ = timed(batch.summary, 'month')
+
+    print(f"{'path':<24} {'load ms':>10} {'aggregate ms':>14}")
+    print(f"{'dict rows':<24} {dict_load_ms:>10.1f} {dict_agg_ms:>14.1f}")
+    print(f"{'InvoiceBatch (' + batch.backend + ')':<24} {batch_load_ms:>10.1f} {batch_agg_ms:>14.1f}")
+
+    db.close_pool()
+
+
+if __name__ == '__main__':
+    main()
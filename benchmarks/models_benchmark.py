@@ -0,0 +1,102 @@
+"""
+Benchmark: __slots__ models built by a row_factory vs dict(row) copies
+Builds a throwaway database with synthetic invoices, then loads them the
+way get_invoices_by_user() does ([dict(inv) for inv in invoices]), through
+Invoice.from_db_row(), and through the model_row_factory cursor, reporting
+best-of-N load time and the memory held by the resulting list.
+
+Usage:
+    python benchmarks/models_benchmark.py [invoice_count]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import config
+
+config.DATABASE_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import database as db
+from models import Invoice, model_row_factory
+
+QUERY = "SELECT * FROM invoices ORDER BY id"
+STATUSES = ['draft', 'sent', 'paid', 'overdue']
+
+
+def populate(count):
+    """Insert `count` invoices"""
+    db.init_database()
+    rng = random.Random(42)
+    with db.UnitOfWork() as uow:
+        for n in range(count):
+            subtotal = rng.randint(100, 10000)
+            uow.add_invoice(
+                rng.randint(2, 5), rng.randint(1, 6), f'INV-2024-{n + 1000:06d}',
+                '2024-01-01', '2024-01-31', rng.choice(STATUSES), subtotal, 10,
+                subtotal / 10, 0, subtotal * 1.1, 'Synthetic invoice', 'Net 30')
+
+
+def load_dicts(conn):
+    return [dict(inv) for inv in conn.execute(QUERY).fetchall()]
+
+
+def load_from_db_row(conn):
+    return [Invoice.from_db_row(inv) for inv in conn.execute(QUERY).fetchall()]
+
+
+def load_row_factory(conn):
+    cursor = conn.cursor()
+    cursor.row_factory = model_row_factory(Invoice)
+    return cursor.execute(QUERY).fetchall()
+
+
+def timed(func, conn, repeat=5):
+    """Best-of-N wall time in milliseconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(conn)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def retained_bytes(func, conn):
+    """Bytes still allocated while the loaded list is alive"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = func(conn)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del result
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"Populating {count} invoices in {config.DATABASE_PATH} ...")
+    populate(count)
+
+    conn = db.get_db_connection()
+    print(f"{'loader':<22} {'best ms':>10} {'rows/s':>12} {'MB held':>10} {'B/row':>8}")
+    for name, func in [('dict(row)', load_dicts),
+                       ('Invoice.from_db_row', load_from_db_row),
+                       ('model_row_factory', load_row_factory)]:
+        ms = timed(func, conn)
+        held = retained_bytes(func, conn)
+        print(f"{name:<22} {ms:>10.1f} {count / (ms / 1000):>12,.0f} "
+              f"{held / 1048576:>10.1f} {held / count:>8.0f}")
+    conn.close()
+
+    db.close_pool()
+
+
+if __name__ == '__main__':
+    main()
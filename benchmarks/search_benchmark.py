@@ -0,0 +1,70 @@
+"""
+Benchmark: FTS5 invoice search vs the legacy LIKE search
+Builds a throwaway database with synthetic invoices and times both paths.
+
+Usage:
+    python benchmarks/search_benchmark.py [invoice_count]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import config
+
+config.DATABASE_PATH = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import database as db
+
+WORDS = ['consulting', 'hosting', 'design', 'license', 'support', 'audit',
+         'migration', 'training', 'retainer', 'hardware', 'travel', 'review']
+SEARCH_TERMS = ['INV-2024-0012', 'PO-4242', 'consult', 'hardware support', 'Acme']
+
+
+def populate(count):
+    """Insert `count` invoices with two line items each"""
+    db.init_database()
+    rng = random.Random(42)
+    with db.UnitOfWork() as uow:
+        for n in range(count):
+            notes = ' '.join(rng.choice(WORDS) for _ in range(6)) + f' PO-{n * 7}'
+            invoice_id = uow.add_invoice(
+                rng.randint(2, 5), rng.randint(1, 6), f'INV-2024-{n + 1000:06d}',
+                '2024-01-01', None, 'draft', 100, 0, 0, 0, 100, notes, 'Net 30')
+            uow.add_items(invoice_id, [
+                (f'{rng.choice(WORDS)} services', 1, 50, 50, 0),
+                (f'{rng.choice(WORDS)} fee', 1, 50, 50, 1),
+            ])
+
+
+def timed(func, *args, repeat=5):
+    """Best-of-N wall time in milliseconds and the last result"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(f"Populating {count} invoices in {config.DATABASE_PATH} ...")
+    populate(count)
+
+    print(f"{'term':<20} {'LIKE ms':>10} {'rows':>6} {'FTS5 ms':>10} {'top-N':>6}")
+    for term in SEARCH_TERMS:
+        like_ms, like_rows = timed(db.search_invoices, 2, term)
+        fts_ms, fts_rows = timed(db.search_invoices_fts, 2, term)
+        print(f"{term:<20} {like_ms:>10.2f} {len(like_rows):>6} {fts_ms:>10.2f} {len(fts_rows):>6}")
+
+    db.close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,87 @@ DEBUG = True  # Vulnerability #12: Debug mode enabled in production
 # Database Configuration
 DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'database', 'invoice.db')
 
+# Connection pool settings (see database.ConnectionPool)
+DB_POOL_SIZE = 10  # Max connections checked out at once
+DB_POOL_TIMEOUT = 5.0  # Seconds to wait for a free connection
+DB_POOL_HEALTH_CHECK = True  # Run SELECT 1 before reusing an idle connection
+
+# Pagination (keyset cursors over invoices.created_at, invoices.id)
+INVOICE_PAGE_SIZE = 50  # Default rows per page for lists and the API
+MAX_PAGE_SIZE = 500  # Upper bound for ?limit= on API requests
+STREAM_BATCH_SIZE = 500  # Rows per fetchmany() when streaming full listings
+
+# Invoice numbering (INV-YYYY-NNN)
+INVOICE_NUMBER_FORMAT = 'INV-{year}-{value:03d}'
+INVOICE_NUMBER_BLOCK_MAX = 1000  # Max numbers reserved in one API call
+
+# Activity log write-behind queue (see database.ActivityLogWriter)
+ACTIVITY_LOG_ASYNC = True  # False writes every log row synchronously
+ACTIVITY_LOG_QUEUE_SIZE = 10000  # Max rows waiting to be written
+ACTIVITY_LOG_BATCH_SIZE = 200  # Rows per multi-row INSERT
+ACTIVITY_LOG_FLUSH_INTERVAL = 0.5  # Seconds before a partial batch is written
+ACTIVITY_LOG_FULL_POLICY = 'block'  # 'block' (wait, then drop) or 'drop' when the queue is full
+ACTIVITY_LOG_BLOCK_TIMEOUT = 1.0  # Seconds to wait under the 'block' policy
+
+# Activity log retention (see database.archive_activity_log)
+ACTIVITY_LOG_RETENTION_DAYS = 90  # Rows older than this are archived
+ACTIVITY_LOG_ARCHIVE_PATH = os.path.join(os.path.dirname(__file__), 'database', 'activity_archive.db')  # None deletes instead
+ACTIVITY_LOG_PAGE_SIZE = 100  # Rows per page on /admin/logs
+
+# Aggregate cache for /api/stats and the admin panel (see database.AggregateCache)
+STATS_CACHE_TTL = 30  # Seconds; writes in this process invalidate immediately
+
+# Request-scoped identity map for users/invoices/companies (see database.get_user_by_id)
+IDENTITY_MAP_ENABLED = True  # Repeat lookups of the same id in one request come from memory
+IDENTITY_MAP_LOG = False  # Log per-request hit/miss counts (app.logger, debug level)
+
+# API key authentication cache (see database.ApiKeyCache)
+API_KEY_CACHE_SIZE = 1024  # Validated keys kept in memory (least recently used dropped first)
+API_KEY_CACHE_TTL = 30  # Seconds; revoking in this process invalidates immediately
+API_KEY_LAST_USED_FLUSH_INTERVAL = 10.0  # Seconds between batched api_keys.last_used writes
+
+# Bulk NDJSON ingestion (/api/invoices/bulk)
+BULK_IMPORT_BATCH_SIZE = 1000  # Records per transaction
+BULK_IMPORT_MAX_BATCH_SIZE = 5000  # Upper bound for ?batch_size=
+BULK_IMPORT_MAX_BYTES = 10 * 1024 * 1024 * 1024  # Replaces MAX_CONTENT_LENGTH for this endpoint
+
+# Streaming XML import (/api/invoices/import-xml); shares the bulk size limits
+XML_IMPORT_BATCH_SIZE = 1000  # Invoices per transaction
+XML_IMPORT_CHUNK_SIZE = 64 * 1024  # Bytes fed to the parser at a time
+
+# PRAGMA profile applied to every new connection
+# durable:   fsync on every commit, for data you cannot afford to lose
+# balanced:  WAL + synchronous=NORMAL, readers never block on writers
+# benchmark: no fsync at all, only for load testing throwaway databases
+DB_PRAGMA_PRESETS = {
+    'durable': {
+        'busy_timeout': 10000,
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16000,  # Negative values are KiB
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+    },
+    'balanced': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+    'benchmark': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -256000,
+        'mmap_size': 1024 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+}
+DB_PRAGMA_PROFILE = 'balanced'
+DB_PRAGMA_OVERRIDES = {}  # Per-deployment tweaks on top of the selected preset
+
 # Vulnerability #2: Hardcoded Admin Credentials
 # TODO: Remove these temporary credentials before production deployment
 DEFAULT_ADMIN_USER = 'admin'
@@ -31,8 +112,35 @@ UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'uploads')
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'doc', 'docx', 'xls', 'xlsx'}
 
+# Content-addressed attachment store (see attachment_store.AttachmentStore)
+ATTACHMENT_STORE_DIR = os.path.join(os.path.dirname(__file__), 'database', 'attachments')
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024  # Bytes read and hashed at a time
+ATTACHMENT_GC_GRACE = 3600  # Seconds an unreferenced blob is kept before collection
+# Let the front proxy send attachment bytes: None, 'x-sendfile' (Apache/lighttpd)
+# or 'x-accel-redirect' (nginx, with an internal location aliased to ATTACHMENT_STORE_DIR)
+ATTACHMENT_SENDFILE_MODE = None
+ATTACHMENT_ACCEL_PREFIX = '/protected-attachments'  # nginx internal location for X-Accel-Redirect
+
 # PDF Generation Configuration
-WKHTMLTOPDF_PATH = '/usr/bin/wkhtmltopdf'  # Used for command injection vulnerability
+WKHTMLTOPDF_PATH = '/usr/bin/wkhtmltopdf'
+
+# PDF worker pool and content-addressed cache (see pdf_renderer.PdfRenderer)
+PDF_WORKERS = os.cpu_count() or 2  # wkhtmltopdf processes running at once (one per core)
+PDF_MAX_PENDING = PDF_WORKERS * 4  # Renders queued or running before requests are turned away
+PDF_RENDER_TIMEOUT = 60  # Seconds before a wkhtmltopdf run is killed
+PDF_CACHE_DIR = os.path.join(os.path.dirname(__file__), 'database', 'pdf_cache')
+PDF_CACHE_MAX_BYTES = 512 * 1024 * 1024  # Least recently used PDFs are evicted above this
+
+# Asynchronous PDF jobs (pdf_jobs table, see pdf_renderer.PdfJobRunner)
+PDF_JOBS_ENABLED = True  # Run the job runner thread in this process
+PDF_JOB_CONCURRENCY = 2  # Jobs handed to the worker pool at once; keep below PDF_MAX_PENDING
+PDF_JOB_MAX_QUEUED = 5000  # Queued jobs before new ones are refused
+PDF_JOB_POLL_INTERVAL = 2.0  # Seconds between checks for jobs queued by other processes
+PDF_JOB_RETENTION_DAYS = 7  # Finished jobs older than this are deleted
+
+# Batch PDF ZIP downloads (/invoice/generate-pdf-batch)
+PDF_BATCH_CONCURRENCY = PDF_WORKERS  # Renders one batch keeps in the pool at once
+PDF_BATCH_MAX_INVOICES = 5000  # Larger batches are refused; narrow the filter instead
 
 # API Configuration
 API_RATE_LIMIT_ENABLED = False  # Vulnerability #19: No rate limiting
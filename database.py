@@ -5,15 +5,229 @@ Contains intentional SQL injection vulnerabilities for training
 
 import sqlite3
 import os
-from datetime import datetime
-from config import DATABASE_PATH
+import atexit
+import base64
+import csv
+import json
+import re
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import g, current_app, has_app_context, has_request_context, request
+from config import (DATABASE_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTH_CHECK,
+                    DB_PRAGMA_PRESETS, DB_PRAGMA_PROFILE, DB_PRAGMA_OVERRIDES,
+                    INVOICE_PAGE_SIZE, INVOICE_NUMBER_FORMAT, STREAM_BATCH_SIZE,
+                    ACTIVITY_LOG_ASYNC, ACTIVITY_LOG_QUEUE_SIZE, ACTIVITY_LOG_BATCH_SIZE,
+                    ACTIVITY_LOG_FLUSH_INTERVAL, ACTIVITY_LOG_FULL_POLICY,
+                    ACTIVITY_LOG_BLOCK_TIMEOUT, ACTIVITY_LOG_RETENTION_DAYS,
+                    ACTIVITY_LOG_ARCHIVE_PATH, ACTIVITY_LOG_PAGE_SIZE, STATS_CACHE_TTL,
+                    API_KEY_CACHE_SIZE, API_KEY_CACHE_TTL, API_KEY_LAST_USED_FLUSH_INTERVAL,
+                    IDENTITY_MAP_ENABLED, IDENTITY_MAP_LOG)
+from models.invoice_batch import InvoiceBatch, INVOICE_BATCH_SELECT
+from models.rows import model_row_factory
+
+
+def get_pragma_profile(name=DB_PRAGMA_PROFILE):
+    """Get the PRAGMA settings for a named preset plus config overrides"""
+    if name not in DB_PRAGMA_PRESETS:
+        raise ValueError(f"Unknown PRAGMA profile: {name}")
+    pragmas = dict(DB_PRAGMA_PRESETS[name])
+    pragmas.update(DB_PRAGMA_OVERRIDES)
+    return pragmas
+
+
+def apply_pragmas(conn, pragmas=None):
+    """Apply a PRAGMA profile to a connection"""
+    if pragmas is None:
+        pragmas = get_pragma_profile()
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name}={value}")
+
+
+def get_pragma_report(conn=None):
+    """Read back the PRAGMA values actually in effect on a connection"""
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    report = {'profile': DB_PRAGMA_PROFILE}
+    for name in get_pragma_profile():
+        report[name] = conn.execute(f"PRAGMA {name}").fetchone()[0]
+    if own_conn:
+        conn.close()
+    return report
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3 connection handed out by ConnectionPool
+    close() returns the connection to its pool instead of closing it, so the
+    existing `conn.close()` calls throughout the code base keep working.
+    """
+
+    pool = None
+    scoped = False  # True while owned by a Flask request (released on teardown)
+    in_unit = False  # True while a UnitOfWork holds a transaction on it
+
+    def close(self):
+        """
+        Release connection back to the pool
+        While request-scoped the connection stays checked out, but a
+        transaction left open by a write that failed before its commit is
+        rolled back, so it neither holds the write lock nor leaks into the
+        request's later queries. A UnitOfWork's transaction is left alone.
+        """
+        if self.scoped:
+            if self.in_transaction and not self.in_unit:
+                self.rollback()
+            return
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            self.dispose()
+
+    def dispose(self):
+        """Really close the underlying sqlite3 connection"""
+        sqlite3.Connection.close(self)
+
+
+class ConnectionPool:
+    """Bounded pool of sqlite3 connections shared across threads"""
+
+    def __init__(self, database, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                 health_check=DB_POOL_HEALTH_CHECK):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.health_check = health_check
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, factory=PooledConnection,
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        apply_pragmas(conn)
+        conn.pool = self
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        """Check out a connection, waiting up to `timeout` seconds for a free slot"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError(
+                f"Connection pool exhausted ({self.size} connections in use)")
+
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+
+        try:
+            if conn is not None and self.health_check and not self._is_healthy(conn):
+                conn.dispose()
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding any uncommitted work"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.dispose()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                self._idle.get_nowait().dispose()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Get the process-wide connection pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE_PATH)
+    return _pool
+
+
+def close_pool():
+    """Close all pooled connections (used on shutdown)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
 
 
 def get_db_connection():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """
+    Get database connection
+    Inside a Flask app context the same connection is reused for the whole
+    request and released on teardown; elsewhere a connection is checked out
+    of the pool and returned by conn.close().
+    """
+    if not has_app_context():
+        return get_pool().acquire()
+
+    if 'db_conn' not in g:
+        conn = get_pool().acquire()
+        conn.scoped = True
+        g.db_conn = conn
+    return g.db_conn
+
+
+def close_request_connection(exception=None):
+    """Release the request-scoped connection back to the pool (uncommitted work is rolled back)"""
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.scoped = False
+        conn.close()
+
+
+def init_app(app):
+    """Register connection teardown and the activity log writer with the Flask app"""
+    app.teardown_appcontext(close_request_connection)
+    app.teardown_request(log_identity_map_stats)
+    atexit.register(close_pool)
+
+    if ACTIVITY_LOG_ASYNC:
+        activity_log_writer.start()
+        # Registered after close_pool so it runs first (atexit is LIFO)
+        atexit.register(activity_log_writer.stop)
+
+    api_key_usage.start()
+    atexit.register(api_key_usage.stop)
+
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'database', 'schema.sql')
 
 
 def init_database():
@@ -22,8 +236,7 @@ def init_database():
     cursor = conn.cursor()
 
     # Execute schema
-    schema_path = os.path.join(os.path.dirname(__file__), 'database', 'schema.sql')
-    with open(schema_path, 'r') as f:
+    with open(SCHEMA_PATH, 'r') as f:
         cursor.executescript(f.read())
 
     # Check if data already exists
@@ -39,6 +252,124 @@ def init_database():
     print(f"Database initialized at {DATABASE_PATH}")
 
 
+def table_exists(conn, name):
+    """Check whether a table exists in the database"""
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()
+    return row is not None
+
+
+def migrate_schema():
+    """
+    Bring an existing database up to the current schema.sql
+    Every statement in the schema is IF NOT EXISTS, so this is safe to rerun.
+    Derived tables that did not exist before are backfilled afterwards.
+    """
+    # Columns added to existing tables since the first release
+    added_columns = {
+        ('invoices', 'items_version'): 'INTEGER NOT NULL DEFAULT 0',
+        ('companies', 'updated_at'): 'TIMESTAMP',  # ADD COLUMN can't default to CURRENT_TIMESTAMP
+        ('pdf_jobs', 'leased_at'): 'TIMESTAMP',
+    }
+
+    # Derived tables and the function that backfills them
+    derived = {
+        'invoice_stats': rebuild_dashboard_rollups,
+        'invoices_fts': rebuild_search_index,
+    }
+
+    conn = get_db_connection()
+    missing = [name for name in derived if not table_exists(conn, name)]
+
+    for (table, column), definition in added_columns.items():
+        if table_exists(conn, table):
+            columns = [row['name'] for row in conn.execute(f"PRAGMA table_info({table})")]
+            if column not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    with open(SCHEMA_PATH, 'r') as f:
+        conn.executescript(f.read())
+    conn.close()
+
+    for name in missing:
+        derived[name]()
+
+
+# Request-scoped identity map
+IDENTITY_MAP_TABLES = ('users', 'invoices', 'companies')
+
+
+def _identity_map():
+    """This request's {table: {id: row}} map, or None outside a request"""
+    if not IDENTITY_MAP_ENABLED or not has_request_context():
+        return None
+    if 'identity_map' not in g:
+        g.identity_map = {table: {} for table in IDENTITY_MAP_TABLES}
+        g.identity_map_stats = {table: [0, 0] for table in IDENTITY_MAP_TABLES}
+    return g.identity_map
+
+
+def _get_row_by_id(table, row_id):
+    """
+    SELECT * FROM `table` by primary key, through the identity map
+    Within one request each id is read at most once until a write in the
+    same request discards it. Callers get a copy, so mutating the result
+    never leaks into later lookups. Missing rows are not remembered.
+    """
+    rows = _identity_map()
+    try:
+        key = int(row_id)
+    except (TypeError, ValueError):
+        key = None
+
+    if rows is not None and key is not None:
+        row = rows[table].get(key)
+        if row is not None:
+            g.identity_map_stats[table][0] += 1
+            return dict(row)
+        g.identity_map_stats[table][1] += 1
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT * FROM {table} WHERE id=?", (row_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if row is None:
+        return None
+
+    row = dict(row)
+    if rows is not None and key is not None:
+        rows[table][key] = row
+    return dict(row)
+
+
+def identity_map_discard(table, row_id=None):
+    """Write-through invalidation: forget one row (or a whole table, or everything)"""
+    rows = _identity_map()
+    if rows is None:
+        return
+    if table is None:
+        for table_rows in rows.values():
+            table_rows.clear()
+    elif row_id is None:
+        rows[table].clear()
+    else:
+        try:
+            rows[table].pop(int(row_id), None)
+        except (TypeError, ValueError):
+            pass
+
+
+def log_identity_map_stats(exception=None):
+    """Log this request's identity map hits/misses at debug level (teardown handler)"""
+    stats = g.pop('identity_map_stats', None)
+    g.pop('identity_map', None)
+    if not IDENTITY_MAP_LOG or not stats or not any(hits or misses for hits, misses in stats.values()):
+        return
+    counts = ', '.join(f"{table} {hits}/{hits + misses}"
+                       for table, (hits, misses) in stats.items() if hits or misses)
+    current_app.logger.debug("Identity map %s %s: %s hits", request.method, request.path, counts)
+
+
 # Vulnerability #1 & #8: SQL Injection in authentication
 def authenticate_user(username, password):
     """
@@ -82,13 +413,8 @@ def authenticate_user(username, password):
 
 
 def get_user_by_id(user_id):
-    """Get user by ID"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE id=?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return dict(user) if user else None
+    """Get user by ID (through the request's identity map)"""
+    return _get_row_by_id('users', user_id)
 
 
 def get_user_by_username(username):
@@ -119,6 +445,7 @@ def create_user(username, email, password, full_name, role='user'):
         user_id = cursor.lastrowid
         conn.commit()
         conn.close()
+        stats_cache.invalidate()
         return user_id
     except sqlite3.IntegrityError:
         conn.close()
@@ -148,6 +475,7 @@ def update_user(user_id, **kwargs):
     cursor.execute(query, values)
     conn.commit()
     conn.close()
+    identity_map_discard('users', user_id)
     return True
 
 
@@ -158,6 +486,7 @@ def update_last_login(user_id):
     cursor.execute("UPDATE users SET last_login=? WHERE id=?", (datetime.now(), user_id))
     conn.commit()
     conn.close()
+    identity_map_discard('users', user_id)
 
 
 # Invoice operations
@@ -177,20 +506,67 @@ def create_invoice(user_id, company_id, invoice_number, invoice_date, due_date,
     invoice_id = cursor.lastrowid
     conn.commit()
     conn.close()
+    stats_cache.invalidate()
     return invoice_id
 
 
 def get_invoice(invoice_id):
     """
-    Get invoice by ID
+    Get invoice by ID (through the request's identity map)
     Used in IDOR vulnerability - no authorization check here
     """
+    return _get_row_by_id('invoices', invoice_id)
+
+
+# HTTP validators
+def _etag(*parts):
+    """Hash version parts into an ETag value (unquoted)"""
+    return hashlib.sha1(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+
+def get_invoice_etag(invoice_id, *variant):
+    """
+    ETag for an invoice and its line items, or None if it does not exist
+    Two primary key lookups: updated_at changes on every header write,
+    items_version on every line item write, and the company's id/updated_at
+    on any edit or removal of the company the invoice shows.
+    `variant` distinguishes representations (JSON, HTML per viewer).
+    """
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM invoices WHERE id=?", (invoice_id,))
-    invoice = cursor.fetchone()
+    row = conn.execute("""
+        SELECT i.updated_at, i.items_version, c.id AS company_id, c.updated_at AS company_updated_at
+        FROM invoices i
+        LEFT JOIN companies c ON c.id = i.company_id
+        WHERE i.id=?
+    """, (invoice_id,)).fetchone()
     conn.close()
-    return dict(invoice) if invoice else None
+    if not row:
+        return None
+    return _etag('invoice', invoice_id, row['updated_at'], row['items_version'],
+                 row['company_id'], row['company_updated_at'], *variant)
+
+
+def get_invoices_collection_etag(user_id=None, *variant):
+    """
+    Collection-level ETag for a user's invoices (or all invoices)
+    Built from the row count (invoice_stats rollup), the highest id and the
+    latest updated_at, all of which come from indexes. The lists show
+    company names, so the companies' count and latest updated_at are
+    included too (any company edit revalidates every list).
+    `variant` distinguishes representations (page cursor, limit, format).
+    """
+    # Separate scalar subqueries so each MAX() is a single index seek
+    where, params = ("", ()) if user_id is None else ("WHERE user_id=?", (user_id,))
+    conn = get_db_connection()
+    row = conn.execute(f"""
+        SELECT (SELECT TOTAL(invoice_count) FROM invoice_stats {where}),
+               (SELECT MAX(id) FROM invoices {where}),
+               (SELECT MAX(updated_at) FROM invoices {where}),
+               (SELECT COUNT(*) FROM companies),
+               (SELECT MAX(updated_at) FROM companies)
+    """, params * 3).fetchone()
+    conn.close()
+    return _etag('invoices', user_id, *row, *variant)
 
 
 def get_invoices_by_user(user_id):
@@ -209,6 +585,66 @@ def get_invoices_by_user(user_id):
     return [dict(inv) for inv in invoices]
 
 
+# Keyset pagination
+def encode_cursor(row):
+    """Encode the (created_at, id) position of a row as an opaque cursor"""
+    raw = json.dumps([row['created_at'], row['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor into (created_at, id), raises ValueError if malformed"""
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if not isinstance(row_id, int):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return created_at, row_id
+
+
+def _fetch_page(query, params, cursor, limit, alias='i'):
+    """
+    Run a query one page at a time, newest first by (created_at, id)
+    `query` must leave room for an extra AND condition on `alias`.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    if cursor:
+        query += f" AND ({alias}.created_at, {alias}.id) < (?, ?)"
+        params = tuple(params) + decode_cursor(cursor)
+    query += f" ORDER BY {alias}.created_at DESC, {alias}.id DESC LIMIT ?"
+    params = tuple(params) + (limit + 1,)
+
+    conn = get_db_connection()
+    rows = conn.execute(query, params).fetchmany(limit + 1)
+    conn.close()
+
+    page = [dict(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(page[-1]) if len(rows) > limit else None
+    return page, next_cursor
+
+
+def get_invoices_by_user_page(user_id, cursor=None, limit=INVOICE_PAGE_SIZE):
+    """Get one page of a user's invoices, returns (invoices, next_cursor)"""
+    return _fetch_page("""
+        SELECT i.*, c.company_name
+        FROM invoices i
+        LEFT JOIN companies c ON i.company_id = c.id
+        WHERE i.user_id=?
+    """, (user_id,), cursor, limit)
+
+
+def get_all_invoices_page(cursor=None, limit=INVOICE_PAGE_SIZE):
+    """Get one page of all invoices (admin function), returns (invoices, next_cursor)"""
+    return _fetch_page("""
+        SELECT i.*, u.username, c.company_name
+        FROM invoices i
+        LEFT JOIN users u ON i.user_id = u.id
+        LEFT JOIN companies c ON i.company_id = c.id
+        WHERE 1=1
+    """, (), cursor, limit)
+
+
 def search_invoices(user_id, search_term):
     """
     Search invoices - VULNERABLE to SQL injection
@@ -235,6 +671,66 @@ def search_invoices(user_id, search_term):
     return [dict(inv) for inv in invoices]
 
 
+# Full-text search (FTS5 index in invoices_fts, see schema.sql)
+def build_fts_query(search_term):
+    """
+    Turn free text into an FTS5 MATCH expression
+    Every word becomes a quoted prefix term, so "acme inv-20" matches
+    documents containing words starting with acme, inv and 20.
+    """
+    words = re.findall(r'\w+', search_term or '')
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_invoices_fts(user_id, search_term, limit=50):
+    """
+    Ranked prefix search over invoice number, notes, terms, company name
+    and item descriptions. Pass user_id=None to search every user's invoices.
+    """
+    match = build_fts_query(search_term)
+    if not match:
+        return []
+
+    query = """
+        SELECT i.*, c.company_name, bm25(invoices_fts) AS rank
+        FROM invoices_fts
+        JOIN invoices i ON i.id = invoices_fts.rowid
+        LEFT JOIN companies c ON i.company_id = c.id
+        WHERE invoices_fts MATCH ?
+    """
+    params = [match]
+    if user_id is not None:
+        query += " AND invoices_fts.user_id = ?"
+        params.append(user_id)
+    query += " ORDER BY rank LIMIT ?"
+    params.append(limit)
+
+    conn = get_db_connection()
+    invoices = conn.execute(query, params).fetchall()
+    conn.close()
+    return [dict(inv) for inv in invoices]
+
+
+def rebuild_search_index():
+    """Repopulate invoices_fts from scratch (backfill for existing databases)"""
+    conn = get_db_connection()
+    with conn:
+        conn.execute("DELETE FROM invoices_fts")
+        conn.execute("""
+            INSERT INTO invoices_fts (rowid, invoice_number, notes, terms, company_name,
+                                      item_descriptions, user_id)
+            SELECT i.id, i.invoice_number, i.notes, i.terms, c.company_name,
+                   (SELECT group_concat(description, ' ') FROM invoice_items WHERE invoice_id = i.id),
+                   i.user_id
+            FROM invoices i
+            LEFT JOIN companies c ON i.company_id = c.id
+        """)
+        conn.execute("INSERT INTO invoices_fts (invoices_fts) VALUES ('optimize')")
+    count = conn.execute("SELECT COUNT(*) FROM invoices_fts").fetchone()[0]
+    conn.close()
+    return count
+
+
 def update_invoice(invoice_id, **kwargs):
     """Update invoice"""
     conn = get_db_connection()
@@ -246,14 +742,16 @@ def update_invoice(invoice_id, **kwargs):
         fields.append(f"{key}=?")
         values.append(value)
 
-    values.append(datetime.now())
-    fields.append("updated_at=?")
+    # Millisecond UTC timestamp, the same format the trg_invoices_touch trigger writes
+    fields.append("updated_at=strftime('%Y-%m-%d %H:%M:%f', 'now')")
     values.append(invoice_id)
 
     query = f"UPDATE invoices SET {', '.join(fields)} WHERE id=?"
     cursor.execute(query, values)
     conn.commit()
     conn.close()
+    stats_cache.invalidate()
+    identity_map_discard('invoices', invoice_id)
 
 
 def delete_invoice(invoice_id):
@@ -262,10 +760,396 @@ def delete_invoice(invoice_id):
     cursor = conn.cursor()
 
     cursor.execute("DELETE FROM invoice_items WHERE invoice_id=?", (invoice_id,))
+    cursor.execute("DELETE FROM attachments WHERE invoice_id=?", (invoice_id,))
     cursor.execute("DELETE FROM invoices WHERE id=?", (invoice_id,))
 
     conn.commit()
     conn.close()
+    stats_cache.invalidate()
+    identity_map_discard('invoices', invoice_id)
+
+
+# Invoice number allocation
+def _max_invoice_number(conn, year):
+    """Highest numeric suffix of the INV-YYYY-NNN numbers stored for `year`"""
+    prefix = INVOICE_NUMBER_FORMAT.format(year=year, value=0).rsplit('-', 1)[0] + '-'
+    return conn.execute("""
+        SELECT IFNULL(MAX(CAST(substr(invoice_number, ?) AS INTEGER)), 0)
+        FROM invoices
+        WHERE invoice_number >= ? AND invoice_number < ?
+    """, (len(prefix) + 1, prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))).fetchone()[0]
+
+
+def _numbers_taken(conn, numbers, chunk=500):
+    """Whether any of `numbers` is already used by an invoice"""
+    for start in range(0, len(numbers), chunk):
+        part = numbers[start:start + chunk]
+        placeholders = ', '.join('?' * len(part))
+        if conn.execute(f"SELECT 1 FROM invoices WHERE invoice_number IN ({placeholders}) LIMIT 1",
+                        part).fetchone():
+            return True
+    return False
+
+
+def _allocate_invoice_numbers(conn, count, year):
+    """
+    Advance the sequence for `year` by `count` on an open write transaction
+    The first allocation of a year starts after the highest INV-YYYY-NNN
+    number already in the invoices table. Numbers stored explicitly since
+    then (imports, bulk rows with their own number) can overtake the
+    sequence; if an allocated block collides, the sequence jumps past the
+    highest stored number and the block is allocated again.
+    """
+    while True:
+        row = conn.execute("""
+            UPDATE invoice_sequences SET last_value = last_value + ?
+            WHERE year = ?
+            RETURNING last_value
+        """, (count, year)).fetchone()
+
+        if row is None:
+            row = conn.execute("""
+                INSERT INTO invoice_sequences (year, last_value) VALUES (?, ?)
+                RETURNING last_value
+            """, (year, _max_invoice_number(conn, year) + count)).fetchone()
+
+        last = row[0]
+        numbers = [INVOICE_NUMBER_FORMAT.format(year=year, value=value)
+                   for value in range(last - count + 1, last + 1)]
+        if not _numbers_taken(conn, numbers):
+            return numbers
+
+        conn.execute("UPDATE invoice_sequences SET last_value = MAX(last_value, ?) WHERE year = ?",
+                     (_max_invoice_number(conn, year), year))
+
+
+def allocate_invoice_numbers(count=1, year=None):
+    """
+    Reserve `count` consecutive invoice numbers for `year` (default: current year)
+    Safe under concurrency: the sequence row is advanced atomically.
+    """
+    with UnitOfWork() as uow:
+        return uow.allocate_invoice_numbers(count, year)
+
+
+class UnitOfWork:
+    """
+    Group several writes into a single transaction
+    Usage:
+        with db.UnitOfWork() as uow:
+            invoice_id = uow.add_invoice(...)
+            uow.add_items(invoice_id, items)
+            uow.log_activity(...)
+    Everything commits together on exit, or rolls back if the block raises.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.invoices_written = False
+        self.touched_invoices = set()  # Ids whose invoice row changed (directly or via item triggers)
+
+    def __enter__(self):
+        self.conn = get_db_connection()
+        if self.conn.in_unit:
+            raise RuntimeError("UnitOfWork is already active on this connection")
+        if self.conn.in_transaction:
+            # Leftovers of a write that failed before its commit: never ours to keep
+            self.conn.rollback()
+        # Take the write lock up front so we never fail upgrading a read lock
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.in_unit = True
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+                if self.invoices_written:
+                    stats_cache.invalidate()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.in_unit = False
+            self.conn.close()
+            self.conn = None
+            for invoice_id in self.touched_invoices:
+                identity_map_discard('invoices', invoice_id)
+        return False
+
+    def allocate_invoice_numbers(self, count=1, year=None):
+        """Reserve invoice numbers as part of this transaction"""
+        return _allocate_invoice_numbers(self.conn, count, year or datetime.now().year)
+
+    def add_invoice(self, user_id, company_id, invoice_number, invoice_date, due_date,
+                    status, subtotal, tax_rate, tax_amount, discount, total, notes, terms):
+        """Insert invoice header, returns the new invoice id"""
+        cursor = self.conn.execute("""
+            INSERT INTO invoices (user_id, company_id, invoice_number, invoice_date, due_date,
+                                 status, subtotal, tax_rate, tax_amount, discount, total, notes, terms)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, company_id, invoice_number, invoice_date, due_date,
+              status, subtotal, tax_rate, tax_amount, discount, total, notes, terms))
+        self.invoices_written = True
+        return cursor.lastrowid
+
+    def add_items(self, invoice_id, items):
+        """
+        Bulk insert line items
+        items: iterable of (description, quantity, unit_price, amount, sort_order)
+        """
+        # The item triggers bump the invoice's items_version and updated_at
+        self.touched_invoices.add(invoice_id)
+        self.conn.executemany("""
+            INSERT INTO invoice_items (invoice_id, description, quantity, unit_price, amount, sort_order)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, ((invoice_id,) + tuple(item) for item in items))
+
+    def log_activity(self, user_id, action, resource_type=None, resource_id=None,
+                     ip_address=None, details=None):
+        """Write an activity log row as part of this transaction"""
+        self.conn.execute("""
+            INSERT INTO activity_log (user_id, action, resource_type, resource_id, ip_address, details)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, action, resource_type, resource_id, ip_address, details))
+
+
+def create_invoice_with_items(user_id, company_id, invoice_number, invoice_date, due_date,
+                              status, subtotal, tax_rate, tax_amount, discount, total,
+                              notes, terms, items=(), ip_address=None, log_details=None):
+    """
+    Create invoice, its line items and the activity log row in one transaction
+    items: iterable of (description, quantity, unit_price, amount, sort_order)
+    The activity row is only written when log_details is given.
+    """
+    with UnitOfWork() as uow:
+        invoice_id = uow.add_invoice(user_id, company_id, invoice_number, invoice_date,
+                                     due_date, status, subtotal, tax_rate, tax_amount,
+                                     discount, total, notes, terms)
+        uow.add_items(invoice_id, items)
+        if log_details is not None:
+            uow.log_activity(user_id, 'create', 'invoice', invoice_id, ip_address, log_details)
+    return invoice_id
+
+
+INVOICE_ITEM_FIELDS = ('description', 'quantity', 'unit_price', 'amount', 'sort_order')
+
+
+# Columns compared by value ('1' == 1, '2.50' == 2.5); everything else is text
+NUMERIC_COLUMNS = frozenset({
+    'user_id', 'company_id', 'subtotal', 'tax_rate', 'tax_amount', 'discount', 'total',
+    'quantity', 'unit_price', 'amount', 'sort_order',
+})
+
+
+def _values_equal(column, old, new):
+    """
+    Compare a stored column value with a submitted one
+    Numeric columns compare as numbers, since forms post strings; text
+    columns compare as exact strings, so '1' -> '1.0' is still an edit.
+    """
+    if old == new:
+        return True
+    if old is None or new is None:
+        return False
+    if column in NUMERIC_COLUMNS:
+        try:
+            return float(old) == float(new)
+        except (TypeError, ValueError):
+            pass
+    return str(old) == str(new)
+
+
+def diff_invoice_items(stored_items, items):
+    """
+    Work out the writes needed to turn stored_items into items
+    items: iterable of (item_id, description, quantity, unit_price, amount, sort_order);
+    item_id may be None for new rows. Rows without an id are matched to an
+    unclaimed stored row at the same sort_order, so forms that don't post
+    ids still produce updates instead of delete + insert.
+    Returns (inserts, updates, delete_ids) ready for executemany.
+    """
+    remaining = {item['id']: item for item in stored_items}
+    inserts, updates, pending = [], [], []
+
+    for item_id, *values in items:
+        try:
+            stored = remaining.pop(int(item_id)) if item_id not in (None, '') else None
+        except (KeyError, ValueError):
+            stored = None
+        if stored is None:
+            pending.append(values)
+            continue
+        if not all(_values_equal(f, stored[f], v) for f, v in zip(INVOICE_ITEM_FIELDS, values)):
+            updates.append(tuple(values) + (stored['id'],))
+
+    by_position = {item['sort_order']: item for item in remaining.values()}
+    for values in pending:
+        stored = by_position.pop(values[-1], None)
+        if stored is None:
+            inserts.append(tuple(values))
+            continue
+        del remaining[stored['id']]
+        if not all(_values_equal(f, stored[f], v) for f, v in zip(INVOICE_ITEM_FIELDS, values)):
+            updates.append(tuple(values) + (stored['id'],))
+
+    return inserts, updates, list(remaining)
+
+
+def update_invoice_with_items(invoice_id, fields, items, user_id=None, ip_address=None,
+                              log_details=None):
+    """
+    Apply an invoice edit as a minimal set of writes in one transaction
+    The header UPDATE is skipped when no field in `fields` changed, and
+    line items are inserted/updated/deleted individually (see diff_invoice_items)
+    instead of being deleted and re-created.
+    Returns a summary dict of what was written, or None if the invoice is gone.
+    """
+    with UnitOfWork() as uow:
+        conn = uow.conn
+        stored = conn.execute("SELECT * FROM invoices WHERE id=?", (invoice_id,)).fetchone()
+        if stored is None:
+            return None
+        uow.touched_invoices.add(invoice_id)
+
+        changed = {key: value for key, value in fields.items()
+                   if not _values_equal(key, stored[key], value)}
+        if changed:
+            assignments = ', '.join(f"{key}=?" for key in changed)
+            conn.execute(f"""
+                UPDATE invoices
+                SET {assignments}, updated_at=strftime('%Y-%m-%d %H:%M:%f', 'now')
+                WHERE id=?
+            """, list(changed.values()) + [invoice_id])
+            uow.invoices_written = True
+
+        stored_items = conn.execute("SELECT * FROM invoice_items WHERE invoice_id=?",
+                                    (invoice_id,)).fetchall()
+        inserts, updates, delete_ids = diff_invoice_items(stored_items, items)
+
+        if delete_ids:
+            conn.executemany("DELETE FROM invoice_items WHERE id=?", [(i,) for i in delete_ids])
+        if updates:
+            conn.executemany("""
+                UPDATE invoice_items
+                SET description=?, quantity=?, unit_price=?, amount=?, sort_order=?
+                WHERE id=?
+            """, updates)
+        if inserts:
+            uow.add_items(invoice_id, inserts)
+
+        if log_details is not None:
+            uow.log_activity(user_id, 'update', 'invoice', invoice_id, ip_address, log_details)
+
+    return {
+        'header_fields': sorted(changed),
+        'inserted': len(inserts),
+        'updated': len(updates),
+        'deleted': len(delete_ids)
+    }
+
+
+INVOICE_HEADER_DEFAULTS = (
+    ('user_id', None), ('company_id', None), ('invoice_number', None),
+    ('invoice_date', None), ('due_date', None), ('status', 'draft'),
+    ('subtotal', 0), ('tax_rate', 0), ('tax_amount', 0), ('discount', 0),
+    ('total', 0), ('notes', ''), ('terms', ''),
+)
+
+
+def invoice_values_from_dict(data):
+    """Header values in add_invoice() order from an API-style invoice dict"""
+    return tuple(data.get(key, default) for key, default in INVOICE_HEADER_DEFAULTS)
+
+
+def invoice_items_from_dict(data):
+    """Line item tuples for add_items() from an API-style invoice dict"""
+    return [(
+        item.get('description', ''),
+        item.get('quantity', 1),
+        item.get('unit_price', 0),
+        item.get('amount', 0),
+        item.get('sort_order', 0)
+    ) for item in data.get('items', [])]
+
+
+def _bulk_invoice_number(data):
+    """
+    A bulk record's invoice number as a string, or '' if one must be allocated
+    Raises ValueError for a number that is not a scalar (a JSON list or
+    object), so it is reported for that record instead of failing the batch.
+    """
+    number = data.get('invoice_number')
+    if not number:
+        return ''
+    if isinstance(number, bool) or not isinstance(number, (str, int, float)):
+        raise ValueError('invoice_number must be a string')
+    return str(number)
+
+
+def insert_invoice_batch(records):
+    """
+    Insert a batch of API-style invoice dicts in one transaction
+    records: list of (ref, data) pairs; ref is echoed back in the results.
+    Duplicate invoice numbers (already stored, or repeated in the batch) are
+    found with one IN query for the whole batch. Invoices without a number
+    get one from a single block reservation. A failing record is rolled back
+    to its savepoint without affecting the rest of the batch.
+    Returns a list of result dicts in input order.
+    """
+    checked = []
+    for ref, data in records:
+        try:
+            checked.append((ref, data, _bulk_invoice_number(data), None))
+        except ValueError as e:
+            checked.append((ref, data, None, str(e)))
+
+    results = []
+    with UnitOfWork() as uow:
+        conn = uow.conn
+
+        numbers = [number for _, _, number, error in checked if number]
+        existing = set()
+        if numbers:
+            placeholders = ', '.join('?' * len(numbers))
+            existing = {row[0] for row in conn.execute(
+                f"SELECT invoice_number FROM invoices WHERE invoice_number IN ({placeholders})",
+                numbers)}
+
+        # Allocated numbers must not collide with explicit ones later in this batch
+        missing = sum(1 for _, _, number, error in checked if not number and not error)
+        explicit = set(numbers)
+        allocated = []
+        while len(allocated) < missing:
+            block = uow.allocate_invoice_numbers(missing - len(allocated))
+            allocated.extend(number for number in block if number not in explicit)
+        allocated = iter(allocated)
+
+        for ref, data, number, error in checked:
+            if error:
+                results.append({'ref': ref, 'status': 'error', 'error': error})
+                continue
+            number = number or next(allocated)
+            if number in existing:
+                results.append({'ref': ref, 'status': 'duplicate', 'invoice_number': number})
+                continue
+            existing.add(number)
+
+            conn.execute("SAVEPOINT bulk_record")
+            try:
+                values = invoice_values_from_dict(dict(data, invoice_number=number))
+                invoice_id = uow.add_invoice(*values)
+                uow.add_items(invoice_id, invoice_items_from_dict(data))
+            except (sqlite3.Error, AttributeError, TypeError, ValueError) as e:
+                conn.execute("ROLLBACK TO bulk_record")
+                conn.execute("RELEASE bulk_record")
+                results.append({'ref': ref, 'status': 'error', 'invoice_number': number,
+                                'error': str(e)})
+                continue
+            conn.execute("RELEASE bulk_record")
+            results.append({'ref': ref, 'status': 'created', 'invoice_id': invoice_id,
+                            'invoice_number': number})
+
+    return results
 
 
 # Invoice items operations
@@ -282,6 +1166,7 @@ def add_invoice_item(invoice_id, description, quantity, unit_price, amount, sort
     item_id = cursor.lastrowid
     conn.commit()
     conn.close()
+    identity_map_discard('invoices', invoice_id)
     return item_id
 
 
@@ -302,6 +1187,7 @@ def delete_invoice_items(invoice_id):
     cursor.execute("DELETE FROM invoice_items WHERE invoice_id=?", (invoice_id,))
     conn.commit()
     conn.close()
+    identity_map_discard('invoices', invoice_id)
 
 
 # Company operations
@@ -335,13 +1221,157 @@ def get_companies_by_user(user_id):
 
 
 def get_company(company_id):
-    """Get company by ID"""
+    """Get company by ID (through the request's identity map)"""
+    return _get_row_by_id('companies', company_id)
+
+
+# API keys
+class ApiKeyCache:
+    """
+    LRU cache of validated API keys
+    Entries expire after `ttl` seconds and at most `max_entries` keys are
+    kept. Revoking a key in this process invalidates it at once; the TTL
+    bounds how long a key revoked elsewhere keeps working here. Unknown
+    keys are not cached, so junk keys cannot push valid ones out.
+    """
+
+    def __init__(self, max_entries=API_KEY_CACHE_SIZE, ttl=API_KEY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # api_key -> (expires, record)
+        self._generation = 0
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get(self, api_key, load):
+        """Cached record for api_key, calling load() on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(api_key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(api_key)
+                self._stats['hits'] += 1
+                return entry[1]
+            self._entries.pop(api_key, None)
+            self._stats['misses'] += 1
+            generation = self._generation
+
+        record = load()
+
+        with self._lock:
+            # Don't store a record loaded before a revoke landed
+            if record is not None and generation == self._generation:
+                self._entries[api_key] = (now + self.ttl, record)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return record
+
+    def invalidate(self, api_key=None):
+        """Drop one key, or every key"""
+        with self._lock:
+            if api_key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(api_key, None)
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), max_entries=self.max_entries)
+
+
+api_key_cache = ApiKeyCache()
+
+
+class ApiKeyUsageTracker:
+    """
+    Batches api_keys.last_used updates
+    record() only notes the time in memory; a background thread writes
+    everything noted since the last flush in one transaction every
+    `flush_interval` seconds. Without the thread, record() writes directly.
+    """
+
+    def __init__(self, flush_interval=API_KEY_LAST_USED_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}  # key id -> last used (UTC)
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the background flush thread"""
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='api-key-usage', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Write what is pending and stop the thread"""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def record(self, key_id):
+        with self._lock:
+            self._pending[key_id] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        if self._thread is None:
+            self.flush()
+
+    def flush(self):
+        """Write pending last_used times, returns the number of keys updated"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            conn = get_db_connection()
+            try:
+                with conn:
+                    conn.executemany("UPDATE api_keys SET last_used=? WHERE id=?",
+                                     [(used, key_id) for key_id, used in pending.items()])
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"API key last_used flush failed ({len(pending)} keys): {str(e)}")
+            return 0
+        return len(pending)
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+
+api_key_usage = ApiKeyUsageTracker()
+
+
+def _load_api_key(api_key):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM companies WHERE id=?", (company_id,))
-    company = cursor.fetchone()
+    cursor.execute("SELECT * FROM api_keys WHERE api_key=? AND is_active=1", (api_key,))
+    key_record = cursor.fetchone()
+    conn.close()
+    return dict(key_record) if key_record else None
+
+
+def get_active_api_key(api_key):
+    """Active api_keys row for a key (cached), or None"""
+    return api_key_cache.get(api_key, lambda: _load_api_key(api_key))
+
+
+def revoke_api_key(key_id):
+    """Deactivate an API key and drop it from the cache, False if no such key"""
+    conn = get_db_connection()
+    row = conn.execute("UPDATE api_keys SET is_active=0 WHERE id=? RETURNING api_key",
+                       (key_id,)).fetchone()
+    conn.commit()
     conn.close()
-    return dict(company) if company else None
+    if row is None:
+        return False
+    api_key_cache.invalidate(row['api_key'])
+    return True
 
 
 # Session operations (Vulnerability #9: Weak session management)
@@ -382,20 +1412,486 @@ def delete_session(session_id):
 
 
 # Activity logging
+ACTIVITY_LOG_COLUMNS = ('user_id', 'action', 'resource_type', 'resource_id',
+                        'ip_address', 'details', 'created_at')
+
+
+class ActivityLogWriter:
+    """
+    Write-behind queue for activity_log rows
+    Rows are queued by log_activity() and written by a background thread
+    in multi-row INSERTs, once `batch_size` rows are waiting or
+    `flush_interval` seconds after the first row of a batch arrived.
+    """
+
+    _STOP = object()
+
+    def __init__(self, max_queue=ACTIVITY_LOG_QUEUE_SIZE, batch_size=ACTIVITY_LOG_BATCH_SIZE,
+                 flush_interval=ACTIVITY_LOG_FLUSH_INTERVAL, policy=ACTIVITY_LOG_FULL_POLICY,
+                 block_timeout=ACTIVITY_LOG_BLOCK_TIMEOUT):
+        if policy not in ('block', 'drop'):
+            raise ValueError(f"Unknown activity log queue policy: {policy}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'written': 0, 'dropped': 0, 'failed': 0,
+                       'batches': 0, 'last_flush_ms': 0.0, 'max_flush_ms': 0.0}
+
+    def start(self):
+        """Start the background writer thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='activity-log-writer', daemon=True)
+            self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def submit(self, row):
+        """Queue one row (tuple in ACTIVITY_LOG_COLUMNS order), False if it was dropped"""
+        try:
+            if self.policy == 'block':
+                self._queue.put(row, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(row)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('enqueued')
+        return True
+
+    def flush(self):
+        """Block until every queued row has been written"""
+        self._queue.join()
+
+    def stop(self):
+        """Write everything still queued and stop the thread"""
+        if self._thread is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._thread = None
+
+    def stats(self):
+        """Counters for monitoring: queue depth, rows written/dropped, flush latency"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def _next_batch(self):
+        """Collect rows until the batch is full or the flush interval expires"""
+        batch = []
+        try:
+            row = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return batch, False
+
+        deadline = time.monotonic() + self.flush_interval
+        while row is not self._STOP:
+            batch.append(row)
+            remaining = deadline - time.monotonic()
+            if len(batch) >= self.batch_size or remaining <= 0:
+                return batch, False
+            try:
+                row = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _run(self):
+        while True:
+            batch, stopping = self._next_batch()
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception as e:
+                # Never let the thread die: flush()/join() would wait forever
+                print(f"Activity log writer error ({len(batch)} rows): {str(e)}")
+                self._count('failed', len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stopping:
+                self._queue.task_done()
+                return
+
+    def _insert(self, rows):
+        placeholders = ', '.join(['(?, ?, ?, ?, ?, ?, ?)'] * len(rows))
+        params = [value for row in rows for value in row]
+        conn = get_db_connection()
+        try:
+            with conn:
+                conn.execute(f"""
+                    INSERT INTO activity_log ({', '.join(ACTIVITY_LOG_COLUMNS)})
+                    VALUES {placeholders}
+                """, params)
+        finally:
+            conn.close()
+
+    def _write(self, batch):
+        """Insert a batch; if it fails, retry row by row so one bad row loses only itself"""
+        start = time.perf_counter()
+        written = len(batch)
+        try:
+            self._insert(batch)
+        except Exception as e:
+            print(f"Activity log batch write failed ({len(batch)} rows), retrying per row: {str(e)}")
+            written = 0
+            for row in batch:
+                try:
+                    self._insert([row])
+                    written += 1
+                except Exception as row_error:
+                    print(f"Activity log row dropped: {str(row_error)}")
+                    self._count('failed')
+
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._stats_lock:
+            self._stats['written'] += written
+            self._stats['batches'] += 1
+            self._stats['last_flush_ms'] = elapsed
+            self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed)
+
+
+activity_log_writer = ActivityLogWriter()
+
+
 def log_activity(user_id, action, resource_type=None, resource_id=None, ip_address=None, details=None):
-    """Log user activity"""
+    """Log user activity (queued for the background writer when it is running)"""
+    # Timestamp now, not when the row reaches the database (same format as CURRENT_TIMESTAMP)
+    created_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    row = (user_id, action, resource_type, resource_id, ip_address, details, created_at)
+
+    if activity_log_writer.running:
+        activity_log_writer.submit(row)
+        return
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(f"""
+        INSERT INTO activity_log ({', '.join(ACTIVITY_LOG_COLUMNS)})
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, row)
+
+    conn.commit()
+    conn.close()
+
+
+def get_activity_logs_page(cursor=None, limit=ACTIVITY_LOG_PAGE_SIZE, user_id=None,
+                           action=None, since=None, until=None):
+    """
+    Get one page of activity logs, newest first, returns (logs, next_cursor)
+    since/until are inclusive YYYY-MM-DD dates.
+    """
+    query = """
+        SELECT al.*, u.username
+        FROM activity_log al
+        LEFT JOIN users u ON al.user_id = u.id
+        WHERE 1=1
+    """
+    params = []
+    if user_id is not None:
+        query += " AND al.user_id = ?"
+        params.append(user_id)
+    if action:
+        query += " AND al.action = ?"
+        params.append(action)
+    if since:
+        query += " AND al.created_at >= ?"
+        params.append(since)
+    if until:
+        query += " AND al.created_at < date(?, '+1 day')"
+        params.append(until)
+    return _fetch_page(query, params, cursor, limit, alias='al')
+
+
+def archive_activity_log(retention_days=ACTIVITY_LOG_RETENTION_DAYS,
+                         archive_path=ACTIVITY_LOG_ARCHIVE_PATH):
+    """
+    Move activity_log rows older than `retention_days` into monthly tables
+    (activity_log_YYYY_MM) in the ATTACHed archive database. With no
+    archive_path the old rows are simply deleted.
+    Returns {month: rows_moved}.
+    """
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db_connection()
+    if conn.in_transaction:
+        conn.commit()
+
+    moved = {}
+    try:
+        if archive_path:
+            conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+
+        months = [row[0] for row in conn.execute("""
+            SELECT DISTINCT strftime('%Y-%m', created_at)
+            FROM activity_log
+            WHERE created_at < ?
+        """, (cutoff,))]
+
+        for month in months:
+            if not month or not re.fullmatch(r'\d{4}-\d{2}', month):
+                continue
+            month_start = f"{month}-01 00:00:00"
+            next_month = conn.execute("SELECT datetime(?, '+1 month')", (month_start,)).fetchone()[0]
+            month_end = min(next_month, cutoff)
+            where = "created_at >= ? AND created_at < ?"
+
+            with conn:
+                if archive_path:
+                    table = f"archive.activity_log_{month.replace('-', '_')}"
+                    conn.execute(f"""
+                        CREATE TABLE IF NOT EXISTS {table} (
+                            id INTEGER PRIMARY KEY,
+                            user_id INTEGER,
+                            action TEXT NOT NULL,
+                            resource_type TEXT,
+                            resource_id INTEGER,
+                            ip_address TEXT,
+                            details TEXT,
+                            created_at TIMESTAMP
+                        )
+                    """)
+                    conn.execute(f"""
+                        INSERT OR IGNORE INTO {table}
+                        SELECT id, user_id, action, resource_type, resource_id,
+                               ip_address, details, created_at
+                        FROM activity_log WHERE {where}
+                    """, (month_start, month_end))
+                cursor = conn.execute(f"DELETE FROM activity_log WHERE {where}",
+                                      (month_start, month_end))
+                moved[month] = cursor.rowcount
+    finally:
+        if archive_path:
+            conn.execute("DETACH DATABASE archive")
+        conn.close()
+
+    return moved
+
+
+# Attachments (blobs on disk in attachment_store.AttachmentStore)
+def set_invoice_attachment(invoice_id, sha256, size, filename, content_type=None, user_id=None,
+                           place=None):
+    """
+    Attach a stored blob to an invoice, replacing its previous attachment
+    The blob row is created on first use; the ref_count triggers account for
+    the new reference and the one it replaces. `place`, if given, puts the
+    blob file in the store and runs under the same write lock that
+    release_unreferenced_blob() holds, so GC cannot unlink the file between
+    the dedup check and the new reference. Returns the attachment id.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if place is not None:
+            place()
+        conn.execute("""
+            INSERT INTO attachment_blobs (sha256, size) VALUES (?, ?)
+            ON CONFLICT (sha256) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+        """, (sha256, size))
+        conn.execute("DELETE FROM attachments WHERE invoice_id=?", (invoice_id,))
+        cursor = conn.execute("""
+            INSERT INTO attachments (invoice_id, sha256, filename, content_type, size, uploaded_by)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (invoice_id, sha256, filename, content_type, size, user_id))
+        conn.execute("""
+            UPDATE invoices SET attachment_path=?, updated_at=strftime('%Y-%m-%d %H:%M:%f', 'now')
+            WHERE id=?
+        """, (filename, invoice_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        identity_map_discard('invoices', invoice_id)
+    return cursor.lastrowid
+
+
+def get_invoice_attachment(invoice_id):
+    """Current attachment row for an invoice, or None"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.execute("SELECT * FROM attachments WHERE invoice_id=? ORDER BY id DESC LIMIT 1", (invoice_id,))
+    attachment = cursor.fetchone()
+    conn.close()
+    return dict(attachment) if attachment else None
+
+
+def get_unreferenced_blobs(grace_seconds):
+    """Digests of blob rows nobody has referenced for `grace_seconds`"""
+    conn = get_db_connection()
+    digests = [row[0] for row in conn.execute("""
+        SELECT sha256 FROM attachment_blobs
+        WHERE ref_count <= 0 AND updated_at < datetime('now', ?)
+    """, (f'-{int(grace_seconds)} seconds',))]
+    conn.close()
+    return digests
+
+
+def release_unreferenced_blob(sha256, grace_seconds, remove):
+    """
+    Delete one blob and its row if it is still unreferenced
+    Under BEGIN IMMEDIATE the row is re-read: it must be missing, or have
+    ref_count 0 and be older than `grace_seconds`. Only then is remove()
+    called to unlink the file (it returns the bytes freed, or None to keep
+    the file), and the row is deleted. Uploads place their files under the
+    same lock (set_invoice_attachment), so a concurrent dedup either sees
+    the blob gone and writes it again, or keeps it referenced.
+    Returns what remove() returned, or None if the blob was kept.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        blob = conn.execute("""
+            SELECT ref_count <= 0 AND updated_at < datetime('now', ?) AS releasable
+            FROM attachment_blobs WHERE sha256=?
+        """, (f'-{int(grace_seconds)} seconds', sha256)).fetchone()
+        freed = None
+        if blob is None or blob['releasable']:
+            freed = remove()
+        if freed is not None and blob is not None:
+            conn.execute("DELETE FROM attachment_blobs WHERE sha256=?", (sha256,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return freed
+
+
+def get_blob_digests():
+    """Set of every sha256 with a blob row"""
+    conn = get_db_connection()
+    digests = {row[0] for row in conn.execute("SELECT sha256 FROM attachment_blobs")}
+    conn.close()
+    return digests
+
 
+# PDF render jobs (queue consumed by pdf_renderer.PdfJobRunner)
+PDF_JOB_COLUMNS = ('id', 'invoice_id', 'user_id', 'status', 'cache_key', 'filename', 'error',
+                   'created_at', 'started_at', 'finished_at')
+
+
+def enqueue_pdf_job(invoice_id, user_id, html, cache_key, filename=None, status='queued'):
+    """Add a render job; status='done' records a job already satisfied from the cache"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
     cursor.execute("""
-        INSERT INTO activity_log (user_id, action, resource_type, resource_id, ip_address, details)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (user_id, action, resource_type, resource_id, ip_address, details))
+        INSERT INTO pdf_jobs (invoice_id, user_id, status, cache_key, html, filename, finished_at)
+        VALUES (?, ?, ?, ?, ?, ?, CASE WHEN ? = 'done' THEN CURRENT_TIMESTAMP END)
+    """, (invoice_id, user_id, status, cache_key, html, filename, status))
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+def get_pdf_job(job_id):
+    """Get a render job (without its HTML)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(PDF_JOB_COLUMNS)} FROM pdf_jobs WHERE id=?", (job_id,))
+    job = cursor.fetchone()
+    conn.close()
+    return dict(job) if job else None
+
+
+def count_pdf_jobs(status='queued'):
+    """Number of jobs in a given state"""
+    conn = get_db_connection()
+    count = conn.execute("SELECT COUNT(*) FROM pdf_jobs WHERE status=?", (status,)).fetchone()[0]
+    conn.close()
+    return count
+
+
+def claim_pdf_jobs(limit, stale_after):
+    """
+    Atomically mark up to `limit` queued jobs as running, oldest first
+    The claiming process holds a lease on each job and renews it while the
+    job waits or renders (renew_pdf_job_leases). Jobs whose lease has not
+    been renewed for `stale_after` seconds (their process died) are claimed
+    again. The single UPDATE ... RETURNING is atomic, so several processes
+    can poll the same queue. Returns dicts with id, cache_key and html.
+    """
+    conn = get_db_connection()
+    jobs = conn.execute("""
+        UPDATE pdf_jobs
+        SET status='running', started_at=CURRENT_TIMESTAMP, leased_at=CURRENT_TIMESTAMP
+        WHERE id IN (
+            SELECT id FROM pdf_jobs WHERE status='queued'
+            UNION ALL
+            SELECT id FROM pdf_jobs
+            WHERE status='running' AND COALESCE(leased_at, started_at) < datetime('now', ?)
+            ORDER BY id LIMIT ?
+        )
+        RETURNING id, cache_key, html
+    """, (f'-{int(stale_after)} seconds', limit)).fetchall()
+    conn.commit()
+    conn.close()
+    return [dict(job) for job in sorted(jobs, key=lambda job: job['id'])]
+
+
+def renew_pdf_job_leases(job_ids):
+    """Extend the lease on jobs this process claimed and has not finished yet"""
+    if not job_ids:
+        return
+    conn = get_db_connection()
+    placeholders = ', '.join('?' * len(job_ids))
+    conn.execute(f"""
+        UPDATE pdf_jobs SET leased_at=CURRENT_TIMESTAMP
+        WHERE status='running' AND id IN ({placeholders})
+    """, list(job_ids))
+    conn.commit()
+    conn.close()
 
+
+def finish_pdf_job(job_id, error=None):
+    """Mark a job done, or failed with an error message"""
+    conn = get_db_connection()
+    conn.execute("""
+        UPDATE pdf_jobs SET status=?, error=?, finished_at=CURRENT_TIMESTAMP
+        WHERE id=? AND status='running'
+    """, ('failed' if error else 'done', error, job_id))
     conn.commit()
     conn.close()
 
 
+def requeue_pdf_job(job_id):
+    """Put a job back in the queue (renderer busy, or its cached PDF was evicted)"""
+    conn = get_db_connection()
+    conn.execute("""
+        UPDATE pdf_jobs SET status='queued', error=NULL, started_at=NULL, finished_at=NULL, leased_at=NULL
+        WHERE id=?
+    """, (job_id,))
+    conn.commit()
+    conn.close()
+
+
+def prune_pdf_jobs(retention_days):
+    """Delete finished jobs older than `retention_days`, returns rows deleted"""
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db_connection()
+    cursor = conn.execute("""
+        DELETE FROM pdf_jobs WHERE status IN ('done', 'failed') AND finished_at < ?
+    """, (cutoff,))
+    deleted = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+
 # Admin functions
 def get_all_users():
     """Get all users (admin function)"""
@@ -407,54 +1903,355 @@ def get_all_users():
     return [dict(user) for user in users]
 
 
+ALL_INVOICES_QUERY = """
+    SELECT i.*, u.username, c.company_name
+    FROM invoices i
+    LEFT JOIN users u ON i.user_id = u.id
+    LEFT JOIN companies c ON i.company_id = c.id
+    ORDER BY i.created_at DESC
+"""
+
+
 def get_all_invoices():
     """Get all invoices (admin function)"""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT i.*, u.username, c.company_name
-        FROM invoices i
-        LEFT JOIN users u ON i.user_id = u.id
-        LEFT JOIN companies c ON i.company_id = c.id
-        ORDER BY i.created_at DESC
-    """)
+    cursor.execute(ALL_INVOICES_QUERY)
     invoices = cursor.fetchall()
     conn.close()
     return [dict(inv) for inv in invoices]
 
 
+def iter_query(query, params=(), batch_size=STREAM_BATCH_SIZE, model=None):
+    """
+    Yield rows of a query as dicts, fetching `batch_size` rows at a time
+    Memory use is bounded by the batch size rather than the result size.
+    The connection is held until the generator is exhausted or closed.
+    With `model` (a __slots__ class from models/) rows are built straight
+    into model objects by the cursor instead of being copied into dicts.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        if model is not None:
+            cursor.row_factory = model_row_factory(model)
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if model is not None:
+                yield from rows
+            else:
+                for row in rows:
+                    yield dict(row)
+    finally:
+        conn.close()
+
+
+def fetch_models(model, query, params=()):
+    """Run a query and return all rows as `model` objects (no dict copies)"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = model_row_factory(model)
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def iter_all_invoices(batch_size=STREAM_BATCH_SIZE):
+    """Stream all invoices (admin function)"""
+    return iter_query(ALL_INVOICES_QUERY, batch_size=batch_size)
+
+
+def iter_all_users(batch_size=STREAM_BATCH_SIZE):
+    """Stream all users (admin function)"""
+    return iter_query("SELECT * FROM users ORDER BY created_at DESC", batch_size=batch_size)
+
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+EXPORT_INVOICE_COLUMNS = ('invoice_id', 'invoice_number', 'user_id', 'invoice_date', 'due_date',
+                          'status', 'subtotal', 'tax_rate', 'tax_amount', 'discount', 'total',
+                          'notes', 'terms', 'created_at', 'updated_at')
+EXPORT_COMPANY_COLUMNS = ('company_id', 'company_name', 'contact_person', 'company_email',
+                          'company_phone', 'company_city', 'company_country')
+EXPORT_ITEM_COLUMNS = ('item_id', 'description', 'quantity', 'unit_price', 'amount', 'sort_order')
+EXPORT_COLUMNS = EXPORT_INVOICE_COLUMNS + EXPORT_COMPANY_COLUMNS + EXPORT_ITEM_COLUMNS
+
+EXPORT_QUERY = """
+    SELECT i.id AS invoice_id, i.invoice_number, i.user_id, i.invoice_date, i.due_date,
+           i.status, i.subtotal, i.tax_rate, i.tax_amount, i.discount, i.total,
+           i.notes, i.terms, i.created_at, i.updated_at,
+           c.id AS company_id, c.company_name, c.contact_person, c.email AS company_email,
+           c.phone AS company_phone, c.city AS company_city, c.country AS company_country,
+           it.id AS item_id, it.description, it.quantity, it.unit_price, it.amount, it.sort_order
+    FROM invoices i
+    LEFT JOIN companies c ON i.company_id = c.id
+    LEFT JOIN invoice_items it ON it.invoice_id = i.id
+    {where}
+    ORDER BY i.invoice_date, i.id, it.sort_order, it.id
+"""
+
+
+def _invoice_filter(date_from=None, date_to=None, statuses=None, user_id=None, company_id=None):
+    """WHERE clause and params for the export/batch filters on invoices `i`"""
+    conditions, params = [], []
+    if date_from:
+        conditions.append("i.invoice_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("i.invoice_date <= ?")
+        params.append(date_to)
+    if statuses:
+        conditions.append(f"i.status IN ({', '.join('?' * len(statuses))})")
+        params.extend(statuses)
+    if user_id is not None:
+        conditions.append("i.user_id = ?")
+        params.append(user_id)
+    if company_id is not None:
+        conditions.append("i.company_id = ?")
+        params.append(company_id)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return where, params
+
+
+def iter_invoice_export(date_from=None, date_to=None, statuses=None, user_id=None,
+                        company_id=None, batch_size=STREAM_BATCH_SIZE):
+    """
+    Stream invoices joined with their company and line items
+    One flat row per line item (one row with empty item columns for an
+    invoice without items), in invoice date order. The date range is
+    inclusive and uses idx_invoices_invoice_date_id.
+    """
+    where, params = _invoice_filter(date_from, date_to, statuses, user_id, company_id)
+    return iter_query(EXPORT_QUERY.format(where=where), params, batch_size=batch_size)
+
+
+def get_invoice_ids(date_from=None, date_to=None, statuses=None, user_id=None, company_id=None):
+    """Ids of the invoices matching the export filters, in invoice date order"""
+    where, params = _invoice_filter(date_from, date_to, statuses, user_id, company_id)
+    conn = get_db_connection()
+    ids = [row[0] for row in conn.execute(
+        f"SELECT i.id FROM invoices i {where} ORDER BY i.invoice_date, i.id", params)]
+    conn.close()
+    return ids
+
+
+def load_invoice_batch(date_from=None, date_to=None, statuses=None, user_id=None,
+                       company_id=None, chunk_size=STREAM_BATCH_SIZE):
+    """
+    Load the invoices matching the export filters into a columnar InvoiceBatch
+    Rows come back as plain tuples in `chunk_size` chunks and go straight
+    into the batch's typed arrays.
+    """
+    where, params = _invoice_filter(date_from, date_to, statuses, user_id, company_id)
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"SELECT {INVOICE_BATCH_SELECT} FROM invoices i {where}", params)
+        return InvoiceBatch.from_cursor(cursor, chunk_size)
+    finally:
+        conn.close()
+
+
+def group_export_rows(rows):
+    """
+    Fold consecutive flat export rows into one nested dict per invoice
+    Relies on the export query returning an invoice's rows together, so only
+    the current invoice is held in memory.
+    """
+    invoice = None
+    for row in rows:
+        if invoice is None or invoice['invoice_id'] != row['invoice_id']:
+            if invoice is not None:
+                yield invoice
+            invoice = {column: row[column] for column in EXPORT_INVOICE_COLUMNS}
+            invoice['company'] = ({column: row[column] for column in EXPORT_COMPANY_COLUMNS}
+                                  if row['company_id'] is not None else None)
+            invoice['items'] = []
+        if row['item_id'] is not None:
+            invoice['items'].append({column: row[column] for column in EXPORT_ITEM_COLUMNS})
+    if invoice is not None:
+        yield invoice
+
+
+class _LineWriter:
+    """File-like object whose write() hands the line back, for csv.writer"""
+
+    def write(self, line):
+        return line
+
+
+def iter_export_lines(rows, fmt='csv'):
+    """
+    Encode export rows as text lines
+    csv: a header, then one line per flat row.
+    ndjson: one JSON object per invoice, with company and items nested.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    if fmt == 'ndjson':
+        for invoice in group_export_rows(rows):
+            yield json.dumps(invoice, default=str) + '\n'
+        return
+
+    writer = csv.writer(_LineWriter(), lineterminator='\n')
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writer.writerow([row[column] for column in EXPORT_COLUMNS])
+
+
+class AggregateCache:
+    """
+    Small in-process cache for expensive aggregate queries
+    Entries expire after `ttl` seconds. Writes in this process call
+    invalidate() so they show up at once; the TTL bounds staleness from
+    writes made by other processes.
+    """
+
+    def __init__(self, ttl=STATS_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generation = 0
+
+    def get(self, key, compute):
+        """Return the cached value for key, calling compute() on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+            generation = self._generation
+
+        value = compute()
+
+        with self._lock:
+            # Don't store a value computed before an invalidation landed
+            if generation == self._generation:
+                self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self):
+        """Drop every cached aggregate"""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+
+stats_cache = AggregateCache()
+
+
+def _compute_system_stats():
+    conn = get_db_connection()
+    row = conn.execute("""
+        SELECT (SELECT COUNT(*) FROM users) AS total_users,
+               TOTAL(invoice_count) AS total_invoices,
+               TOTAL(CASE WHEN status = 'paid' THEN total_sum END) AS total_revenue,
+               TOTAL(CASE WHEN status IN ('sent', 'draft') THEN total_sum END) AS pending_revenue
+        FROM invoice_stats
+    """).fetchone()
+    conn.close()
+    return {
+        'total_users': row['total_users'],
+        'total_invoices': int(row['total_invoices']),
+        'total_revenue': row['total_revenue'],
+        'pending_revenue': row['pending_revenue']
+    }
+
+
+def get_system_stats():
+    """System-wide user/invoice/revenue totals (admin panel, /api/stats), cached"""
+    return stats_cache.get('system_stats', _compute_system_stats)
+
+
 def get_dashboard_stats(user_id):
-    """Get dashboard statistics for user"""
+    """Get dashboard statistics for user (read from the invoice_stats rollup)"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.execute("SELECT status, invoice_count, total_sum FROM invoice_stats WHERE user_id=?", (user_id,))
+    rows = {row['status']: row for row in cursor.fetchall()}
+    conn.close()
 
-    stats = {}
+    def count(status):
+        return rows[status]['invoice_count'] if status in rows else 0
 
-    # Total invoices
-    cursor.execute("SELECT COUNT(*) as count FROM invoices WHERE user_id=?", (user_id,))
-    stats['total_invoices'] = cursor.fetchone()['count']
+    def amount(status):
+        return rows[status]['total_sum'] if status in rows else 0
 
-    # Paid invoices
-    cursor.execute("SELECT COUNT(*) as count FROM invoices WHERE user_id=? AND status='paid'", (user_id,))
-    stats['paid_invoices'] = cursor.fetchone()['count']
+    return {
+        'total_invoices': sum(row['invoice_count'] for row in rows.values()),
+        'paid_invoices': count('paid'),
+        'pending_invoices': count('sent'),
+        'overdue_invoices': count('overdue'),
+        'total_revenue': amount('paid'),
+        'outstanding_amount': amount('sent') + amount('overdue')
+    }
 
-    # Pending invoices
-    cursor.execute("SELECT COUNT(*) as count FROM invoices WHERE user_id=? AND status='sent'", (user_id,))
-    stats['pending_invoices'] = cursor.fetchone()['count']
 
-    # Overdue invoices
-    cursor.execute("SELECT COUNT(*) as count FROM invoices WHERE user_id=? AND status='overdue'", (user_id,))
-    stats['overdue_invoices'] = cursor.fetchone()['count']
+def get_recent_invoices(user_id, limit=5):
+    """Get the most recent invoices for a user"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT i.*, c.company_name
+        FROM invoices i
+        LEFT JOIN companies c ON i.company_id = c.id
+        WHERE i.user_id=?
+        ORDER BY i.created_at DESC
+        LIMIT ?
+    """, (user_id, limit))
+    invoices = cursor.fetchall()
+    conn.close()
+    return [dict(inv) for inv in invoices]
+
 
-    # Total revenue
-    cursor.execute("SELECT SUM(total) as revenue FROM invoices WHERE user_id=? AND status='paid'", (user_id,))
-    result = cursor.fetchone()
-    stats['total_revenue'] = result['revenue'] if result['revenue'] else 0
+# Live aggregate used to (re)build and verify the invoice_stats rollup
+ROLLUP_SOURCE_QUERY = """
+    SELECT user_id, IFNULL(status, '') AS status,
+           COUNT(*) AS invoice_count, TOTAL(IFNULL(total, 0)) AS total_sum
+    FROM invoices
+    GROUP BY user_id, IFNULL(status, '')
+"""
 
-    # Outstanding amount
-    cursor.execute("SELECT SUM(total) as outstanding FROM invoices WHERE user_id=? AND status IN ('sent', 'overdue')", (user_id,))
-    result = cursor.fetchone()
-    stats['outstanding_amount'] = result['outstanding'] if result['outstanding'] else 0
 
+def rebuild_dashboard_rollups():
+    """Recompute the invoice_stats rollup from the invoices table"""
+    conn = get_db_connection()
+    with conn:
+        conn.execute("DELETE FROM invoice_stats")
+        conn.execute(f"""
+            INSERT INTO invoice_stats (user_id, status, invoice_count, total_sum)
+            {ROLLUP_SOURCE_QUERY}
+        """)
+    count = conn.execute("SELECT COUNT(*) FROM invoice_stats").fetchone()[0]
     conn.close()
-    return stats
+    return count
+
+
+def check_dashboard_rollups(tolerance=0.005):
+    """
+    Compare invoice_stats against live aggregates over invoices
+    Returns a list of (user_id, status, expected, actual) mismatches,
+    where expected/actual are (invoice_count, total_sum) tuples.
+    """
+    conn = get_db_connection()
+    live = {(r['user_id'], r['status']): (r['invoice_count'], r['total_sum'])
+            for r in conn.execute(ROLLUP_SOURCE_QUERY)}
+    stored = {(r['user_id'], r['status']): (r['invoice_count'], r['total_sum'])
+              for r in conn.execute("SELECT * FROM invoice_stats")}
+    conn.close()
+
+    mismatches = []
+    for key in sorted(set(live) | set(stored), key=str):
+        expected = live.get(key, (0, 0))
+        actual = stored.get(key, (0, 0))
+        if expected[0] != actual[0] or abs(expected[1] - actual[1]) > tolerance:
+            mismatches.append((key[0], key[1], expected, actual))
+    return mismatches
@@ -27,7 +27,8 @@ CREATE TABLE IF NOT EXISTS companies (
     state TEXT,
     zip_code TEXT,
     country TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- Part of the invoice ETags (company details are rendered)
 );
 
 -- Invoices table (Vulnerability #22: Sequential predictable IDs)
@@ -48,7 +49,8 @@ CREATE TABLE IF NOT EXISTS invoices (
     terms TEXT,
     attachment_path TEXT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    items_version INTEGER NOT NULL DEFAULT 0  -- Bumped whenever the invoice's line items change
 );
 
 -- Invoice line items
@@ -96,10 +98,223 @@ CREATE TABLE IF NOT EXISTS activity_log (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Version tracking for ETags (see database.get_invoice_etag)
+-- Any UPDATE that does not set updated_at itself gets a fresh millisecond timestamp
+CREATE TRIGGER IF NOT EXISTS trg_invoices_touch AFTER UPDATE ON invoices
+WHEN NEW.updated_at IS OLD.updated_at
+BEGIN
+    UPDATE invoices SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id = NEW.id;
+END;
+
+-- Invoice pages and lists render company details, so companies carry a version too
+CREATE TRIGGER IF NOT EXISTS trg_companies_touch AFTER UPDATE ON companies
+WHEN NEW.updated_at IS OLD.updated_at
+BEGIN
+    UPDATE companies SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoice_items_version_insert AFTER INSERT ON invoice_items
+BEGIN
+    UPDATE invoices SET items_version = items_version + 1 WHERE id = NEW.invoice_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoice_items_version_update AFTER UPDATE ON invoice_items
+BEGIN
+    UPDATE invoices SET items_version = items_version + 1 WHERE id IN (OLD.invoice_id, NEW.invoice_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoice_items_version_delete AFTER DELETE ON invoice_items
+BEGIN
+    UPDATE invoices SET items_version = items_version + 1 WHERE id = OLD.invoice_id;
+END;
+
+-- Invoice number sequences, one row per year (see database.allocate_invoice_numbers)
+CREATE TABLE IF NOT EXISTS invoice_sequences (
+    year INTEGER PRIMARY KEY,
+    last_value INTEGER NOT NULL
+);
+
+-- Per-user invoice rollup (one row per user and status)
+-- Kept current by the triggers below so the dashboard is a single keyed lookup
+CREATE TABLE IF NOT EXISTS invoice_stats (
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    invoice_count INTEGER NOT NULL DEFAULT 0,
+    total_sum REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, status)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoice_stats_insert AFTER INSERT ON invoices
+BEGIN
+    INSERT INTO invoice_stats (user_id, status, invoice_count, total_sum)
+    VALUES (NEW.user_id, IFNULL(NEW.status, ''), 1, IFNULL(NEW.total, 0))
+    ON CONFLICT (user_id, status) DO UPDATE SET
+        invoice_count = invoice_count + 1,
+        total_sum = total_sum + excluded.total_sum;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoice_stats_delete AFTER DELETE ON invoices
+BEGIN
+    UPDATE invoice_stats
+    SET invoice_count = invoice_count - 1,
+        total_sum = total_sum - IFNULL(OLD.total, 0)
+    WHERE user_id = OLD.user_id AND status = IFNULL(OLD.status, '');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoice_stats_update AFTER UPDATE OF user_id, status, total ON invoices
+BEGIN
+    UPDATE invoice_stats
+    SET invoice_count = invoice_count - 1,
+        total_sum = total_sum - IFNULL(OLD.total, 0)
+    WHERE user_id = OLD.user_id AND status = IFNULL(OLD.status, '');
+
+    INSERT INTO invoice_stats (user_id, status, invoice_count, total_sum)
+    VALUES (NEW.user_id, IFNULL(NEW.status, ''), 1, IFNULL(NEW.total, 0))
+    ON CONFLICT (user_id, status) DO UPDATE SET
+        invoice_count = invoice_count + 1,
+        total_sum = total_sum + excluded.total_sum;
+END;
+
+-- Full-text search over invoices (rowid = invoices.id)
+-- Denormalizes the company name and item descriptions; kept in sync by triggers
+CREATE VIRTUAL TABLE IF NOT EXISTS invoices_fts USING fts5(
+    invoice_number,
+    notes,
+    terms,
+    company_name,
+    item_descriptions,
+    user_id UNINDEXED,
+    prefix = '2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_invoices_fts_insert AFTER INSERT ON invoices
+BEGIN
+    INSERT INTO invoices_fts (rowid, invoice_number, notes, terms, company_name, item_descriptions, user_id)
+    SELECT NEW.id, NEW.invoice_number, NEW.notes, NEW.terms,
+           (SELECT company_name FROM companies WHERE id = NEW.company_id),
+           (SELECT group_concat(description, ' ') FROM invoice_items WHERE invoice_id = NEW.id),
+           NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoices_fts_update
+AFTER UPDATE OF user_id, company_id, invoice_number, notes, terms ON invoices
+BEGIN
+    DELETE FROM invoices_fts WHERE rowid = OLD.id;
+    INSERT INTO invoices_fts (rowid, invoice_number, notes, terms, company_name, item_descriptions, user_id)
+    SELECT NEW.id, NEW.invoice_number, NEW.notes, NEW.terms,
+           (SELECT company_name FROM companies WHERE id = NEW.company_id),
+           (SELECT group_concat(description, ' ') FROM invoice_items WHERE invoice_id = NEW.id),
+           NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoices_fts_delete AFTER DELETE ON invoices
+BEGIN
+    DELETE FROM invoices_fts WHERE rowid = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoice_items_fts_insert AFTER INSERT ON invoice_items
+BEGIN
+    UPDATE invoices_fts
+    SET item_descriptions = (SELECT group_concat(description, ' ') FROM invoice_items WHERE invoice_id = NEW.invoice_id)
+    WHERE rowid = NEW.invoice_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoice_items_fts_update AFTER UPDATE OF invoice_id, description ON invoice_items
+BEGIN
+    UPDATE invoices_fts
+    SET item_descriptions = (SELECT group_concat(description, ' ') FROM invoice_items WHERE invoice_id = OLD.invoice_id)
+    WHERE rowid = OLD.invoice_id;
+    UPDATE invoices_fts
+    SET item_descriptions = (SELECT group_concat(description, ' ') FROM invoice_items WHERE invoice_id = NEW.invoice_id)
+    WHERE rowid = NEW.invoice_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_invoice_items_fts_delete AFTER DELETE ON invoice_items
+BEGIN
+    UPDATE invoices_fts
+    SET item_descriptions = (SELECT group_concat(description, ' ') FROM invoice_items WHERE invoice_id = OLD.invoice_id)
+    WHERE rowid = OLD.invoice_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_companies_fts_update AFTER UPDATE OF company_name ON companies
+BEGIN
+    UPDATE invoices_fts
+    SET company_name = NEW.company_name
+    WHERE rowid IN (SELECT id FROM invoices WHERE company_id = NEW.id);
+END;
+
+-- Asynchronous PDF render jobs (see pdf_renderer.PdfJobRunner)
+-- The rendered HTML is kept so a job can be re-run after a restart or cache eviction
+CREATE TABLE IF NOT EXISTS pdf_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    invoice_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',  -- queued, running, done, failed
+    cache_key TEXT NOT NULL,  -- SHA-256 of html, names the cached PDF
+    html TEXT NOT NULL,
+    filename TEXT,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    leased_at TIMESTAMP  -- Renewed by the claiming process while it holds the job
+);
+
+-- Content-addressed attachment storage (see attachment_store.AttachmentStore)
+-- One row per distinct file content; ref_count is kept by the triggers below
+CREATE TABLE IF NOT EXISTS attachment_blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP  -- Last reference change, for the GC grace period
+) WITHOUT ROWID;
+
+-- Invoice attachments; the original file name is kept for display only
+CREATE TABLE IF NOT EXISTS attachments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    invoice_id INTEGER NOT NULL,  -- No FOREIGN KEY constraint
+    sha256 TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    content_type TEXT,
+    size INTEGER NOT NULL,
+    uploaded_by INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_attachments_ref_insert AFTER INSERT ON attachments
+BEGIN
+    UPDATE attachment_blobs SET ref_count = ref_count + 1, updated_at = CURRENT_TIMESTAMP
+    WHERE sha256 = NEW.sha256;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_attachments_ref_delete AFTER DELETE ON attachments
+BEGIN
+    UPDATE attachment_blobs SET ref_count = ref_count - 1, updated_at = CURRENT_TIMESTAMP
+    WHERE sha256 = OLD.sha256;
+END;
+
 -- Indexes for performance (but missing on some critical columns)
 CREATE INDEX IF NOT EXISTS idx_invoices_user_id ON invoices(user_id);
+-- Keyset pagination indexes (ORDER BY created_at DESC, id DESC)
+CREATE INDEX IF NOT EXISTS idx_invoices_created_at_id ON invoices(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_invoices_user_created_at_id ON invoices(user_id, created_at, id);
+-- Collection ETags (MAX(updated_at) per user and overall)
+CREATE INDEX IF NOT EXISTS idx_invoices_updated_at ON invoices(updated_at);
+CREATE INDEX IF NOT EXISTS idx_invoices_user_updated_at ON invoices(user_id, updated_at);
+CREATE INDEX IF NOT EXISTS idx_companies_updated_at ON companies(updated_at);
+-- Exports (invoice_date range, ORDER BY invoice_date, id)
+CREATE INDEX IF NOT EXISTS idx_invoices_invoice_date_id ON invoices(invoice_date, id);
 CREATE INDEX IF NOT EXISTS idx_companies_user_id ON companies(user_id);
 CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice_id ON invoice_items(invoice_id);
+CREATE INDEX IF NOT EXISTS idx_attachments_invoice_id ON attachments(invoice_id);
+CREATE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments(sha256);
+CREATE INDEX IF NOT EXISTS idx_attachment_blobs_ref_count ON attachment_blobs(ref_count, updated_at);
+CREATE INDEX IF NOT EXISTS idx_pdf_jobs_status_id ON pdf_jobs(status, id);
 CREATE INDEX IF NOT EXISTS idx_sessions_session_id ON sessions(session_id);
 -- Missing index on sessions.user_id (performance issue)
--- Missing index on activity_log (performance issue)
+
+-- Activity log browsing (/admin/logs) and retention by created_at
+CREATE INDEX IF NOT EXISTS idx_activity_log_created_at ON activity_log(created_at);
+CREATE INDEX IF NOT EXISTS idx_activity_log_user_created_at ON activity_log(user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_activity_log_action_created_at ON activity_log(action, created_at);
@@ -3,7 +3,9 @@ Models package for InvoiceFlow
 """
 
 from .user import User
-from .invoice import Invoice
+from .invoice import Invoice, InvoiceItem
 from .company import Company
+from .invoice_batch import InvoiceBatch
+from .rows import model_row_factory, model_from_row
 
-__all__ = ['User', 'Invoice', 'Company']
+__all__ = ['User', 'Invoice', 'InvoiceItem', 'Company', 'InvoiceBatch', 'model_row_factory', 'model_from_row']
@@ -4,11 +4,15 @@ Represents client companies
 """
 
 from datetime import datetime
+from .rows import model_from_row
 
 
 class Company:
     """Company/Client model"""
 
+    __slots__ = ('id', 'user_id', 'company_name', 'contact_person', 'email', 'phone',
+                 'address', 'city', 'state', 'zip_code', 'country', 'created_at')
+
     def __init__(self, id=None, user_id=None, company_name='', contact_person='',
                  email='', phone='', address='', city='', state='', zip_code='',
                  country='', created_at=None):
@@ -49,23 +53,8 @@ class Company:
 
     @staticmethod
     def from_db_row(row):
-        """Create Company instance from database row"""
-        if not row:
-            return None
-        return Company(
-            id=row['id'],
-            user_id=row['user_id'],
-            company_name=row['company_name'],
-            contact_person=row.get('contact_person', ''),
-            email=row.get('email', ''),
-            phone=row.get('phone', ''),
-            address=row.get('address', ''),
-            city=row.get('city', ''),
-            state=row.get('state', ''),
-            zip_code=row.get('zip_code', ''),
-            country=row.get('country', ''),
-            created_at=row.get('created_at')
-        )
+        """Create Company instance from database row (sqlite3.Row or dict)"""
+        return model_from_row(Company, row)
 
     def __repr__(self):
         return f"<Company {self.company_name}>"
@@ -4,15 +4,21 @@ Represents customer invoices
 """
 
 from datetime import datetime
+from .rows import model_from_row
 
 
 class Invoice:
     """Invoice model - Vulnerability #22: Sequential predictable IDs"""
 
+    __slots__ = ('id', 'user_id', 'company_id', 'invoice_number', 'invoice_date', 'due_date',
+                 'status', 'subtotal', 'tax_rate', 'tax_amount', 'discount', 'total', 'notes',
+                 'terms', 'attachment_path', 'created_at', 'updated_at', 'items_version')
+
     def __init__(self, id=None, user_id=None, company_id=None, invoice_number=None,
                  invoice_date=None, due_date=None, status='draft', subtotal=0.0,
                  tax_rate=0.0, tax_amount=0.0, discount=0.0, total=0.0,
-                 notes='', terms='', attachment_path=None, created_at=None, updated_at=None):
+                 notes='', terms='', attachment_path=None, created_at=None, updated_at=None,
+                 items_version=0):
         self.id = id  # Sequential AUTO_INCREMENT (predictable)
         self.user_id = user_id
         self.company_id = company_id
@@ -30,6 +36,7 @@ class Invoice:
         self.attachment_path = attachment_path
         self.created_at = created_at or datetime.now()
         self.updated_at = updated_at or datetime.now()
+        self.items_version = items_version
 
     def calculate_total(self):
         """Calculate invoice total"""
@@ -56,33 +63,14 @@ class Invoice:
             'terms': self.terms,
             'attachment_path': self.attachment_path,
             'created_at': str(self.created_at) if self.created_at else None,
-            'updated_at': str(self.updated_at) if self.updated_at else None
+            'updated_at': str(self.updated_at) if self.updated_at else None,
+            'items_version': self.items_version
         }
 
     @staticmethod
     def from_db_row(row):
-        """Create Invoice instance from database row"""
-        if not row:
-            return None
-        return Invoice(
-            id=row['id'],
-            user_id=row['user_id'],
-            company_id=row.get('company_id'),
-            invoice_number=row['invoice_number'],
-            invoice_date=row['invoice_date'],
-            due_date=row.get('due_date'),
-            status=row['status'],
-            subtotal=row.get('subtotal', 0.0),
-            tax_rate=row.get('tax_rate', 0.0),
-            tax_amount=row.get('tax_amount', 0.0),
-            discount=row.get('discount', 0.0),
-            total=row.get('total', 0.0),
-            notes=row.get('notes', ''),
-            terms=row.get('terms', ''),
-            attachment_path=row.get('attachment_path'),
-            created_at=row.get('created_at'),
-            updated_at=row.get('updated_at')
-        )
+        """Create Invoice instance from database row (sqlite3.Row or dict)"""
+        return model_from_row(Invoice, row)
 
     def __repr__(self):
         return f"<Invoice {self.invoice_number} - ${self.total}>"
@@ -91,6 +79,8 @@ class Invoice:
 class InvoiceItem:
     """Invoice line item model"""
 
+    __slots__ = ('id', 'invoice_id', 'description', 'quantity', 'unit_price', 'amount', 'sort_order')
+
     def __init__(self, id=None, invoice_id=None, description='', quantity=1.0,
                  unit_price=0.0, amount=0.0, sort_order=0):
         self.id = id
@@ -120,18 +110,8 @@ class InvoiceItem:
 
     @staticmethod
     def from_db_row(row):
-        """Create InvoiceItem instance from database row"""
-        if not row:
-            return None
-        return InvoiceItem(
-            id=row['id'],
-            invoice_id=row['invoice_id'],
-            description=row['description'],
-            quantity=row['quantity'],
-            unit_price=row['unit_price'],
-            amount=row['amount'],
-            sort_order=row.get('sort_order', 0)
-        )
+        """Create InvoiceItem instance from database row (sqlite3.Row or dict)"""
+        return model_from_row(InvoiceItem, row)
 
     def __repr__(self):
         return f"<InvoiceItem {self.description} - ${self.amount}>"
@@ -0,0 +1,186 @@
+"""
+Columnar invoice batches for reporting
+An InvoiceBatch holds a few invoice columns as typed arrays (NumPy arrays
+when NumPy is installed, array.array otherwise) so totals, group-bys and
+date buckets run over whole columns instead of one dict per row.
+"""
+
+from array import array
+from datetime import date
+
+try:
+    import numpy as np
+except ImportError:  # optional: fall back to the array module
+    np = None
+
+
+# SQLite julianday() of 0001-01-01 minus one, so julianday - offset = date.toordinal()
+JULIAN_ORDINAL_OFFSET = 1721424.5
+
+# column: (SQL expression over invoices `i`, array typecode); NULLs and stray
+# text are coerced in SQL since array.extend() rejects anything but numbers
+BATCH_COLUMNS = {
+    'id': ("i.id", 'q'),
+    'user_id': ("CAST(COALESCE(i.user_id, 0) AS INTEGER)", 'q'),
+    'company_id': ("CAST(COALESCE(i.company_id, 0) AS INTEGER)", 'q'),
+    'invoice_date': (f"COALESCE(CAST(julianday(i.invoice_date) - {JULIAN_ORDINAL_OFFSET} AS INTEGER), 0)", 'q'),
+    'subtotal': ("CAST(COALESCE(i.subtotal, 0) AS REAL)", 'd'),
+    'tax_amount': ("CAST(COALESCE(i.tax_amount, 0) AS REAL)", 'd'),
+    'discount': ("CAST(COALESCE(i.discount, 0) AS REAL)", 'd'),
+    'total': ("CAST(COALESCE(i.total, 0) AS REAL)", 'd'),
+}
+AMOUNT_COLUMNS = ('subtotal', 'tax_amount', 'discount', 'total')
+DATE_BUCKETS = ('day', 'week', 'month', 'year')
+
+# Status is dictionary-encoded, so it is selected last and handled apart;
+# NULL becomes 'unknown' so the group keys stay sortable strings
+INVOICE_BATCH_SELECT = ', '.join(
+    [f"{expr} AS {name}" for name, (expr, _) in BATCH_COLUMNS.items()]
+    + ["COALESCE(i.status, 'unknown') AS status"])
+
+
+class _Codebook(dict):
+    """Maps each new key to the next dense integer code"""
+
+    def __missing__(self, key):
+        code = self[key] = len(self)
+        return code
+
+
+def _date_label(ordinal, period):
+    if ordinal <= 0:
+        return 'unknown'
+    day = date.fromordinal(ordinal)
+    if period == 'day':
+        return day.isoformat()
+    if period == 'week':
+        year, week, _ = day.isocalendar()
+        return f"{year}-W{week:02d}"
+    if period == 'month':
+        return f"{day.year}-{day.month:02d}"
+    return str(day.year)
+
+
+class InvoiceBatch:
+    """Invoice columns as typed arrays, with whole-column aggregates"""
+
+    def __init__(self, columns, statuses):
+        self.columns = columns    # name -> array.array or numpy array
+        self.statuses = statuses  # status code -> status string
+        self.backend = 'numpy' if np is not None else 'array'
+
+    @classmethod
+    def from_cursor(cls, cursor, chunk_size=1000):
+        """
+        Build a batch from a cursor over INVOICE_BATCH_SELECT
+        Rows are read with fetchmany(chunk_size) and appended column by column,
+        so no per-row objects outlive their chunk. The cursor should return
+        plain tuples (row_factory None).
+        """
+        arrays = {name: array(typecode) for name, (_, typecode) in BATCH_COLUMNS.items()}
+        targets = list(arrays.values())
+        codes = array('q')
+        codebook = _Codebook()
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            for target, values in zip(targets, columns):
+                target.extend(values)
+            codes.extend(map(codebook.__getitem__, columns[-1]))
+
+        arrays['status'] = codes
+        if np is not None:
+            arrays = {name: np.frombuffer(values, dtype=values.typecode)
+                      for name, values in arrays.items()}
+        return cls(arrays, list(codebook))
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __repr__(self):
+        return f"<InvoiceBatch {len(self)} invoices ({self.backend})>"
+
+    def _sum(self, values):
+        return float(values.sum()) if np is not None else float(sum(values))
+
+    def _aggregate(self, codes, size):
+        """Count and amount sums per dense group code in [0, size)"""
+        if np is not None:
+            counts = np.bincount(codes, minlength=size).tolist()
+            sums = [np.bincount(codes, weights=self.columns[name], minlength=size).tolist()
+                    for name in AMOUNT_COLUMNS]
+        else:
+            counts = [0] * size
+            for code in codes:
+                counts[code] += 1
+            sums = []
+            for name in AMOUNT_COLUMNS:
+                acc = [0.0] * size
+                for code, value in zip(codes, self.columns[name]):
+                    acc[code] += value
+                sums.append(acc)
+
+        return [{'count': count, **dict(zip(AMOUNT_COLUMNS, amounts))}
+                for count, *amounts in zip(counts, *sums)]
+
+    def _encode(self, values):
+        """Dense group codes for an integer column, and the value behind each code"""
+        if np is not None:
+            keys, codes = np.unique(values, return_inverse=True)
+            return codes, keys.tolist()
+        codebook = _Codebook()
+        codes = array('q', map(codebook.__getitem__, values))
+        return codes, list(codebook)
+
+    def totals(self):
+        """Invoice count and amount sums over the whole batch"""
+        result = {'count': len(self)}
+        for name in AMOUNT_COLUMNS:
+            result[name] = self._sum(self.columns[name])
+        return result
+
+    def group_by_status(self):
+        """{status: {count, subtotal, tax_amount, discount, total}}"""
+        groups = self._aggregate(self.columns['status'], len(self.statuses))
+        return dict(sorted(zip(self.statuses, groups)))
+
+    def group_by(self, column):
+        """Aggregates per distinct value of an integer column (user_id, company_id, ...)"""
+        codes, keys = self._encode(self.columns[column])
+        return dict(sorted(zip(keys, self._aggregate(codes, len(keys)))))
+
+    def group_by_company(self):
+        """Aggregates per company_id (0 for invoices without a company)"""
+        return self.group_by('company_id')
+
+    def bucket_by_date(self, period='month'):
+        """
+        Aggregates per invoice_date bucket ('day', 'week', 'month' or 'year')
+        Rows are grouped by day over the column first; only the distinct days
+        are turned into labels and folded into coarser buckets.
+        """
+        if period not in DATE_BUCKETS:
+            raise ValueError(f"period must be one of {', '.join(DATE_BUCKETS)}")
+
+        buckets = {}
+        for ordinal, group in self.group_by('invoice_date').items():
+            label = _date_label(ordinal, period)
+            bucket = buckets.get(label)
+            if bucket is None:
+                buckets[label] = group
+            else:
+                for name, value in group.items():
+                    bucket[name] += value
+        return dict(sorted(buckets.items()))
+
+    def summary(self, period='month'):
+        """Totals plus every grouping, as one JSON-ready dict"""
+        return {
+            'totals': self.totals(),
+            'by_status': self.group_by_status(),
+            'by_company': self.group_by_company(),
+            'by_date': self.bucket_by_date(period),
+        }
@@ -0,0 +1,68 @@
+"""
+Building model objects from sqlite3 rows
+model_row_factory() is a cursor row_factory that fills a __slots__ model
+straight from the result tuple, without the dict(row) copy.
+"""
+
+import inspect
+from operator import itemgetter
+
+
+def _slot_defaults(model):
+    """Default value for every slot, taken from the model's __init__ signature"""
+    params = inspect.signature(model.__init__).parameters
+    return {name: (params[name].default if name in params else None) for name in model.__slots__}
+
+
+def _tuple_getter(indexes):
+    """itemgetter that always returns a tuple, even for zero or one index"""
+    if len(indexes) > 1:
+        return itemgetter(*indexes)
+    if indexes:
+        index = indexes[0]
+        return lambda row: (row[index],)
+    return lambda row: ()
+
+
+def model_row_factory(model):
+    """
+    sqlite3 row_factory returning `model` instances
+    Columns are matched to slots by name once per statement (the mapping is
+    cached against cursor.description); slots with no matching column get
+    their __init__ default, and columns with no slot (joined extras) are
+    ignored. __init__ itself is not called.
+    """
+    defaults = _slot_defaults(model)
+    setters = {name: getattr(model, name).__set__ for name in model.__slots__}
+    new = model.__new__
+    # (description, pick values, [setter], [(setter, default)])
+    plan = [(None, None, (), ())]
+
+    def build_plan(description):
+        columns = {column[0]: index for index, column in enumerate(description)}
+        present = [name for name in model.__slots__ if name in columns]
+        pick = _tuple_getter([columns[name] for name in present])
+        fill = [(setters[name], defaults[name]) for name in model.__slots__ if name not in columns]
+        return description, pick, [setters[name] for name in present], fill
+
+    def factory(cursor, row):
+        description, pick, assign, fill = plan[0]
+        if description is not cursor.description:
+            # Replace the whole tuple at once so concurrent cursors never mix plans
+            description, pick, assign, fill = plan[0] = build_plan(cursor.description)
+        obj = new(model)
+        for setter, value in zip(assign, pick(row)):
+            setter(obj, value)
+        for setter, default in fill:
+            setter(obj, default)
+        return obj
+
+    return factory
+
+
+def model_from_row(model, row):
+    """Build a model from a sqlite3.Row or dict, ignoring columns it has no slot for"""
+    if not row:
+        return None
+    fields = model.__slots__
+    return model(**{key: row[key] for key in row.keys() if key in fields})
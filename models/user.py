@@ -4,11 +4,15 @@ Represents system users with authentication
 """
 
 from datetime import datetime
+from .rows import model_from_row
 
 
 class User:
     """User model"""
 
+    __slots__ = ('id', 'username', 'email', 'password', 'full_name', 'role',
+                 'created_at', 'last_login', 'is_active')
+
     def __init__(self, id=None, username=None, email=None, password=None,
                  full_name=None, role='user', created_at=None, last_login=None,
                  is_active=1):
@@ -50,20 +54,8 @@ class User:
 
     @staticmethod
     def from_db_row(row):
-        """Create User instance from database row"""
-        if not row:
-            return None
-        return User(
-            id=row['id'],
-            username=row['username'],
-            email=row['email'],
-            password=row['password'],
-            full_name=row['full_name'],
-            role=row['role'],
-            created_at=row['created_at'],
-            last_login=row['last_login'],
-            is_active=row['is_active']
-        )
+        """Create User instance from database row (sqlite3.Row or dict)"""
+        return model_from_row(User, row)
 
     def __repr__(self):
         return f"<User {self.username} ({self.role})>"
@@ -0,0 +1,456 @@
+"""
+PDF rendering for InvoiceFlow
+wkhtmltopdf runs in a bounded worker pool; output is cached on disk under
+the SHA-256 of the rendered HTML, so an unchanged invoice is never
+rendered twice. Asynchronous jobs are queued in the pdf_jobs table and fed
+to the same pool by PdfJobRunner.
+"""
+
+import os
+import hashlib
+import subprocess
+import tempfile
+import threading
+import time
+import atexit
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import database as db
+from config import (WKHTMLTOPDF_PATH, PDF_WORKERS, PDF_MAX_PENDING, PDF_RENDER_TIMEOUT,
+                    PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES, PDF_JOBS_ENABLED, PDF_JOB_CONCURRENCY,
+                    PDF_JOB_POLL_INTERVAL, PDF_JOB_RETENTION_DAYS, PDF_BATCH_CONCURRENCY)
+
+
+class PdfRenderError(Exception):
+    """wkhtmltopdf failed or produced no output"""
+
+
+class PdfRendererBusy(PdfRenderError):
+    """Too many renders already queued"""
+
+
+def html_cache_key(html):
+    """Cache key for a rendered HTML document"""
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+
+class PdfCache:
+    """
+    Content-addressed PDF files with size-bounded LRU eviction
+    Files live at <directory>/<key[:2]>/<key>.pdf. Recency is kept in memory
+    (seeded from file mtimes on startup) and mirrored to mtime on every hit,
+    so the order survives a restart.
+    """
+
+    def __init__(self, directory=PDF_CACHE_DIR, max_bytes=PDF_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = None  # key -> size, least recently used first
+        self._size = 0
+        self._stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.pdf')
+
+    def _load(self):
+        """Index files already on disk (called with the lock held)"""
+        if self._entries is not None:
+            return
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.pdf'):
+                    st = os.stat(os.path.join(root, name))
+                    found.append((st.st_mtime, name[:-4], st.st_size))
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(found))
+        self._size = sum(self._entries.values())
+
+    def get(self, key):
+        """
+        Path of the cached PDF for `key`, or None
+        A file this process has not indexed (rendered by another worker
+        sharing the directory) is adopted into the index rather than
+        reported as a miss.
+        """
+        path = self.path_for(key)
+        with self._lock:
+            self._load()
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                self._forget(key)
+                self._stats['misses'] += 1
+                return None
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                self._entries[key] = size
+                self._size += size
+                self._evict(keep=key)
+            self._stats['hits'] += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def put(self, key, source_path):
+        """Move a freshly rendered file into the cache and evict down to max_bytes"""
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._load()
+            self._forget(key)
+            self._entries[key] = size
+            self._size += size
+            self._stats['stored'] += 1
+            self._evict(keep=key)
+        return path
+
+    def _forget(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    def _evict(self, keep):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            if key == keep:
+                break
+            self._forget(key)
+            self._stats['evicted'] += 1
+            try:
+                os.remove(self.path_for(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return dict(self._stats, entries=len(self._entries), bytes=self._size,
+                        max_bytes=self.max_bytes)
+
+
+class PdfRenderer:
+    """
+    Bounded pool of wkhtmltopdf processes in front of a PdfCache
+    At most `workers` processes run at once and at most `max_pending`
+    renders are queued or running; beyond that render() raises
+    PdfRendererBusy instead of piling up request threads. Concurrent
+    requests for the same HTML share one render.
+    """
+
+    def __init__(self, cache=None, workers=PDF_WORKERS, max_pending=PDF_MAX_PENDING,
+                 timeout=PDF_RENDER_TIMEOUT, binary=WKHTMLTOPDF_PATH):
+        self.cache = cache or PdfCache()
+        self.workers = workers
+        self.timeout = timeout
+        self.binary = binary
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._in_flight = {}  # cache key -> Future
+
+    def render(self, html):
+        """Path of a PDF for `html`, from the cache or a fresh render"""
+        key = html_cache_key(html)
+        cached = self.cache.get(key)
+        if cached:
+            return cached
+        return self.submit(html, key).result()
+
+    def open(self, html):
+        """
+        The PDF for `html` as an open binary file, rendering it if needed
+        Opening pins the file: a later eviction only unlinks it. If it was
+        evicted between render() and the open, it is rendered once more.
+        """
+        for attempt in range(2):
+            path = self.render(html)
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                if attempt:
+                    raise PdfRenderError("Rendered PDF was evicted before it could be opened")
+
+    def submit(self, html, key=None):
+        """Queue a render and return its Future (shared with identical in-flight renders)"""
+        key = key or html_cache_key(html)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            if not self._slots.acquire(blocking=False):
+                raise PdfRendererBusy(f"{len(self._in_flight)} PDF renders already pending")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='pdf-render')
+            future = self._executor.submit(self._render, html, key)
+            self._in_flight[key] = future
+        future.add_done_callback(lambda _: self._release(key))
+        return future
+
+    def _release(self, key):
+        with self._lock:
+            self._in_flight.pop(key, None)
+        self._slots.release()
+
+    def _render(self, html, key):
+        os.makedirs(self.cache.directory, exist_ok=True)
+        html_fd, html_path = tempfile.mkstemp(suffix='.html', dir=self.cache.directory)
+        pdf_fd, pdf_path = tempfile.mkstemp(suffix='.pdf.tmp', dir=self.cache.directory)
+        os.close(pdf_fd)
+        try:
+            with os.fdopen(html_fd, 'w', encoding='utf-8') as f:
+                f.write(html)
+            try:
+                result = subprocess.run([self.binary, '--quiet', html_path, pdf_path],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                        timeout=self.timeout)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                raise PdfRenderError(str(e))
+            if result.returncode != 0 or os.path.getsize(pdf_path) == 0:
+                raise PdfRenderError(result.stderr.decode('utf-8', 'replace').strip()
+                                     or f"wkhtmltopdf exited with {result.returncode}")
+            return self.cache.put(key, pdf_path)
+        finally:
+            for path in (html_path, pdf_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def shutdown(self):
+        """Wait for running renders and stop the worker threads"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._in_flight)
+        return dict(self.cache.stats(), workers=self.workers, pending=pending)
+
+
+pdf_renderer = PdfRenderer()
+
+
+class _ZipSink:
+    """Write-only file object for zipfile; the ZIP generator drains it as it goes"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_pdf_zip(documents, renderer=None, concurrency=PDF_BATCH_CONCURRENCY, chunk_size=64 * 1024):
+    """
+    Stream a ZIP of PDFs for (name, html) pairs
+    Cached PDFs are added straight away; the rest are rendered in the
+    worker pool, at most `concurrency` at a time, and added in the order
+    they finish. Files are copied into the archive in chunks, so neither
+    the documents nor the PDFs are ever all in memory. Renders that fail
+    are listed in errors.txt at the end of the archive.
+    """
+    renderer = renderer or pdf_renderer
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED)
+    documents = iter(documents)
+    pending = {}  # Future -> names waiting for it
+    failures = []
+
+    def add(name, path):
+        try:
+            source = open(path, 'rb')
+        except OSError as e:
+            failures.append(f'{name}: {str(e)}')
+            return
+        with source:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.file_size = os.fstat(source.fileno()).st_size
+            with archive.open(info, 'w') as target:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    yield sink.drain()
+        yield sink.drain()
+
+    waiting = None  # document the pool had no room for yet
+    while True:
+        while len(pending) < concurrency:
+            if waiting is None:
+                waiting = next(documents, None)
+                if waiting is None:
+                    break
+            name, html = waiting
+            key = html_cache_key(html)
+            cached = renderer.cache.get(key)
+            if cached:
+                waiting = None
+                yield from add(name, cached)
+                continue
+            try:
+                future = renderer.submit(html, key)
+            except PdfRendererBusy:
+                break
+            pending.setdefault(future, []).append(name)
+            waiting = None
+
+        if not pending:
+            if waiting is None:
+                break
+            # The pool is full with other requests' renders; back off briefly
+            time.sleep(0.2)
+            continue
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            for name in pending.pop(future):
+                try:
+                    path = future.result()
+                except PdfRenderError as e:
+                    failures.append(f'{name}: {str(e)}')
+                    continue
+                yield from add(name, path)
+
+    if failures:
+        archive.writestr('errors.txt', '\n'.join(failures) + '\n')
+    archive.close()
+    yield sink.drain()
+
+
+class PdfJobRunner:
+    """
+    Background thread that feeds queued pdf_jobs rows to a PdfRenderer
+    At most `concurrency` jobs are in the pool at once, which leaves the
+    rest of the pool's pending slots for synchronous downloads. Jobs are
+    claimed from SQLite, so they survive restarts and several processes
+    can share one queue.
+    """
+
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, renderer=pdf_renderer, concurrency=PDF_JOB_CONCURRENCY,
+                 poll_interval=PDF_JOB_POLL_INTERVAL, retention_days=PDF_JOB_RETENTION_DAYS):
+        self.renderer = renderer
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.retention_days = retention_days
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._active = 0
+        self._held = set()  # Claimed job ids whose lease this process renews
+        self._last_prune = 0.0
+        self._stats = {'claimed': 0, 'done': 0, 'failed': 0, 'requeued': 0}
+
+    def start(self):
+        """Start the runner thread"""
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='pdf-job-runner', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop claiming jobs and wait for the ones already in the pool"""
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        self.renderer.shutdown()
+
+    def notify(self):
+        """Wake the runner after a job was queued in this process"""
+        self._wake.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, active=self._active, concurrency=self.concurrency)
+
+    def _run(self):
+        # Waits first, so a fresh install has its schema before the first poll
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            if self._stopping:
+                return
+            try:
+                with self._lock:
+                    held = list(self._held)
+                db.renew_pdf_job_leases(held)
+                self._dispatch()
+                if time.monotonic() - self._last_prune > self.PRUNE_INTERVAL:
+                    db.prune_pdf_jobs(self.retention_days)
+                    self._last_prune = time.monotonic()
+            except Exception as e:
+                print(f"PDF job runner error: {str(e)}")
+
+    def _dispatch(self):
+        with self._lock:
+            free = self.concurrency - self._active
+        if free <= 0:
+            return
+
+        # Leases are renewed every poll, so one unrenewed for two render
+        # timeouts belongs to a dead process, not a job waiting in our pool
+        jobs = db.claim_pdf_jobs(free, stale_after=max(self.renderer.timeout, self.poll_interval) * 2)
+        for index, job in enumerate(jobs):
+            try:
+                future = self.renderer.submit(job['html'], job['cache_key'])
+            except PdfRendererBusy:
+                # Synchronous downloads took the free slots; try again later
+                for waiting in jobs[index:]:
+                    db.requeue_pdf_job(waiting['id'])
+                self._count('requeued', len(jobs) - index)
+                return
+            with self._lock:
+                self._active += 1
+                self._held.add(job['id'])
+                self._stats['claimed'] += 1
+            future.add_done_callback(lambda f, job_id=job['id']: self._finished(job_id, f))
+
+    def _finished(self, job_id, future):
+        error = future.exception()
+        try:
+            db.finish_pdf_job(job_id, str(error) if error else None)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._held.discard(job_id)
+                self._stats['failed' if error else 'done'] += 1
+            self._wake.set()
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+
+pdf_job_runner = PdfJobRunner()
+
+
+def init_app(app):
+    """Start the PDF job runner for this process"""
+    if PDF_JOBS_ENABLED:
+        pdf_job_runner.start()
+        atexit.register(pdf_job_runner.stop)
@@ -5,6 +5,7 @@ Contains weak access control and privilege escalation vulnerabilities
 
 from flask import Blueprint, render_template, request, session, redirect, url_for, jsonify
 import database as db
+from pdf_renderer import pdf_renderer, pdf_job_runner
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -44,25 +45,14 @@ def panel():
     if redirect_check:
         return redirect_check
 
-    # Get system statistics
-    all_users = db.get_all_users()
-    all_invoices = db.get_all_invoices()
-
-    total_revenue = sum([inv['total'] for inv in all_invoices if inv['status'] == 'paid'])
-    pending_revenue = sum([inv['total'] for inv in all_invoices if inv['status'] in ['sent', 'draft']])
-
-    stats = {
-        'total_users': len(all_users),
-        'total_invoices': len(all_invoices),
-        'total_revenue': total_revenue,
-        'pending_revenue': pending_revenue
-    }
+    # Get system statistics (SQL aggregates, cached)
+    stats = db.get_system_stats()
+    recent_invoices, _ = db.get_all_invoices_page(limit=10)
 
     # Vulnerability #23: Sensitive information will be in HTML comments
     return render_template('admin/panel.html',
                           stats=stats,
-                          users=all_users,
-                          recent_invoices=all_invoices[:10])
+                          recent_invoices=recent_invoices)
 
 
 @admin_bp.route('/users')
@@ -167,6 +157,8 @@ def delete_user(user_id):
         cursor.execute("DELETE FROM users WHERE id=?", (user_id,))
         conn.commit()
         conn.close()
+        db.stats_cache.invalidate()
+        db.identity_map_discard('users', user_id)
 
         db.log_activity(session['user_id'], 'admin_delete', 'user', user_id,
                        request.remote_addr, f'Admin deleted user {user["username"]}')
@@ -174,6 +166,25 @@ def delete_user(user_id):
     return redirect(url_for('admin.users'))
 
 
+@admin_bp.route('/api-key/<int:key_id>/revoke', methods=['POST'])
+def revoke_api_key(key_id):
+    """
+    Revoke an API key (takes effect immediately in this process)
+    Vulnerability #7: No CSRF protection
+    """
+    redirect_check = require_admin()
+    if redirect_check:
+        return redirect_check
+
+    if not db.revoke_api_key(key_id):
+        return jsonify({'error': 'API key not found'}), 404
+
+    db.log_activity(session['user_id'], 'admin_revoke', 'api_key', key_id,
+                   request.remote_addr, f'Admin revoked API key {key_id}')
+
+    return jsonify({'success': True, 'key_id': key_id})
+
+
 @admin_bp.route('/invoices')
 def invoices():
     """Admin view of all invoices"""
@@ -181,8 +192,14 @@ def invoices():
     if redirect_check:
         return redirect_check
 
-    all_invoices = db.get_all_invoices()
-    return render_template('admin/invoices.html', invoices=all_invoices)
+    cursor = request.args.get('cursor')
+    try:
+        page, next_cursor = db.get_all_invoices_page(cursor=cursor)
+    except ValueError:
+        return "Invalid cursor", 400
+
+    return render_template('admin/invoices.html', invoices=page,
+                           cursor=cursor, next_cursor=next_cursor)
 
 
 @admin_bp.route('/logs')
@@ -195,19 +212,24 @@ def logs():
     if redirect_check:
         return redirect_check
 
-    conn = db.get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT al.*, u.username
-        FROM activity_log al
-        LEFT JOIN users u ON al.user_id = u.id
-        ORDER BY al.created_at DESC
-        LIMIT 100
-    """)
-    logs = cursor.fetchall()
-    conn.close()
+    filters = {
+        'user_id': request.args.get('user_id', type=int),
+        'action': request.args.get('action', '').strip() or None,
+        'since': request.args.get('since', '').strip() or None,
+        'until': request.args.get('until', '').strip() or None,
+    }
+    cursor = request.args.get('cursor')
+
+    try:
+        logs, next_cursor = db.get_activity_logs_page(cursor=cursor, **filters)
+    except ValueError:
+        return "Invalid cursor", 400
+
+    # Query string for pagination links keeps the active filters
+    active_filters = {key: value for key, value in filters.items() if value is not None}
 
-    return render_template('admin/logs.html', logs=[dict(log) for log in logs])
+    return render_template('admin/logs.html', logs=logs, filters=active_filters,
+                           cursor=cursor, next_cursor=next_cursor)
 
 
 @admin_bp.route('/debug-info')
@@ -229,6 +251,11 @@ def debug_info():
         'python_version': sys.version,
         'platform': platform.platform(),
         'database_path': config.DATABASE_PATH,
+        'database_pragmas': db.get_pragma_report(),
+        'activity_log_writer': db.activity_log_writer.stats(),
+        'api_key_cache': db.api_key_cache.stats(),
+        'pdf_renderer': pdf_renderer.stats(),
+        'pdf_jobs': dict(pdf_job_runner.stats(), queued=db.count_pdf_jobs('queued')),
         'upload_folder': config.UPLOAD_FOLDER,
         'secret_key': config.SECRET_KEY,  # Vulnerability: Exposes secret key!
         'debug_mode': config.DEBUG,
@@ -269,6 +296,7 @@ def sql_console():
                 result = [dict(row) for row in cursor.fetchall()]
             else:
                 conn.commit()
+                db.identity_map_discard(None)
                 result = f"Query executed. Rows affected: {cursor.rowcount}"
 
             conn.close()
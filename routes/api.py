@@ -1,12 +1,18 @@
 """
 API routes for InvoiceFlow
-Contains XXE, Missing Authentication, and other API vulnerabilities
+Contains Missing Authentication, and other API vulnerabilities
 """
 
-from flask import Blueprint, request, jsonify, session
-import xml.etree.ElementTree as ET
+from flask import Blueprint, request, jsonify, session, Response, current_app
+from werkzeug.wsgi import get_input_stream
+from xml.parsers import expat
+from datetime import date
 import json
+import tempfile
+import time
 import database as db
+from routes.caching import not_modified, with_etag
+from models.invoice_batch import DATE_BUCKETS
 import config
 
 api_bp = Blueprint('api', __name__)
@@ -26,19 +32,51 @@ def require_api_auth():
     if not api_key:
         return jsonify({'error': 'API key required'}), 401
 
-    # Validate API key (not implemented properly)
-    conn = db.get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM api_keys WHERE api_key=? AND is_active=1", (api_key,))
-    key_record = cursor.fetchone()
-    conn.close()
-
+    # Validate API key (cached for API_KEY_CACHE_TTL seconds)
+    key_record = db.get_active_api_key(api_key)
     if not key_record:
         return jsonify({'error': 'Invalid API key'}), 401
 
+    db.api_key_usage.record(key_record['id'])
     return None
 
 
+def get_page_limit():
+    """Read ?limit= from the request, clamped to 1..MAX_PAGE_SIZE"""
+    limit = request.args.get('limit', config.INVOICE_PAGE_SIZE, type=int)
+    return max(1, min(limit, config.MAX_PAGE_SIZE))
+
+
+def wants_ndjson():
+    """Client asked for newline-delimited JSON (?format=ndjson or Accept header)"""
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best == 'application/x-ndjson'
+
+
+def stream_json_rows(key, rows):
+    """
+    Stream rows as {"success": true, "<key>": [...], "count": N}
+    or as NDJSON (one object per line) when the client asks for it.
+    Rows are encoded one at a time, so memory stays flat.
+    """
+    if wants_ndjson():
+        def generate_ndjson():
+            for row in rows:
+                yield json.dumps(row, default=str, sort_keys=True) + '\n'
+        return Response(generate_ndjson(), mimetype='application/x-ndjson')
+
+    def generate():
+        count = 0
+        yield f'{{"success": true, "{key}": ['
+        for row in rows:
+            yield (',' if count else '') + json.dumps(row, default=str, sort_keys=True)
+            count += 1
+        yield f'], "count": {count}}}'
+
+    return Response(generate(), mimetype='application/json')
+
+
 @api_bp.route('/invoices/list', methods=['GET'])
 def api_list_invoices():
     """
@@ -51,14 +89,68 @@ def api_list_invoices():
     if auth_check:
         return auth_check
 
+    paged = 'cursor' in request.args or 'limit' in request.args
+    etag = db.get_invoices_collection_etag(
+        None, 'ndjson' if wants_ndjson() else 'json',
+        request.args.get('cursor') if paged else 'all', get_page_limit() if paged else None)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    # Without paging parameters the full list is streamed straight from the cursor
+    if not paged:
+        return with_etag(stream_json_rows('invoices', db.iter_all_invoices()), etag)
+
     # Vulnerability: No user isolation - can see all invoices
-    all_invoices = db.get_all_invoices()
+    try:
+        invoices, next_cursor = db.get_all_invoices_page(
+            cursor=request.args.get('cursor'), limit=get_page_limit())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    return jsonify({
+    return with_etag(jsonify({
         'success': True,
-        'count': len(all_invoices),
-        'invoices': all_invoices
-    })
+        'count': len(invoices),
+        'invoices': invoices,
+        'next_cursor': next_cursor
+    }), etag)
+
+
+@api_bp.route('/invoices/export', methods=['GET'])
+def api_export_invoices():
+    """
+    Export invoices with their company and line items as CSV or NDJSON
+    Filters: ?from=&to= (invoice_date, inclusive), ?status=paid,sent, ?user_id=, ?company_id=
+    Rows are streamed from one ordered join, so memory stays flat.
+    Vulnerability #13: Missing authentication
+    """
+    auth_check = require_api_auth()
+    if auth_check:
+        return auth_check
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in db.EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of {', '.join(db.EXPORT_FORMATS)}"}), 400
+
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    try:
+        for value in (date_from, date_to):
+            if value:
+                date.fromisoformat(value)
+    except ValueError:
+        return jsonify({'error': 'from and to must be YYYY-MM-DD dates'}), 400
+
+    statuses = [s for s in request.args.get('status', '').split(',') if s]
+
+    # Vulnerability: No user isolation - exports every user's invoices by default
+    rows = db.iter_invoice_export(date_from, date_to, statuses,
+                                  request.args.get('user_id', type=int),
+                                  request.args.get('company_id', type=int))
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(db.iter_export_lines(rows, fmt), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=invoices.{fmt}'
+    return response
 
 
 @api_bp.route('/invoices/<int:invoice_id>', methods=['GET'])
@@ -73,6 +165,14 @@ def api_get_invoice(invoice_id):
     if auth_check:
         return auth_check
 
+    # Conditional GET: answer 304 from a single version lookup
+    etag = db.get_invoice_etag(invoice_id, 'json')
+    if etag is None:
+        return jsonify({'error': 'Invoice not found'}), 404
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
     # Vulnerability #4: IDOR - no ownership check
     invoice = db.get_invoice(invoice_id)
 
@@ -81,11 +181,11 @@ def api_get_invoice(invoice_id):
 
     items = db.get_invoice_items(invoice_id)
 
-    return jsonify({
+    return with_etag(jsonify({
         'success': True,
         'invoice': invoice,
         'items': items
-    })
+    }), etag)
 
 
 @api_bp.route('/invoices/create', methods=['POST'])
@@ -103,84 +203,259 @@ def api_create_invoice():
 
     # Vulnerability #3: No validation of input data
     try:
-        invoice_id = db.create_invoice(
-            data.get('user_id'),
-            data.get('company_id'),
-            data.get('invoice_number'),
-            data.get('invoice_date'),
-            data.get('due_date'),
-            data.get('status', 'draft'),
-            data.get('subtotal', 0),
-            data.get('tax_rate', 0),
-            data.get('tax_amount', 0),
-            data.get('discount', 0),
-            data.get('total', 0),
-            data.get('notes', ''),
-            data.get('terms', '')
+        if not data.get('invoice_number'):
+            data['invoice_number'] = db.allocate_invoice_numbers()[0]
+
+        # Header, items and activity log are written in one transaction
+        invoice_id = db.create_invoice_with_items(
+            *db.invoice_values_from_dict(data),
+            items=db.invoice_items_from_dict(data),
+            ip_address=request.remote_addr,
+            log_details=f"Created invoice {data.get('invoice_number')} via API"
         )
 
-        # Add items
-        for item in data.get('items', []):
-            db.add_invoice_item(
-                invoice_id,
-                item.get('description', ''),
-                item.get('quantity', 1),
-                item.get('unit_price', 0),
-                item.get('amount', 0),
-                item.get('sort_order', 0)
-            )
-
         return jsonify({
             'success': True,
-            'invoice_id': invoice_id
+            'invoice_id': invoice_id,
+            'invoice_number': data['invoice_number']
         })
     except Exception as e:
         # Vulnerability #17: Verbose error
         return jsonify({'error': str(e)}), 500
 
 
+def read_ndjson(stream):
+    """Yield (line_number, record_or_error) for each non-blank line of an NDJSON stream"""
+    for line_no, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, ValueError(f'Invalid JSON: {str(e)}')
+            continue
+        if not isinstance(record, dict):
+            yield line_no, ValueError('Record must be a JSON object')
+            continue
+        yield line_no, record
+
+
+@api_bp.route('/invoices/bulk', methods=['POST'])
+def api_bulk_create_invoices():
+    """
+    Bulk invoice ingestion from a streamed NDJSON body (one invoice per line,
+    same shape as /invoices/create). Records are inserted in transactions of
+    ?batch_size= records. The response is NDJSON: one result per record,
+    then a summary line. Results are spooled to a temp file, so memory stays
+    flat however large the upload is.
+    Vulnerability #13: Missing authentication
+    Vulnerability #3: No input validation
+    """
+    auth_check = require_api_auth()
+    if auth_check:
+        return auth_check
+
+    batch_size = request.args.get('batch_size', config.BULK_IMPORT_BATCH_SIZE, type=int)
+    batch_size = max(1, min(batch_size, config.BULK_IMPORT_MAX_BATCH_SIZE))
+
+    # Bypass MAX_CONTENT_LENGTH: uploads here are read incrementally
+    stream = get_input_stream(request.environ, max_content_length=config.BULK_IMPORT_MAX_BYTES)
+
+    results = tempfile.TemporaryFile(mode='w+')
+    counts = {'created': 0, 'duplicate': 0, 'error': 0}
+    start = time.perf_counter()
+
+    def write_results(batch_results):
+        for result in batch_results:
+            result['line'] = result.pop('ref')
+            counts[result['status']] += 1
+            results.write(json.dumps(result, sort_keys=True) + '\n')
+
+    batch = []
+    try:
+        for line_no, record in read_ndjson(stream):
+            if isinstance(record, Exception):
+                write_results([{'ref': line_no, 'status': 'error', 'error': str(record)}])
+                continue
+            batch.append((line_no, record))
+            if len(batch) >= batch_size:
+                write_results(db.insert_invoice_batch(batch))
+                batch = []
+        if batch:
+            write_results(db.insert_invoice_batch(batch))
+    except Exception:
+        results.close()
+        raise
+
+    summary = dict(counts, records=sum(counts.values()), batch_size=batch_size,
+                   seconds=round(time.perf_counter() - start, 3))
+    db.log_activity(None, 'bulk_import', 'invoice', None, request.remote_addr,
+                    f"Bulk imported {counts['created']} invoices "
+                    f"({counts['duplicate']} duplicates, {counts['error']} errors)")
+
+    def generate():
+        try:
+            results.seek(0)
+            for line in results:
+                yield line
+            yield json.dumps({'summary': summary}, sort_keys=True) + '\n'
+        finally:
+            results.close()
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@api_bp.route('/invoices/reserve-numbers', methods=['POST'])
+def api_reserve_invoice_numbers():
+    """
+    Reserve a block of invoice numbers in one call (for bulk imports)
+    Vulnerability #13: Missing authentication
+    """
+    auth_check = require_api_auth()
+    if auth_check:
+        return auth_check
+
+    data = request.get_json(silent=True) or {}
+
+    try:
+        count = int(data.get('count', 1))
+        year = int(data['year']) if data.get('year') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'count and year must be integers'}), 400
+
+    if not 1 <= count <= config.INVOICE_NUMBER_BLOCK_MAX:
+        return jsonify({'error': f'count must be between 1 and {config.INVOICE_NUMBER_BLOCK_MAX}'}), 400
+
+    numbers = db.allocate_invoice_numbers(count, year)
+
+    return jsonify({
+        'success': True,
+        'count': len(numbers),
+        'invoice_numbers': numbers
+    })
+
+
+XML_INVOICE_FIELDS = ('user_id', 'invoice_number', 'invoice_date', 'total')
+
+
+def iter_xml_invoices(stream, chunk_size=None):
+    """
+    Yield one dict of field text per <invoice> child of the root element.
+    The body is fed to expat in chunks and only the current invoice is kept,
+    so memory does not grow with the document. DOCTYPE and entity
+    declarations are rejected outright, so no external entity is resolved.
+    """
+    chunk_size = chunk_size or config.XML_IMPORT_CHUNK_SIZE
+    parser = expat.ParserCreate()
+    parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_NEVER)
+
+    completed = []
+    state = {'depth': 0, 'invoice': None, 'field': None, 'text': []}
+
+    def forbid_dtd(*args):
+        raise ValueError('DOCTYPE and entity declarations are not allowed')
+
+    def start_element(name, attrs):
+        state['depth'] += 1
+        if state['depth'] == 2 and name == 'invoice':
+            state['invoice'] = {}
+        elif state['depth'] == 3 and state['invoice'] is not None and name in XML_INVOICE_FIELDS:
+            state['field'] = name
+            state['text'] = []
+
+    def end_element(name):
+        if state['depth'] == 3 and state['field']:
+            # First occurrence wins, like Element.find()
+            state['invoice'].setdefault(state['field'], ''.join(state['text']))
+            state['field'] = None
+        elif state['depth'] == 2 and state['invoice'] is not None:
+            completed.append(state['invoice'])
+            state['invoice'] = None
+        state['depth'] -= 1
+
+    def character_data(data):
+        if state['field']:
+            state['text'].append(data)
+
+    parser.StartDoctypeDeclHandler = forbid_dtd
+    parser.EntityDeclHandler = forbid_dtd
+    parser.ExternalEntityRefHandler = forbid_dtd
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    while True:
+        chunk = stream.read(chunk_size)
+        parser.Parse(chunk, not chunk)
+        yield from completed
+        completed.clear()
+        if not chunk:
+            break
+
+
 @api_bp.route('/invoices/import-xml', methods=['POST'])
 def api_import_xml():
     """
-    Import invoices from XML
-    Vulnerability #11: XXE (XML External Entity) Injection
+    Import invoices from a streamed XML body
+    Invoices are inserted in transactions of ?batch_size= rows, so a failure
+    keeps the batches already committed and reports how far the import got.
     """
     auth_check = require_api_auth()
     if auth_check:
         return auth_check
 
-    xml_data = request.data.decode('utf-8')
+    batch_size = request.args.get('batch_size', config.XML_IMPORT_BATCH_SIZE, type=int)
+    batch_size = max(1, min(batch_size, config.BULK_IMPORT_MAX_BATCH_SIZE))
 
-    try:
-        # Vulnerability #11: XXE - XML parser without entity expansion disabled
-        # This allows attackers to read local files, perform SSRF, etc.
-        parser = ET.XMLParser()  # Default parser is vulnerable
-        root = ET.fromstring(xml_data, parser=parser)
-
-        invoices_imported = 0
-
-        # Parse XML and create invoices
-        for invoice_elem in root.findall('invoice'):
-            user_id = invoice_elem.find('user_id').text if invoice_elem.find('user_id') is not None else None
-            invoice_number = invoice_elem.find('invoice_number').text if invoice_elem.find('invoice_number') is not None else ''
-            invoice_date = invoice_elem.find('invoice_date').text if invoice_elem.find('invoice_date') is not None else ''
-            total = float(invoice_elem.find('total').text) if invoice_elem.find('total') is not None else 0
-
-            if user_id and invoice_number:
-                invoice_id = db.create_invoice(
-                    int(user_id), None, invoice_number, invoice_date, None,
+    # Bypass MAX_CONTENT_LENGTH: the body is parsed incrementally
+    stream = get_input_stream(request.environ, max_content_length=config.BULK_IMPORT_MAX_BYTES)
+
+    stats = {'imported': 0, 'skipped': 0, 'batches': 0}
+    start = time.perf_counter()
+
+    def progress():
+        seconds = time.perf_counter() - start
+        return dict(stats, seconds=round(seconds, 3),
+                    rows_per_second=round(stats['imported'] / seconds, 1) if seconds else 0)
+
+    def insert_batch(batch):
+        with db.UnitOfWork() as uow:
+            for user_id, invoice_number, invoice_date, total in batch:
+                invoice_id = uow.add_invoice(
+                    user_id, None, invoice_number, invoice_date, None,
                     'draft', total, 0, 0, 0, total, '', ''
                 )
-                invoices_imported += 1
+                uow.log_activity(user_id, 'import', 'invoice', invoice_id,
+                                 request.remote_addr, f'Imported invoice {invoice_number} from XML')
+        stats['imported'] += len(batch)
+        stats['batches'] += 1
+        report = progress()
+        current_app.logger.info("XML import: %s invoices in %ss (%s rows/s)",
+                                report['imported'], report['seconds'], report['rows_per_second'])
 
-        return jsonify({
-            'success': True,
-            'imported': invoices_imported
-        })
+    try:
+        batch = []
+        for invoice in iter_xml_invoices(stream):
+            user_id = invoice.get('user_id')
+            invoice_number = invoice.get('invoice_number', '')
+            if not (user_id and invoice_number):
+                stats['skipped'] += 1
+                continue
+
+            total = float(invoice['total']) if 'total' in invoice else 0
+            batch.append((int(user_id), invoice_number, invoice.get('invoice_date', ''), total))
+            if len(batch) >= batch_size:
+                insert_batch(batch)
+                batch = []
+        if batch:
+            insert_batch(batch)
 
     except Exception as e:
         # Vulnerability #17: Verbose error
-        return jsonify({'error': f'XML parsing error: {str(e)}'}), 400
+        return jsonify(dict(progress(), error=f'XML import error: {str(e)}')), 400
+
+    return jsonify(dict(progress(), success=True))
 
 
 @api_bp.route('/users/list', methods=['GET'])
@@ -194,14 +469,8 @@ def api_list_users():
     if auth_check:
         return auth_check
 
-    users = db.get_all_users()
-
     # Vulnerability #25: Returns plaintext passwords
-    return jsonify({
-        'success': True,
-        'count': len(users),
-        'users': users  # Includes plaintext passwords!
-    })
+    return stream_json_rows('users', db.iter_all_users())  # Includes plaintext passwords!
 
 
 @api_bp.route('/users/<int:user_id>', methods=['GET'])
@@ -240,6 +509,15 @@ def api_search():
     search_term = request.args.get('q', '')
     search_type = request.args.get('type', 'invoices')
 
+    # Invoice search goes through the FTS5 index unless the legacy LIKE path is requested
+    if search_type == 'invoices' and request.args.get('mode') != 'like':
+        results = db.search_invoices_fts(None, search_term, limit=get_page_limit())
+        return jsonify({
+            'success': True,
+            'count': len(results),
+            'results': results
+        })
+
     # Vulnerability #1: SQL Injection
     conn = db.get_db_connection()
     cursor = conn.cursor()
@@ -279,34 +557,68 @@ def api_stats():
     if auth_check:
         return auth_check
 
-    conn = db.get_db_connection()
-    cursor = conn.cursor()
-
-    # Get various statistics
-    cursor.execute("SELECT COUNT(*) as count FROM users")
-    total_users = cursor.fetchone()['count']
-
-    cursor.execute("SELECT COUNT(*) as count FROM invoices")
-    total_invoices = cursor.fetchone()['count']
-
-    cursor.execute("SELECT SUM(total) as revenue FROM invoices WHERE status='paid'")
-    total_revenue = cursor.fetchone()['revenue'] or 0
-
-    conn.close()
+    # Served from the aggregate cache (invalidated by writes, TTL fallback)
+    stats = db.get_system_stats()
 
     # Vulnerability #23: Exposes internal system information
     return jsonify({
         'success': True,
         'stats': {
-            'total_users': total_users,
-            'total_invoices': total_invoices,
-            'total_revenue': total_revenue,
+            'total_users': stats['total_users'],
+            'total_invoices': stats['total_invoices'],
+            'total_revenue': stats['total_revenue'],
             'database_path': config.DATABASE_PATH,  # Sensitive info!
             'debug_mode': config.DEBUG
         }
     })
 
 
+@api_bp.route('/stats/invoices', methods=['GET'])
+def api_invoice_analytics():
+    """
+    Invoice totals grouped by status, company and date bucket
+    Filters as /invoices/export, plus ?bucket=day|week|month|year. The
+    matching invoices are loaded into a columnar InvoiceBatch and
+    aggregated over whole columns.
+    Vulnerability #13: Missing authentication
+    """
+    auth_check = require_api_auth()
+    if auth_check:
+        return auth_check
+
+    bucket = request.args.get('bucket', 'month')
+    if bucket not in DATE_BUCKETS:
+        return jsonify({'error': f"bucket must be one of {', '.join(DATE_BUCKETS)}"}), 400
+
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    try:
+        for value in (date_from, date_to):
+            if value:
+                date.fromisoformat(value)
+    except ValueError:
+        return jsonify({'error': 'from and to must be YYYY-MM-DD dates'}), 400
+
+    statuses = [s for s in request.args.get('status', '').split(',') if s]
+
+    started = time.perf_counter()
+    # Vulnerability: No user isolation - aggregates every user's invoices by default
+    batch = db.load_invoice_batch(date_from, date_to, statuses,
+                                  request.args.get('user_id', type=int),
+                                  request.args.get('company_id', type=int))
+    loaded = time.perf_counter()
+    summary = batch.summary(bucket)
+    finished = time.perf_counter()
+
+    return jsonify({
+        'success': True,
+        'backend': batch.backend,
+        'load_ms': round((loaded - started) * 1000, 2),
+        'aggregate_ms': round((finished - loaded) * 1000, 2),
+        **summary
+    })
+
+
 @api_bp.route('/health', methods=['GET'])
 def api_health():
     """
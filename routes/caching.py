@@ -0,0 +1,29 @@
+"""
+Conditional GET helpers shared by the blueprints
+ETags themselves come from database.get_invoice_etag() and friends.
+"""
+
+from flask import request, make_response, Response
+
+
+def not_modified(etag):
+    """304 response if the client's If-None-Match already holds this ETag"""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def with_etag(body, etag, private=False):
+    """
+    Attach a strong ETag and ask clients to revalidate before reuse
+    `body` is anything make_response() accepts. Pages that differ per viewer
+    pass private=True so shared caches do not store them.
+    """
+    response = make_response(body)
+    response.set_etag(etag)
+    if private:
+        response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -1,12 +1,18 @@
 """
 Invoice management routes for InvoiceFlow
-Contains IDOR, XSS, Command Injection, Path Traversal, and other vulnerabilities
+Contains IDOR, XSS, Path Traversal, and other vulnerabilities
 """
 
-from flask import Blueprint, render_template, request, session, redirect, url_for, send_file, jsonify, flash
+from flask import Blueprint, current_app, render_template, request, session, redirect, url_for, send_file, jsonify, flash, Response, stream_with_context
 import os
+import re
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 import database as db
+from routes.caching import not_modified, with_etag
 import config
+from attachment_store import attachment_store
+from pdf_renderer import (pdf_renderer, pdf_job_runner, html_cache_key, iter_pdf_zip,
+                          PdfRenderError, PdfRendererBusy)
 from datetime import datetime, timedelta
 
 invoice_bp = Blueprint('invoice', __name__)
@@ -36,14 +42,31 @@ def list_invoices():
     # Vulnerability #16: Reflected XSS in search
     search_term = request.args.get('search', '')
 
+    cursor = request.args.get('cursor')
+    next_cursor = None
+
+    etag = None
+
     if search_term:
-        # Vulnerability: SQL Injection in search
-        invoices = db.search_invoices(user_id, search_term)
+        if request.args.get('mode') == 'like':
+            # Vulnerability: SQL Injection in legacy LIKE search
+            invoices = db.search_invoices(user_id, search_term)
+        else:
+            invoices = db.search_invoices_fts(user_id, search_term)
     else:
-        invoices = db.get_invoices_by_user(user_id)
+        etag = db.get_invoices_collection_etag(user_id, 'html', cursor)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        try:
+            invoices, next_cursor = db.get_invoices_by_user_page(user_id, cursor=cursor)
+        except ValueError:
+            return "Invalid cursor", 400
 
     # Vulnerability #16: search_term not escaped in template
-    return render_template('invoice/list.html', invoices=invoices, search_term=search_term)
+    page = render_template('invoice/list.html', invoices=invoices, search_term=search_term,
+                           cursor=cursor, next_cursor=next_cursor)
+    return with_etag(page, etag, private=True) if etag else page
 
 
 @invoice_bp.route('/view', methods=['GET', 'POST'])
@@ -76,6 +99,15 @@ def view_invoice():
     except ValueError:
         return "Invalid invoice ID", 400
 
+    # Revalidation: the page only changes when the invoice or its items do
+    # (the viewer is part of the tag since the layout shows their session)
+    etag = db.get_invoice_etag(invoice_id, 'html', session['user_id'])
+    if etag is None:
+        return "Invoice not found", 404
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
     invoice = db.get_invoice(invoice_id)
 
     if not invoice:
@@ -87,10 +119,10 @@ def view_invoice():
         company = db.get_company(invoice['company_id'])
 
     # Vulnerability #6: Stored XSS in invoice.notes rendered without escaping
-    return render_template('invoice/view.html',
-                          invoice=invoice,
-                          items=items,
-                          company=company)
+    return with_etag(render_template('invoice/view.html',
+                                     invoice=invoice,
+                                     items=items,
+                                     company=company), etag, private=True)
 
 
 @invoice_bp.route('/create', methods=['GET', 'POST'])
@@ -141,27 +173,26 @@ def create_invoice():
         total = subtotal + tax_amount - discount
 
         # Generate invoice number (predictable pattern)
-        invoice_number = f"INV-{datetime.now().year}-{db.get_db_connection().execute('SELECT COUNT(*) + 1 FROM invoices').fetchone()[0]:03d}"
+        invoice_number = db.allocate_invoice_numbers()[0]
 
-        # Create invoice
-        invoice_id = db.create_invoice(
-            user_id, company_id, invoice_number, invoice_date, due_date,
-            'draft', subtotal, tax_rate, tax_amount, discount, total, notes, terms
-        )
-
-        # Add line items
+        # Collect line items
+        items = []
         for i, desc in enumerate(descriptions):
             if desc.strip():
                 try:
                     qty = float(quantities[i])
                     price = float(unit_prices[i])
-                    amount = qty * price
-                    db.add_invoice_item(invoice_id, desc, qty, price, amount, i)
+                    items.append((desc, qty, price, qty * price, i))
                 except:
                     pass
 
-        db.log_activity(user_id, 'create', 'invoice', invoice_id,
-                       request.remote_addr, f'Created invoice {invoice_number}')
+        # Create invoice, items and activity log entry in one transaction
+        invoice_id = db.create_invoice_with_items(
+            user_id, company_id, invoice_number, invoice_date, due_date,
+            'draft', subtotal, tax_rate, tax_amount, discount, total, notes, terms,
+            items=items, ip_address=request.remote_addr,
+            log_details=f'Created invoice {invoice_number}'
+        )
 
         return redirect(url_for('invoice.view_invoice', invoice_id=invoice_id))
 
@@ -206,6 +237,7 @@ def edit_invoice(invoice_id):
             discount = 0
 
         # Update line items
+        item_ids = request.form.getlist('item_id[]')
         descriptions = request.form.getlist('description[]')
         quantities = request.form.getlist('quantity[]')
         unit_prices = request.form.getlist('unit_price[]')
@@ -223,34 +255,35 @@ def edit_invoice(invoice_id):
         tax_amount = subtotal * (tax_rate / 100)
         total = subtotal + tax_amount - discount
 
-        # Update invoice
-        db.update_invoice(invoice_id,
-                         company_id=company_id,
-                         invoice_date=invoice_date,
-                         due_date=due_date,
-                         status=status,
-                         subtotal=subtotal,
-                         tax_rate=tax_rate,
-                         tax_amount=tax_amount,
-                         discount=discount,
-                         total=total,
-                         notes=notes,
-                         terms=terms)
-
-        # Delete old items and add new ones
-        db.delete_invoice_items(invoice_id)
+        # Collect submitted line items (item_id is empty for newly added rows)
+        items = []
         for i, desc in enumerate(descriptions):
             if desc.strip():
                 try:
                     qty = float(quantities[i])
                     price = float(unit_prices[i])
-                    amount = qty * price
-                    db.add_invoice_item(invoice_id, desc, qty, price, amount, i)
+                    item_id = item_ids[i] if i < len(item_ids) else None
+                    items.append((item_id, desc, qty, price, qty * price, i))
                 except:
                     pass
 
-        db.log_activity(user_id, 'update', 'invoice', invoice_id,
-                       request.remote_addr, f'Updated invoice {invoice["invoice_number"]}')
+        # Only the header fields and items that changed are written, in one transaction
+        header = {
+            'company_id': company_id,
+            'invoice_date': invoice_date,
+            'due_date': due_date,
+            'status': status,
+            'subtotal': subtotal,
+            'tax_rate': tax_rate,
+            'tax_amount': tax_amount,
+            'discount': discount,
+            'total': total,
+            'notes': notes,
+            'terms': terms
+        }
+        db.update_invoice_with_items(invoice_id, header, items,
+                                     user_id=user_id, ip_address=request.remote_addr,
+                                     log_details=f'Updated invoice {invoice["invoice_number"]}')
 
         return redirect(url_for('invoice.view_invoice', invoice_id=invoice_id))
 
@@ -290,7 +323,9 @@ def delete_invoice(invoice_id):
 def generate_pdf(invoice_id):
     """
     Generate PDF for invoice
-    Vulnerability #5: Command Injection via filename parameter (ADMIN ONLY)
+    Rendering goes through the PDF worker pool; an invoice whose rendered
+    HTML has not changed is served straight from the PDF cache.
+    With ?async=1 the render is queued and a job id is returned at once.
     Vulnerability #14: Requires privilege escalation to exploit
     """
     redirect_check = require_login()
@@ -310,7 +345,7 @@ def generate_pdf(invoice_id):
     items = db.get_invoice_items(invoice_id)
     company = db.get_company(invoice['company_id']) if invoice.get('company_id') else None
 
-    # Vulnerability #5: Command Injection via filename parameter
+    # Only used as the download name; the file itself lives in the cache
     filename = request.args.get('filename', f"invoice_{invoice_id}")
 
     # Generate HTML content
@@ -319,37 +354,172 @@ def generate_pdf(invoice_id):
                                    items=items,
                                    company=company)
 
-    # Write HTML to temp file
-    html_path = os.path.join(config.UPLOAD_FOLDER, f'temp_{invoice_id}.html')
-    with open(html_path, 'w') as f:
-        f.write(html_content)
+    if request.args.get('async') == '1':
+        return queue_pdf_job(invoice, html_content, filename)
 
-    # Vulnerability #5: Command Injection - unsanitized filename in shell command
-    pdf_path = os.path.join(config.UPLOAD_FOLDER, f'{filename}.pdf')
+    try:
+        pdf_file = pdf_renderer.open(html_content)
+    except PdfRendererBusy:
+        return "PDF renderer busy, try again shortly", 503
+    except PdfRenderError as e:
+        current_app.logger.warning("PDF generation failed for invoice %s: %s", invoice_id, e)
+        return "PDF generation failed", 500
 
-    # Using os.system instead of subprocess (dangerous!)
-    command = f'{config.WKHTMLTOPDF_PATH} {html_path} {pdf_path}'
-    os.system(command)
+    db.log_activity(session['user_id'], 'generate_pdf', 'invoice', invoice_id,
+                   request.remote_addr, f'Generated PDF for invoice {invoice["invoice_number"]}')
+    return send_file(pdf_file, mimetype='application/pdf', as_attachment=True,
+                     download_name=f'{filename}.pdf')
 
-    # Clean up temp HTML
+
+@invoice_bp.route('/generate-pdf-batch')
+def generate_pdf_batch():
+    """
+    Download the PDFs of every matching invoice as one streamed ZIP
+    Filters: ?company_id=, ?from=&to= (invoice_date, inclusive), ?status=paid,sent
+    PDFs are rendered in parallel by the worker pool (cached ones are
+    reused) and written to the response as each one finishes.
+    Vulnerability #4: IDOR - no ownership check (but requires admin)
+    """
+    redirect_check = require_login()
+    if redirect_check:
+        return redirect_check
+
+    if session.get('role') != 'admin':
+        flash('PDF generation is only available for administrator accounts. Please contact support.', 'warning')
+        return redirect(url_for('invoice.list_invoices')), 403
+
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
     try:
-        os.remove(html_path)
-    except:
-        pass
+        for value in (date_from, date_to):
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return "from and to must be YYYY-MM-DD dates", 400
+
+    statuses = [s for s in request.args.get('status', '').split(',') if s]
+    invoice_ids = db.get_invoice_ids(date_from, date_to, statuses,
+                                     company_id=request.args.get('company_id', type=int))
+    if not invoice_ids:
+        return "No invoices match the filter", 404
+    if len(invoice_ids) > config.PDF_BATCH_MAX_INVOICES:
+        return f"Too many invoices ({len(invoice_ids)}), at most {config.PDF_BATCH_MAX_INVOICES} per batch", 400
+
+    db.log_activity(session['user_id'], 'generate_pdf_batch', 'invoice', None,
+                   request.remote_addr, f'Generated PDF batch of {len(invoice_ids)} invoices')
+
+    def documents():
+        companies = {}
+        for invoice_id in invoice_ids:
+            invoice = db.get_invoice(invoice_id)
+            if not invoice:
+                continue
+            company_id = invoice.get('company_id')
+            if company_id and company_id not in companies:
+                companies[company_id] = db.get_company(company_id)
+            html_content = render_template('invoice/pdf_template.html',
+                                           invoice=invoice,
+                                           items=db.get_invoice_items(invoice_id),
+                                           company=companies.get(company_id))
+            name = re.sub(r'[^A-Za-z0-9._-]', '_', invoice['invoice_number'])
+            yield f'{name}.pdf', html_content
+
+    response = Response(stream_with_context(iter_pdf_zip(documents())), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=invoices.zip'
+    return response
+
+
+def pdf_job_response(job, status_code=200):
+    """JSON status for a PDF job, with a download URL once it is done"""
+    body = {
+        'success': job['status'] != 'failed',
+        'job_id': job['id'],
+        'invoice_id': job['invoice_id'],
+        'status': job['status'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'status_url': url_for('invoice.pdf_job_status', job_id=job['id'])
+    }
+    if job['status'] == 'done':
+        body['download_url'] = url_for('invoice.pdf_job_download', job_id=job['id'])
+    if job['error']:
+        body['error'] = job['error']
+    return jsonify(body), status_code
+
+
+def queue_pdf_job(invoice, html_content, filename):
+    """Queue an asynchronous render (or record a cache hit as already done)"""
+    cache_key = html_cache_key(html_content)
+    status = 'done' if pdf_renderer.cache.get(cache_key) else 'queued'
+
+    if status == 'queued' and db.count_pdf_jobs('queued') >= config.PDF_JOB_MAX_QUEUED:
+        return jsonify({'error': 'PDF job queue is full, try again later'}), 503
+
+    job_id = db.enqueue_pdf_job(invoice['id'], session['user_id'], html_content,
+                                cache_key, filename, status)
+    if status == 'queued':
+        pdf_job_runner.notify()
+
+    db.log_activity(session['user_id'], 'queue_pdf', 'invoice', invoice['id'],
+                   request.remote_addr, f'Queued PDF job {job_id} for invoice {invoice["invoice_number"]}')
+    return pdf_job_response(db.get_pdf_job(job_id), 202)
+
+
+@invoice_bp.route('/pdf-jobs/<int:job_id>')
+def pdf_job_status(job_id):
+    """Poll an asynchronous PDF job: queued, running, done or failed"""
+    redirect_check = require_login()
+    if redirect_check:
+        return redirect_check
+
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'PDF generation is only available for administrator accounts'}), 403
+
+    job = db.get_pdf_job(job_id)
+    if not job:
+        return jsonify({'error': 'PDF job not found'}), 404
+
+    return pdf_job_response(job)
+
+
+@invoice_bp.route('/pdf-jobs/<int:job_id>/download')
+def pdf_job_download(job_id):
+    """Download the PDF of a finished job"""
+    redirect_check = require_login()
+    if redirect_check:
+        return redirect_check
+
+    if session.get('role') != 'admin':
+        return jsonify({'error': 'PDF generation is only available for administrator accounts'}), 403
+
+    job = db.get_pdf_job(job_id)
+    if not job:
+        return jsonify({'error': 'PDF job not found'}), 404
 
-    if os.path.exists(pdf_path):
-        db.log_activity(session['user_id'], 'generate_pdf', 'invoice', invoice_id,
-                       request.remote_addr, f'Generated PDF for invoice {invoice["invoice_number"]}')
-        return send_file(pdf_path, as_attachment=True, download_name=f'{filename}.pdf')
+    if job['status'] == 'failed':
+        return pdf_job_response(job, 500)
+    if job['status'] != 'done':
+        return pdf_job_response(job, 202)
 
-    return "PDF generation failed", 500
+    pdf_path = pdf_renderer.cache.get(job['cache_key'])
+    if not pdf_path:
+        # Evicted from the PDF cache since the job finished: render it again
+        db.requeue_pdf_job(job_id)
+        pdf_job_runner.notify()
+        return pdf_job_response(db.get_pdf_job(job_id), 202)
+
+    filename = job['filename'] or f"invoice_{job['invoice_id']}"
+    return send_file(pdf_path, as_attachment=True, download_name=f'{filename}.pdf')
 
 
 @invoice_bp.route('/upload-attachment/<int:invoice_id>', methods=['POST'])
 def upload_attachment(invoice_id):
     """
     Upload attachment for invoice
-    Vulnerability #10: Path Traversal via filename
+    The file is streamed into the content-addressed attachment store, so
+    identical uploads share one blob and same-name uploads no longer
+    overwrite each other. The client's file name is kept for display only.
     """
     redirect_check = require_login()
     if redirect_check:
@@ -367,28 +537,63 @@ def upload_attachment(invoice_id):
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
 
-    # Vulnerability #10: Path Traversal - no sanitization of filename
-    # User can upload files like "../../etc/passwd" or "../../../app.py"
-    filename = file.filename
-    filepath = os.path.join(config.UPLOAD_FOLDER, filename)
-
     # Save file without validation
-    file.save(filepath)
-
-    # Update invoice with attachment path
-    db.update_invoice(invoice_id, attachment_path=filename)
+    filename = file.filename
+    sha256, size = attachment_store.save_stream(
+        file.stream,
+        lambda sha256, size, place: db.set_invoice_attachment(
+            invoice_id, sha256, size, filename, file.mimetype, session['user_id'], place=place))
 
     db.log_activity(session['user_id'], 'upload', 'invoice', invoice_id,
                    request.remote_addr, f'Uploaded attachment {filename}')
 
-    return jsonify({'success': True, 'filename': filename})
+    return jsonify({'success': True, 'filename': filename, 'sha256': sha256, 'size': size})
+
+
+def send_attachment(attachment):
+    """
+    Serve a stored attachment blob
+    The blob's SHA-256 is a strong ETag, so If-None-Match, Range and
+    If-Range are answered by send_file's conditional handling. Full
+    responses go through the server's wsgi.file_wrapper (sendfile where
+    the server supports it). With ATTACHMENT_SENDFILE_MODE set only the
+    headers are sent and the front proxy transfers the file itself.
+    """
+    filepath = attachment_store.path_for(attachment['sha256'])
+    mode = config.ATTACHMENT_SENDFILE_MODE
+
+    if mode in ('x-accel-redirect', 'x-sendfile'):
+        response = Response(mimetype=attachment['content_type'] or 'application/octet-stream')
+        response.headers.set('Content-Disposition', 'attachment', filename=attachment['filename'])
+        response.set_etag(attachment['sha256'])
+        if mode == 'x-accel-redirect':
+            relative = os.path.relpath(filepath, attachment_store.root).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = f"{config.ATTACHMENT_ACCEL_PREFIX.rstrip('/')}/{relative}"
+        else:
+            response.headers['X-Sendfile'] = filepath
+        return response
+
+    try:
+        response = send_file(filepath, mimetype=attachment['content_type'] or None,
+                             as_attachment=True, download_name=attachment['filename'],
+                             etag=attachment['sha256'], conditional=True,
+                             last_modified=datetime.strptime(attachment['created_at'], '%Y-%m-%d %H:%M:%S'))
+    except FileNotFoundError:
+        return "File not found", 404
+    except RequestedRangeNotSatisfiable as e:
+        # Answer 416 here; the app's catch-all error handler would turn it into a 500
+        return e.get_response()
+
+    # Advertise resumable downloads on full responses too
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
 
 
 @invoice_bp.route('/download-attachment/<int:invoice_id>')
 def download_attachment(invoice_id):
     """
     Download invoice attachment
-    Vulnerability #10: Path Traversal in file download
+    Vulnerability #10: Path Traversal in file download (legacy attachment_path files)
     """
     redirect_check = require_login()
     if redirect_check:
@@ -399,8 +604,13 @@ def download_attachment(invoice_id):
     if not invoice or not invoice.get('attachment_path'):
         return "Attachment not found", 404
 
+    attachment = db.get_invoice_attachment(invoice_id)
+    if attachment:
+        return send_attachment(attachment)
+
     # Vulnerability #10: Path Traversal
-    # If attachment_path is "../../../etc/passwd", this would serve it
+    # Attachments uploaded before the attachment store are still served from
+    # UPLOAD_FOLDER; if attachment_path is "../../../etc/passwd", this would serve it
     filepath = os.path.join(config.UPLOAD_FOLDER, invoice['attachment_path'])
 
     if os.path.exists(filepath):
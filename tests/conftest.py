@@ -0,0 +1,66 @@
+"""
+Shared fixtures for the InvoiceFlow tests
+Every test that uses the `database` fixture (directly or through `app`,
+`client`) gets a freshly seeded SQLite file under its own tmp_path.
+Background threads (async activity log, PDF job runner) are switched off
+before the application modules read their config.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import config
+
+_SCRATCH = tempfile.mkdtemp(prefix='invoiceflow-tests-')
+config.DATABASE_PATH = os.path.join(_SCRATCH, 'invoice.db')
+config.ACTIVITY_LOG_ASYNC = False
+config.PDF_JOBS_ENABLED = False
+config.ATTACHMENT_STORE_DIR = os.path.join(_SCRATCH, 'attachments')
+config.PDF_CACHE_DIR = os.path.join(_SCRATCH, 'pdf_cache')
+config.UPLOAD_FOLDER = os.path.join(_SCRATCH, 'uploads')
+
+import database as db
+from attachment_store import attachment_store
+
+ADMIN = ('admin', 'InvoiceFlow2024!Secure')
+JOHN = ('john', 'password123')
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """The database module, pointed at a new seeded database file"""
+    db.close_pool()
+    path = str(tmp_path / 'invoice.db')
+    monkeypatch.setattr(config, 'DATABASE_PATH', path)
+    monkeypatch.setattr(db, 'DATABASE_PATH', path)
+    monkeypatch.setattr(attachment_store, 'root', str(tmp_path / 'attachments'))
+    db.init_database()
+    db.stats_cache.invalidate()
+    db.api_key_cache.invalidate()
+    yield db
+    db.close_pool()
+
+
+@pytest.fixture
+def app(database):
+    from app import app as flask_app
+    flask_app.config['TESTING'] = True
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def login(client):
+    """login(username, password) for the test client; defaults to john"""
+    def login(username=JOHN[0], password=JOHN[1]):
+        return client.post('/login', data={'username': username, 'password': password})
+    return login
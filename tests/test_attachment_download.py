@@ -0,0 +1,88 @@
+import io
+import os
+
+import pytest
+
+import config
+from attachment_store import attachment_store
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def attachment(client, login):
+    """john logged in, with DATA attached to invoice 1; returns its sha256"""
+    login()
+    response = client.post('/invoice/upload-attachment/1',
+                           data={'file': (io.BytesIO(DATA), 'scan.pdf')},
+                           content_type='multipart/form-data')
+    return response.get_json()['sha256']
+
+
+def download(client, **headers):
+    return client.get('/invoice/download-attachment/1', headers=headers)
+
+
+def test_full_download(client, attachment):
+    response = download(client)
+
+    assert response.status_code == 200
+    assert response.data == DATA
+    assert response.headers['ETag'] == f'"{attachment}"'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert 'filename=scan.pdf' in response.headers['Content-Disposition']
+
+
+def test_if_none_match_answers_304(client, attachment):
+    assert download(client, **{'If-None-Match': f'"{attachment}"'}).status_code == 304
+
+
+def test_range_returns_partial_content(client, attachment):
+    response = download(client, Range='bytes=100-199')
+
+    assert response.status_code == 206
+    assert response.data == DATA[100:200]
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(DATA)}'
+
+
+def test_suffix_range(client, attachment):
+    response = download(client, Range='bytes=-10')
+
+    assert response.status_code == 206
+    assert response.data == DATA[-10:]
+
+
+def test_if_range_with_current_etag_resumes(client, attachment):
+    response = download(client, Range='bytes=1000-', **{'If-Range': f'"{attachment}"'})
+
+    assert response.status_code == 206
+    assert response.data == DATA[1000:]
+
+
+def test_if_range_with_stale_etag_sends_whole_file(client, attachment):
+    response = download(client, Range='bytes=1000-', **{'If-Range': '"0123abcd"'})
+
+    assert response.status_code == 200
+    assert response.data == DATA
+
+
+def test_unsatisfiable_range_is_416(client, attachment):
+    response = download(client, Range=f'bytes={len(DATA) + 10}-')
+
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(DATA)}'
+
+
+def test_missing_blob_is_404(client, attachment):
+    os.remove(attachment_store.path_for(attachment))
+
+    assert download(client).status_code == 404
+
+
+def test_x_accel_redirect_sends_headers_only(client, attachment, monkeypatch):
+    monkeypatch.setattr(config, 'ATTACHMENT_SENDFILE_MODE', 'x-accel-redirect')
+    response = download(client)
+
+    assert response.data == b''
+    assert response.headers['X-Accel-Redirect'] == \
+        f'/protected-attachments/{attachment[:2]}/{attachment[2:4]}/{attachment}'
@@ -0,0 +1,127 @@
+import io
+import os
+import threading
+import time
+
+from attachment_store import attachment_store
+
+PAST = time.time() - 7200
+
+
+def upload(client, invoice_id, data, filename='scan.pdf'):
+    return client.post(f'/invoice/upload-attachment/{invoice_id}',
+                       data={'file': (io.BytesIO(data), filename)},
+                       content_type='multipart/form-data')
+
+
+def blobs(db):
+    conn = db.get_pool().acquire()
+    try:
+        return {row['sha256']: row['ref_count']
+                for row in conn.execute("SELECT sha256, ref_count FROM attachment_blobs")}
+    finally:
+        conn.close()
+
+
+def expire(db, sha256):
+    """Age a blob past the GC grace period, both its row and its file"""
+    os.utime(attachment_store.path_for(sha256), (PAST, PAST))
+    conn = db.get_pool().acquire()
+    try:
+        conn.execute("UPDATE attachment_blobs SET updated_at=datetime('now', '-2 hours') WHERE sha256=?",
+                     (sha256,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def save(db, invoice_id, data):
+    return attachment_store.save_stream(
+        io.BytesIO(data),
+        lambda sha256, size, place: db.set_invoice_attachment(
+            invoice_id, sha256, size, 'scan.pdf', place=place))
+
+
+def test_identical_uploads_share_one_blob(client, login, database):
+    login()
+    first = upload(client, 1, b'same bytes').get_json()
+    second = upload(client, 2, b'same bytes').get_json()
+
+    assert first['sha256'] == second['sha256']
+    assert blobs(database) == {first['sha256']: 2}
+    assert attachment_store.exists(first['sha256'])
+    assert os.listdir(os.path.join(attachment_store.root, 'tmp')) == []
+
+
+def test_ref_count_follows_replace_and_delete(database):
+    old, _ = save(database, 1, b'old')
+    save(database, 2, b'old')
+    new, _ = save(database, 1, b'new')
+    assert blobs(database) == {old: 1, new: 1}
+
+    database.delete_invoice(2)
+    assert blobs(database) == {old: 0, new: 1}
+
+
+def test_gc_keeps_recent_and_referenced_blobs(database):
+    kept, _ = save(database, 1, b'referenced')
+    dropped, _ = save(database, 2, b'dropped')
+    database.delete_invoice(2)
+
+    assert attachment_store.collect_garbage(3600) == (0, 0)
+    assert attachment_store.exists(kept) and attachment_store.exists(dropped)
+
+
+def test_gc_removes_expired_unreferenced_blobs(database):
+    kept, _ = save(database, 1, b'referenced')
+    dropped, size = save(database, 2, b'dropped')
+    database.delete_invoice(2)
+    expire(database, kept)
+    expire(database, dropped)
+
+    assert attachment_store.collect_garbage(3600) == (1, size)
+    assert attachment_store.exists(kept)
+    assert not attachment_store.exists(dropped)
+    assert dropped not in blobs(database)
+
+
+def test_gc_removes_stale_orphan_and_temp_files(database):
+    orphan = attachment_store.path_for('ab' * 32)
+    leftover = os.path.join(attachment_store.root, 'tmp', 'upload-leftover')
+    for path in (orphan, leftover):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x')
+        os.utime(path, (PAST, PAST))
+
+    assert attachment_store.collect_garbage(3600) == (2, 2)
+    assert not os.path.exists(orphan) and not os.path.exists(leftover)
+
+
+def test_upload_during_gc_keeps_the_blob(database, monkeypatch):
+    """A dedup onto a blob GC is removing waits for GC's lock, then writes it again"""
+    data = b'shared content'
+    sha256, _ = save(database, 2, data)
+    database.delete_invoice(2)
+    expire(database, sha256)
+
+    unlinked = threading.Event()
+    remove_if_stale = attachment_store._remove_if_stale
+
+    def slow_remove(path, cutoff):
+        size = remove_if_stale(path, cutoff)
+        unlinked.set()
+        time.sleep(0.3)  # still inside GC's transaction
+        return size
+
+    monkeypatch.setattr(attachment_store, '_remove_if_stale', slow_remove)
+    results = []
+    gc = threading.Thread(target=lambda: results.append(attachment_store.collect_garbage(3600)))
+    gc.start()
+    unlinked.wait(5)
+    save(database, 1, data)
+    gc.join()
+
+    assert results == [(1, len(data))]
+    assert attachment_store.exists(sha256)
+    assert blobs(database) == {sha256: 1}
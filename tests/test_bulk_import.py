@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+
+RECORD = {'user_id': 2, 'invoice_date': '2024-06-01'}
+
+
+def stored_numbers(db):
+    conn = db.get_pool().acquire()
+    try:
+        return [row[0] for row in conn.execute("SELECT invoice_number FROM invoices")]
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('data, expected', [
+    ({}, ''),
+    ({'invoice_number': None}, ''),
+    ({'invoice_number': ''}, ''),
+    ({'invoice_number': 0}, ''),
+    ({'invoice_number': 'INV-X-1'}, 'INV-X-1'),
+    ({'invoice_number': 1042}, '1042'),
+])
+def test_bulk_invoice_number(database, data, expected):
+    assert database._bulk_invoice_number(data) == expected
+
+
+@pytest.mark.parametrize('number', [True, ['INV-1'], {'n': 1}])
+def test_bulk_invoice_number_rejects_non_scalars(database, number):
+    with pytest.raises(ValueError):
+        database._bulk_invoice_number({'invoice_number': number})
+
+
+def test_batch_reports_bad_records_without_failing_the_rest(database):
+    results = database.insert_invoice_batch([
+        (1, {**RECORD, 'invoice_number': ['bad']}),
+        (2, {**RECORD, 'invoice_number': 'INV-BULK-1'}),
+        (3, {**RECORD, 'invoice_number': 'INV-2024-001'}),
+        (4, {**RECORD, 'invoice_number': 'INV-BULK-1'}),
+        (5, {**RECORD, 'items': [{'description': 'x'}, 'not an object']}),
+    ])
+
+    assert [result['status'] for result in results] == \
+        ['error', 'created', 'duplicate', 'duplicate', 'error']
+    numbers = stored_numbers(database)
+    assert numbers.count('INV-BULK-1') == 1
+    assert results[4]['invoice_number'] not in numbers
+
+
+def test_allocated_numbers_skip_explicit_ones_in_the_batch(database):
+    year = database.datetime.now().year
+    upcoming = [f'INV-{year}-{value:03d}' for value in (1, 2)]
+
+    results = database.insert_invoice_batch([
+        (1, {**RECORD}),
+        (2, {**RECORD, 'invoice_number': upcoming[0]}),
+        (3, {**RECORD}),
+        (4, {**RECORD, 'invoice_number': upcoming[1]}),
+    ])
+
+    assert [result['status'] for result in results] == ['created'] * 4
+    numbers = [result['invoice_number'] for result in results]
+    assert len(set(numbers)) == 4
+
+
+def test_allocation_skips_numbers_stored_after_the_sequence_started(database):
+    first = database.allocate_invoice_numbers(1, 2024)
+    assert first == ['INV-2024-011']
+
+    # Stored explicitly past the sequence (an import, or a bulk row with its own number)
+    database.create_invoice(2, 1, 'INV-2024-013', '2024-06-01', None, 'draft',
+                            0, 0, 0, 0, 0, '', '')
+
+    block = database.allocate_invoice_numbers(3, 2024)
+    assert len(set(block)) == 3
+    assert not set(block) & set(stored_numbers(database))
+    assert min(block) > 'INV-2024-013'
+
+
+def test_bulk_endpoint_streams_one_result_per_line(client):
+    body = '\n'.join([
+        json.dumps({**RECORD, 'invoice_number': 'INV-NDJSON-1'}),
+        '{not json',
+        json.dumps(['not', 'an', 'object']),
+        '',
+        json.dumps({**RECORD, 'invoice_number': 'INV-NDJSON-1'}),
+    ])
+    response = client.post('/api/invoices/bulk?batch_size=2', data=body,
+                           content_type='application/x-ndjson')
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert [line['line'] for line in lines[:-1]] == [2, 3, 1, 5]
+    assert lines[-1]['summary']['created'] == 1
+    assert lines[-1]['summary']['duplicate'] == 1
+    assert lines[-1]['summary']['error'] == 2
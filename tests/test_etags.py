@@ -0,0 +1,86 @@
+def execute(db, query, params=()):
+    conn = db.get_pool().acquire()
+    try:
+        conn.execute(query, params)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_invoice_etag_answers_304(client):
+    first = client.get('/api/invoices/1')
+    etag = first.headers['ETag']
+    assert first.status_code == 200
+    assert 'no-cache' in first.headers['Cache-Control']
+
+    again = client.get('/api/invoices/1', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.headers['ETag'] == etag
+    assert again.data == b''
+
+
+def test_invoice_etag_changes_on_header_write(client, database):
+    etag = client.get('/api/invoices/1').headers['ETag']
+    database.update_invoice(1, notes='changed')
+
+    response = client.get('/api/invoices/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_invoice_etag_changes_on_item_write(client, database):
+    etag = client.get('/api/invoices/1').headers['ETag']
+    database.add_invoice_item(1, 'Extra', 1, 10, 10, 9)
+
+    response = client.get('/api/invoices/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['items'][-1]['description'] == 'Extra'
+
+
+def test_invoice_etag_changes_with_its_company(database):
+    etag = database.get_invoice_etag(1, 'json')
+    execute(database, "UPDATE companies SET company_name='Renamed' WHERE id=1")
+    renamed = database.get_invoice_etag(1, 'json')
+    execute(database, "DELETE FROM companies WHERE id=1")
+
+    assert len({etag, renamed, database.get_invoice_etag(1, 'json')}) == 3
+
+
+def test_unrelated_company_keeps_invoice_etag(database):
+    etag = database.get_invoice_etag(1, 'json')
+    execute(database, "UPDATE companies SET company_name='Renamed' WHERE id=4")
+    assert database.get_invoice_etag(1, 'json') == etag
+
+
+def test_collection_etag_tracks_invoices_and_companies(database):
+    etag = database.get_invoices_collection_etag(2, 'json')
+    assert database.get_invoices_collection_etag(2, 'json') == etag
+    assert database.get_invoices_collection_etag(2, 'ndjson') != etag
+
+    execute(database, "UPDATE companies SET phone='555-0000' WHERE id=2")
+    renamed = database.get_invoices_collection_etag(2, 'json')
+    assert renamed != etag
+
+    database.create_invoice(2, 1, 'INV-ETAG-1', '2024-06-01', None, 'draft',
+                            0, 0, 0, 0, 0, '', '')
+    assert database.get_invoices_collection_etag(2, 'json') != renamed
+
+
+def test_missing_invoice_has_no_etag(client, database):
+    assert database.get_invoice_etag(999) is None
+    assert client.get('/api/invoices/999').status_code == 404
+
+
+def test_invoice_page_is_private_and_per_viewer(client, login):
+    login()
+    first = client.post('/invoice/view', data={'invoice_id': 1})
+    etag = first.headers['ETag']
+    assert 'private' in first.headers['Cache-Control']
+
+    again = client.post('/invoice/view', data={'invoice_id': 1}, headers={'If-None-Match': etag})
+    assert again.status_code == 304
+
+    client.get('/logout')
+    login('admin', 'InvoiceFlow2024!Secure')
+    other = client.post('/invoice/view', data={'invoice_id': 1}, headers={'If-None-Match': etag})
+    assert other.status_code == 200
@@ -0,0 +1,88 @@
+import pytest
+
+
+@pytest.fixture
+def request_context(app):
+    with app.test_request_context():
+        yield
+        app.do_teardown_request()
+        app.do_teardown_appcontext()
+
+
+def stats(db):
+    return {table: tuple(counts) for table, counts in db.g.identity_map_stats.items()
+            if any(counts)}
+
+
+def test_repeat_lookup_is_served_from_memory(database, request_context):
+    first = database.get_invoice(1)
+    again = database.get_invoice('1')
+
+    assert again == first
+    assert stats(database) == {'invoices': (1, 1)}
+
+
+def test_callers_get_copies(database, request_context):
+    database.get_invoice(1)['status'] = 'tampered'
+    assert database.get_invoice(1)['status'] == 'paid'
+
+
+def test_write_discards_the_cached_row(database, request_context):
+    database.get_invoice(1)
+    database.update_invoice(1, status='sent')
+
+    assert database.get_invoice(1)['status'] == 'sent'
+
+
+def test_unit_of_work_discards_touched_invoices(database, request_context):
+    database.get_invoice(2)
+    database.update_invoice_with_items(2, {'notes': 'revised'}, [])
+
+    assert database.get_invoice(2)['notes'] == 'revised'
+
+
+def test_user_and_company_lookups_are_mapped(database, request_context):
+    database.get_user_by_id(2)
+    database.get_user_by_id(2)
+    database.get_company(1)
+    database.update_user(2, full_name='Johnny')
+
+    assert database.get_user_by_id(2)['full_name'] == 'Johnny'
+    assert database.get_company(1)['company_name'] == 'Acme Corporation'
+    assert stats(database) == {'users': (1, 2), 'companies': (1, 1)}
+
+
+def test_missing_rows_are_not_remembered(database, request_context):
+    assert database.get_invoice(999) is None
+    database.create_invoice(2, 1, 'INV-IDMAP-1', '2024-06-01', None, 'draft',
+                            0, 0, 0, 0, 0, '', '')
+
+    assert database.get_invoice(11)['invoice_number'] == 'INV-IDMAP-1'
+
+
+def test_map_lives_for_one_request_only(app, database):
+    with app.test_request_context():
+        database.get_invoice(1)
+        app.do_teardown_request()
+        assert 'identity_map' not in database.g
+        app.do_teardown_appcontext()
+
+    with app.test_request_context():
+        database.get_invoice(1)
+        assert stats(database) == {'invoices': (0, 1)}
+        app.do_teardown_request()
+        app.do_teardown_appcontext()
+
+
+def test_no_map_outside_a_request(database):
+    database.get_invoice(1)
+    database.update_invoice(1, status='sent')
+    assert database.get_invoice(1)['status'] == 'sent'
+
+
+def test_map_can_be_disabled(database, request_context, monkeypatch):
+    monkeypatch.setattr(database, 'IDENTITY_MAP_ENABLED', False)
+    database.get_invoice(1)
+    database.get_invoice(1)
+
+    assert 'identity_map_stats' not in database.g
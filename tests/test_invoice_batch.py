@@ -0,0 +1,122 @@
+import pytest
+
+from models import invoice_batch
+
+
+@pytest.fixture(params=['array', 'numpy'])
+def backend(request, monkeypatch):
+    """Run a test against both column backends (numpy only when installed)"""
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(invoice_batch, 'np', None)
+    return request.param
+
+
+def insert_raw(db, rows):
+    """Insert invoices bypassing the app, so columns can hold NULLs and stray text"""
+    conn = db.get_pool().acquire()
+    try:
+        conn.executemany("""
+            INSERT INTO invoices (user_id, company_id, invoice_number, invoice_date, status,
+                                  subtotal, tax_amount, discount, total)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def all_invoices(db):
+    conn = db.get_pool().acquire()
+    try:
+        return [dict(row) for row in conn.execute("SELECT * FROM invoices")]
+    finally:
+        conn.close()
+
+
+def test_batch_matches_row_by_row_totals(database, backend):
+    invoices = all_invoices(database)
+    batch = database.load_invoice_batch()
+
+    assert batch.backend == backend
+    assert len(batch) == len(invoices)
+    totals = batch.totals()
+    assert totals['count'] == len(invoices)
+    assert totals['total'] == pytest.approx(sum(inv['total'] for inv in invoices))
+
+    by_status = batch.group_by_status()
+    assert set(by_status) == {inv['status'] for inv in invoices}
+    for status, group in by_status.items():
+        rows = [inv for inv in invoices if inv['status'] == status]
+        assert group['count'] == len(rows)
+        assert group['subtotal'] == pytest.approx(sum(inv['subtotal'] for inv in rows))
+
+
+def test_company_and_month_groups(database, backend):
+    invoices = all_invoices(database)
+    batch = database.load_invoice_batch()
+
+    by_company = batch.group_by_company()
+    assert sum(group['count'] for group in by_company.values()) == len(invoices)
+    assert by_company[1]['count'] == sum(1 for inv in invoices if inv['company_id'] == 1)
+
+    by_month = batch.bucket_by_date('month')
+    assert set(by_month) == {inv['invoice_date'][:7] for inv in invoices}
+    assert list(by_month) == sorted(by_month)
+
+
+def test_null_status_and_stray_values_are_coerced(database, backend):
+    insert_raw(database, [
+        (9, None, 'INV-RAW-1', '2024-03-05', None, None, None, None, None),
+        (9, '77', 'INV-RAW-2', 'not a date', None, '12.5', '1', 'abc', '13.5'),
+        ('9', 1, 'INV-RAW-3', '2024-03-20', 'sent', 100, 10, 0, 110),
+    ])
+    batch = database.load_invoice_batch(user_id=9)
+
+    assert batch.group_by_status() == {
+        'sent': {'count': 1, 'subtotal': 100.0, 'tax_amount': 10.0, 'discount': 0.0, 'total': 110.0},
+        'unknown': {'count': 2, 'subtotal': 12.5, 'tax_amount': 1.0, 'discount': 0.0, 'total': 13.5},
+    }
+    assert {company: group['count'] for company, group in batch.group_by_company().items()} == \
+        {0: 1, 1: 1, 77: 1}
+    assert {year: group['count'] for year, group in batch.bucket_by_date('year').items()} == \
+        {'2024': 2, 'unknown': 1}
+
+
+def test_from_cursor_reads_in_chunks(database, backend):
+    insert_raw(database, [(2, 1, f'INV-CHUNK-{n}', '2024-07-01', 'draft', n, 0, 0, n)
+                          for n in range(25)])
+    whole = database.load_invoice_batch(statuses=['draft'])
+    chunked = database.load_invoice_batch(statuses=['draft'], chunk_size=4)
+
+    assert len(chunked) == len(whole)
+    assert chunked.summary('week') == whole.summary('week')
+
+
+def test_empty_batch(database, backend):
+    batch = database.load_invoice_batch(statuses=['no-such-status'])
+
+    assert len(batch) == 0
+    assert batch.summary() == {'totals': {'count': 0, 'subtotal': 0.0, 'tax_amount': 0.0,
+                                          'discount': 0.0, 'total': 0.0},
+                               'by_status': {}, 'by_company': {}, 'by_date': {}}
+
+
+@pytest.mark.parametrize('period, label', [
+    ('day', '2024-03-05'), ('week', '2024-W10'), ('month', '2024-03'), ('year', '2024'),
+])
+def test_date_labels(period, label):
+    ordinal = invoice_batch.date(2024, 3, 5).toordinal()
+    assert invoice_batch._date_label(ordinal, period) == label
+
+
+def test_unknown_bucket_is_rejected(database):
+    with pytest.raises(ValueError):
+        database.load_invoice_batch().bucket_by_date('quarter')
+
+
+def test_stats_endpoint(client):
+    body = client.get('/api/stats/invoices?bucket=year').get_json()
+    assert body['totals']['count'] == 10
+    assert client.get('/api/stats/invoices?bucket=quarter').status_code == 400
@@ -0,0 +1,94 @@
+import pytest
+
+
+def stored(item_id, description, quantity, unit_price, amount, sort_order):
+    return {'id': item_id, 'description': description, 'quantity': quantity,
+            'unit_price': unit_price, 'amount': amount, 'sort_order': sort_order}
+
+
+STORED = [stored(1, 'Design', 2.0, 50.0, 100.0, 1),
+          stored(2, 'Build', 1.0, 300.0, 300.0, 2),
+          stored(3, 'Support', 4.0, 25.0, 100.0, 3)]
+
+
+def invoice_version(db, invoice_id):
+    conn = db.get_pool().acquire()
+    try:
+        row = conn.execute("SELECT items_version, updated_at FROM invoices WHERE id=?",
+                           (invoice_id,)).fetchone()
+        return tuple(row)
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('column, old, new, equal', [
+    ('quantity', 2.0, '2', True),
+    ('unit_price', 2.5, '2.50', True),
+    ('amount', 2.5, '2.6', False),
+    ('description', '1', '1.0', False),
+    ('description', 'Design', 'Design', True),
+    ('notes', None, '', False),
+    ('quantity', 1, 'abc', False),
+])
+def test_values_equal(database, column, old, new, equal):
+    assert database._values_equal(column, old, new) is equal
+
+
+def test_unchanged_form_post_writes_nothing(database):
+    items = [(str(item['id']), item['description'], str(item['quantity']), str(item['unit_price']),
+              str(item['amount']), str(item['sort_order'])) for item in STORED]
+    assert database.diff_invoice_items(STORED, items) == ([], [], [])
+
+
+def test_diff_updates_inserts_and_deletes(database):
+    items = [(1, 'Design', 3, 50, 150, 1),      # changed
+             (2, 'Build', 1, 300, 300, 2),      # unchanged
+             (None, 'Hosting', 1, 20, 20, 4)]   # new; item 3 dropped
+    inserts, updates, delete_ids = database.diff_invoice_items(STORED, items)
+
+    assert inserts == [('Hosting', 1, 20, 20, 4)]
+    assert updates == [('Design', 3, 50, 150, 1, 1)]
+    assert delete_ids == [3]
+
+
+def test_rows_without_ids_match_by_sort_order(database):
+    items = [(None, 'Design', 2, 50, 100, 1),
+             ('', 'Build v2', 1, 300, 300, 2),
+             ('x', 'Support', 4, 25, 100, 3)]
+    inserts, updates, delete_ids = database.diff_invoice_items(STORED, items)
+
+    assert (inserts, delete_ids) == ([], [])
+    assert updates == [('Build v2', 1, 300, 300, 2, 2)]
+
+
+def test_update_invoice_with_items_is_minimal(database):
+    before = invoice_version(database, 2)
+    stored_items = database.get_invoice_items(2)
+    items = [(item['id'], item['description'], item['quantity'], item['unit_price'],
+              item['amount'], item['sort_order']) for item in stored_items]
+
+    summary = database.update_invoice_with_items(2, {'status': 'sent'}, items)
+
+    assert summary == {'header_fields': [], 'inserted': 0, 'updated': 0, 'deleted': 0}
+    assert invoice_version(database, 2) == before
+
+
+def test_item_edit_bumps_items_version(database):
+    before = invoice_version(database, 2)
+    stored_items = database.get_invoice_items(2)
+    first = stored_items[0]
+    items = [(first['id'], first['description'] + ' (revised)', first['quantity'],
+              first['unit_price'], first['amount'], first['sort_order'])]
+
+    summary = database.update_invoice_with_items(2, {'notes': 'revised'}, items)
+
+    assert summary['header_fields'] == ['notes']
+    assert summary['updated'] == 1
+    assert summary['deleted'] == len(stored_items) - 1
+    assert invoice_version(database, 2)[0] > before[0]
+    assert [item['description'] for item in database.get_invoice_items(2)] == \
+        [first['description'] + ' (revised)']
+
+
+def test_update_of_missing_invoice_returns_none(database):
+    assert database.update_invoice_with_items(999, {}, []) is None
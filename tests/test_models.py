@@ -0,0 +1,58 @@
+import sqlite3
+
+import pytest
+
+from models import Company, Invoice, InvoiceItem, model_from_row
+
+
+def idle_connections(db):
+    """Free slots in the connection pool"""
+    return db.get_pool()._slots._value
+
+
+def test_fetch_models_builds_slot_objects(database):
+    invoices = database.fetch_models(Invoice, "SELECT * FROM invoices ORDER BY id")
+
+    assert len(invoices) == 10
+    assert isinstance(invoices[0], Invoice)
+    assert invoices[0].invoice_number == 'INV-2024-001'
+    assert not hasattr(invoices[0], '__dict__')
+
+
+def test_missing_columns_get_init_defaults_and_extras_are_ignored(database):
+    [invoice] = database.fetch_models(
+        Invoice, "SELECT id, total, 'x' AS company_name FROM invoices WHERE id=1")
+
+    assert (invoice.id, invoice.total) == (1, 5400.0)
+    assert invoice.status == 'draft'
+    assert invoice.items_version == 0
+
+
+def test_factory_replans_when_the_columns_change(database):
+    first = database.fetch_models(InvoiceItem, "SELECT id, description FROM invoice_items WHERE id=1")
+    second = database.fetch_models(InvoiceItem, "SELECT description, id, amount FROM invoice_items WHERE id=1")
+
+    assert (first[0].id, first[0].description) == (second[0].id, second[0].description)
+    assert second[0].amount == 5000.0
+
+
+def test_iter_query_with_model_matches_fetch_models(database):
+    query = "SELECT * FROM companies ORDER BY id"
+    streamed = list(database.iter_query(query, batch_size=2, model=Company))
+    fetched = database.fetch_models(Company, query)
+
+    assert len(streamed) == len(fetched) > 2
+    assert [(c.id, c.company_name) for c in streamed] == [(c.id, c.company_name) for c in fetched]
+
+
+def test_fetch_models_releases_the_connection_on_error(database):
+    free = idle_connections(database)
+    with pytest.raises(sqlite3.OperationalError):
+        database.fetch_models(Invoice, "SELECT * FROM no_such_table")
+    assert idle_connections(database) == free
+
+
+def test_model_from_row(database):
+    assert model_from_row(Company, None) is None
+    company = model_from_row(Company, {'id': 5, 'company_name': 'Acme', 'unknown': 1})
+    assert (company.id, company.company_name) == (5, 'Acme')
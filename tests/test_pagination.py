@@ -0,0 +1,67 @@
+import pytest
+
+
+def all_pages(db, limit):
+    pages, cursor = [], None
+    while True:
+        page, cursor = db.get_all_invoices_page(cursor=cursor, limit=limit)
+        pages.append([row['id'] for row in page])
+        if cursor is None:
+            return pages
+
+
+def iter_pages(db, cursor, limit):
+    while cursor:
+        page, cursor = db.get_all_invoices_page(cursor=cursor, limit=limit)
+        yield page
+
+
+def test_pages_cover_every_invoice_once_newest_first(database):
+    pages = all_pages(database, 3)
+
+    ids = [invoice_id for page in pages for invoice_id in page]
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    assert ids == sorted(ids, reverse=True)
+    assert sorted(ids) == list(range(1, 11))
+
+
+def test_last_full_page_has_no_next_cursor(database):
+    page, cursor = database.get_all_invoices_page(limit=10)
+    assert len(page) == 10
+    assert cursor is None
+
+
+def test_cursor_is_stable_across_inserts(database):
+    first, cursor = database.get_all_invoices_page(limit=4)
+    database.create_invoice(2, 1, 'INV-PAGE-NEW', '2024-06-01', None, 'draft',
+                            0, 0, 0, 0, 0, '', '')
+    rest = [row['id'] for page in iter_pages(database, cursor, 4) for row in page]
+
+    assert [row['id'] for row in first] + rest == list(range(10, 0, -1))
+
+
+def test_user_pages_only_hold_that_users_invoices(database):
+    page, _ = database.get_invoices_by_user_page(2, limit=50)
+    assert page and {row['user_id'] for row in page} == {2}
+
+
+@pytest.mark.parametrize('cursor', ['not-base64!', 'WyJhIl0=', 'WyJhIiwgImIiXQ=='])
+def test_malformed_cursor_raises_value_error(database, cursor):
+    with pytest.raises(ValueError):
+        database.decode_cursor(cursor)
+
+
+def test_api_rejects_malformed_cursor(client):
+    response = client.get('/api/invoices/list?cursor=bogus')
+    assert response.status_code == 400
+
+
+def test_api_follows_next_cursor(client):
+    seen, cursor = [], ''
+    while True:
+        body = client.get(f'/api/invoices/list?limit=4&cursor={cursor}').get_json()
+        seen.extend(invoice['id'] for invoice in body['invoices'])
+        cursor = body['next_cursor']
+        if not cursor:
+            break
+    assert seen == list(range(10, 0, -1))
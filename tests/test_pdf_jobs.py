@@ -0,0 +1,129 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pdf_renderer import PdfJobRunner
+
+
+def enqueue(db, count):
+    return [db.enqueue_pdf_job(1, 2, f'<p>{n}</p>', f'key-{n}') for n in range(count)]
+
+
+def age_leases(db, job_ids, seconds):
+    conn = db.get_pool().acquire()
+    try:
+        conn.executemany("UPDATE pdf_jobs SET leased_at=datetime('now', ?) WHERE id=?",
+                         [(f'-{seconds} seconds', job_id) for job_id in job_ids])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_claim_takes_oldest_jobs_up_to_limit(database):
+    job_ids = enqueue(database, 5)
+
+    claimed = database.claim_pdf_jobs(3, stale_after=60)
+
+    assert [job['id'] for job in claimed] == job_ids[:3]
+    assert claimed[0]['html'] == '<p>0</p>'
+    assert database.count_pdf_jobs('queued') == 2
+    assert database.count_pdf_jobs('running') == 3
+
+
+def test_concurrent_claims_never_share_a_job(database):
+    job_ids = enqueue(database, 40)
+    claims = []
+    barrier = threading.Barrier(4)
+
+    def claim():
+        barrier.wait()
+        for _ in range(5):
+            claims.extend(job['id'] for job in database.claim_pdf_jobs(2, stale_after=60))
+
+    threads = [threading.Thread(target=claim) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claims) == job_ids
+
+
+def test_expired_lease_is_claimed_again(database):
+    job_ids = enqueue(database, 2)
+    database.claim_pdf_jobs(2, stale_after=60)
+    age_leases(database, job_ids[:1], 3600)
+
+    reclaimed = database.claim_pdf_jobs(5, stale_after=60)
+
+    assert [job['id'] for job in reclaimed] == job_ids[:1]
+
+
+def test_renewed_lease_is_not_reclaimed(database):
+    job_ids = enqueue(database, 2)
+    database.claim_pdf_jobs(2, stale_after=60)
+    age_leases(database, job_ids, 3600)
+
+    database.renew_pdf_job_leases(job_ids)
+
+    assert database.claim_pdf_jobs(5, stale_after=60) == []
+
+
+def test_finish_does_not_touch_a_requeued_job(database):
+    [job_id] = enqueue(database, 1)
+    database.claim_pdf_jobs(1, stale_after=60)
+    database.requeue_pdf_job(job_id)
+
+    database.finish_pdf_job(job_id)
+
+    job = database.get_pdf_job(job_id)
+    assert job['status'] == 'queued'
+    assert job['finished_at'] is None
+
+
+def test_finish_records_failure(database):
+    [job_id] = enqueue(database, 1)
+    database.claim_pdf_jobs(1, stale_after=60)
+
+    database.finish_pdf_job(job_id, error='wkhtmltopdf exited with 1')
+
+    job = database.get_pdf_job(job_id)
+    assert (job['status'], job['error']) == ('failed', 'wkhtmltopdf exited with 1')
+
+
+class SlowRenderer:
+    """Stands in for PdfRenderer: one worker, each render takes `delay` seconds"""
+
+    timeout = 1
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.rendered = []
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, html, cache_key):
+        return self._executor.submit(self._render, cache_key)
+
+    def _render(self, cache_key):
+        time.sleep(self.delay)
+        self.rendered.append(cache_key)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def test_runner_keeps_leases_on_jobs_waiting_in_its_pool(database):
+    # Five 0.6s renders queue behind one worker for ~3s, past the 2s stale
+    # window (2 x renderer timeout); renewal must stop them being reclaimed
+    job_ids = enqueue(database, 5)
+    renderer = SlowRenderer(0.6)
+    runner = PdfJobRunner(renderer, concurrency=5, poll_interval=0.05)
+
+    runner.start()
+    deadline = time.monotonic() + 10
+    while database.count_pdf_jobs('done') < len(job_ids) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    runner.stop()
+
+    assert sorted(renderer.rendered) == sorted(f'key-{n}' for n in range(5))
+    assert runner.stats()['claimed'] == 5
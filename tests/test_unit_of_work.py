@@ -0,0 +1,82 @@
+import sqlite3
+
+import pytest
+
+
+def count_invoices(db):
+    conn = db.get_pool().acquire()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_create_invoice_with_items_is_atomic(database):
+    before = count_invoices(database)
+
+    with pytest.raises(sqlite3.Error):
+        database.create_invoice_with_items(
+            2, 1, 'INV-UOW-1', '2024-05-01', None, 'draft', 100, 0, 0, 0, 100, '', '',
+            items=[('ok', 1, 100, 100, 1), ('too', 'many', 'values', 1, 2, 3)])
+
+    assert count_invoices(database) == before
+
+
+def test_unit_of_work_commits_everything_together(database):
+    invoice_id = database.create_invoice_with_items(
+        2, 1, 'INV-UOW-2', '2024-05-01', None, 'draft', 300, 0, 0, 0, 300, '', '',
+        items=[('a', 1, 100, 100, 1), ('b', 2, 100, 200, 2)], log_details='created')
+
+    conn = database.get_pool().acquire()
+    try:
+        items = conn.execute("SELECT COUNT(*) FROM invoice_items WHERE invoice_id=?",
+                             (invoice_id,)).fetchone()[0]
+        logged = conn.execute("SELECT COUNT(*) FROM activity_log WHERE resource_id=? AND details=?",
+                              (invoice_id, 'created')).fetchone()[0]
+        version = conn.execute("SELECT items_version FROM invoices WHERE id=?",
+                               (invoice_id,)).fetchone()[0]
+    finally:
+        conn.close()
+    assert (items, logged) == (2, 1)
+    assert version == 2
+
+
+def test_unit_of_work_rolls_back_stray_transaction(app, database):
+    with app.test_request_context():
+        conn = database.get_db_connection()
+        conn.execute("DELETE FROM invoices")  # failed helper: no commit, no close()
+        with database.UnitOfWork() as uow:
+            uow.log_activity(2, 'test')
+        database.close_request_connection()
+
+    assert count_invoices(database) == 10
+
+
+def test_nested_unit_of_work_is_refused(app, database):
+    with app.test_request_context():
+        with database.UnitOfWork():
+            with pytest.raises(RuntimeError):
+                with database.UnitOfWork():
+                    pass
+        database.close_request_connection()
+
+
+def test_scoped_close_rolls_back_open_transaction(app, database):
+    with app.test_request_context():
+        conn = database.get_db_connection()
+        conn.execute("DELETE FROM invoices")
+        conn.close()
+        assert not conn.in_transaction
+        assert database.get_db_connection() is conn
+        database.close_request_connection()
+
+    assert count_invoices(database) == 10
+
+
+def test_pool_reuses_released_connections(database):
+    pool = database.get_pool()
+    first = pool.acquire()
+    first.close()
+    second = pool.acquire()
+    second.close()
+    assert first is second